@@ -1,11 +1,41 @@
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+import tempfile
+from datetime import datetime
+from itertools import islice
+
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, Response, jsonify, stream_with_context,
+                   get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, bcrypt, User, Message, Likes, Follows
+from ratelimit import limiter
+from live import hub, event_stream
+from session_store import init_sessions, revoke_user_sessions
+from cache import user_cache, message_cache
+from availability import availability
+import cache
+import compression
+import export
+import feeds
+import images
+import ingest
+import likes
+import notifications
+import partitions
+import profiles
+import readmodels
+import search
+import shards
+import snowflake
+import tags
+import trending
+import jobs
+import metrics
+import tasks  # registers background tasks with `jobs`
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +50,131 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Background jobs: "queue" stores them in the jobs table for `flask worker`
+# to pick up; "local" (for tests) runs them inline as they're enqueued.
+app.config['JOBS_MODE'] = os.environ.get('JOBS_MODE', 'queue')
+app.config['JOBS_VISIBILITY_TIMEOUT'] = int(
+    os.environ.get('JOBS_VISIBILITY_TIMEOUT', 300))
+app.config['JOBS_MAX_ATTEMPTS'] = int(os.environ.get('JOBS_MAX_ATTEMPTS', 5))
+
+# Rate limits for login/signup/posting: "memory" keeps buckets per process;
+# "sqlite:////path/to/file.db" shares them between processes on a host.
+app.config['RATELIMIT_ENABLED'] = (
+    os.environ.get('RATELIMIT_ENABLED', 'true').lower() == 'true')
+app.config['RATELIMIT_STORAGE'] = os.environ.get('RATELIMIT_STORAGE', 'memory')
+
+# Sessions: "cookie" keeps Flask's signed cookie; "memory" or
+# "sqlite:////path/to/file.db" keep the data server-side behind an opaque id.
+app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'cookie')
+
+# Cached user/message lookups: set "sqlite:////path/to/file.db" to share
+# them between processes on a host, on top of each process's own LRU.
+app.config['CACHE_SHARED'] = os.environ.get('CACHE_SHARED')
+
+# Trending counters are in-memory; set a path to snapshot them to disk.
+app.config['TRENDING_SNAPSHOT_PATH'] = os.environ.get('TRENDING_SNAPSHOT_PATH')
+app.config['TRENDING_SNAPSHOT_INTERVAL'] = int(
+    os.environ.get('TRENDING_SNAPSHOT_INTERVAL', 60))
+
+# Home feed engine: "query" sorts all followed users' messages in one
+# query; "merge" merges each followed user's newest messages; "hybrid"
+# pushes messages to followers' feeds, except from accounts with at least
+# FEED_CELEBRITY_THRESHOLD followers, which are merged in (see feeds.py).
+app.config['FEED_ENGINE'] = os.environ.get('FEED_ENGINE', 'query')
+app.config['FEED_CELEBRITY_THRESHOLD'] = int(
+    os.environ.get('FEED_CELEBRITY_THRESHOLD', 1000))
+
+# Proxied profile/header image thumbnails are cached on disk here, up to
+# IMAGE_CACHE_MAX_BYTES. Fetching from private addresses is refused unless
+# IMAGE_PROXY_ALLOW_PRIVATE is "true" (for local development and tests).
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['IMAGE_PROXY_TIMEOUT'] = float(
+    os.environ.get('IMAGE_PROXY_TIMEOUT', 5))
+app.config['IMAGE_PROXY_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_PROXY_MAX_BYTES', 5 * 1024 * 1024))
+app.config['IMAGE_PROXY_MAX_PIXELS'] = int(
+    os.environ.get('IMAGE_PROXY_MAX_PIXELS', 25 * 1000 * 1000))
+app.config['IMAGE_PROXY_FAILURE_TTL'] = float(
+    os.environ.get('IMAGE_PROXY_FAILURE_TTL', 300))
+app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = (
+    os.environ.get('IMAGE_PROXY_ALLOW_PRIVATE', 'false').lower() == 'true')
+
+# Message ids embed a worker number claimed per process from this range;
+# give each host its own range if several hosts post messages.
+app.config['MESSAGE_ID_WORKERS'] = os.environ.get('MESSAGE_ID_WORKERS', '0-1023')
+app.config['MESSAGE_ID_LOCK_DIR'] = os.environ.get('MESSAGE_ID_LOCK_DIR')
+
+# Most messages accepted in one request to the batch ingestion API.
+app.config['INGEST_MAX_BATCH'] = int(os.environ.get('INGEST_MAX_BATCH', 1000))
+
+# Comma-separated database URLs to spread messages and likes over, by user
+# id; unset keeps them in the main database (see shards.py).
+app.config['MESSAGE_SHARDS'] = os.environ.get('MESSAGE_SHARDS')
+
+# `flask maintain-partitions` moves messages older than this many months
+# out of the database into compressed files here (see partitions.py).
+app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'] = int(
+    os.environ.get('MESSAGE_ARCHIVE_AFTER_MONTHS', 12))
+app.config['MESSAGE_ARCHIVE_DIR'] = os.environ.get(
+    'MESSAGE_ARCHIVE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-archive'))
+
+# Compress text responses of at least COMPRESS_MIN_SIZE bytes with brotli
+# or gzip (see compression.py). Levels trade CPU for size: gzip 1-9,
+# brotli 0-11.
+app.config['COMPRESS_ENABLED'] = (
+    os.environ.get('COMPRESS_ENABLED', 'true').lower() == 'true')
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+app.config['COMPRESS_LEVEL'] = int(os.environ.get('COMPRESS_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(
+    os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+
+# Buffer likes and unlikes in memory and write them in batches every
+# LIKES_FLUSH_INTERVAL seconds. LIKES_DURABILITY is "none", "journal"
+# (survives the process dying) or "fsync" (survives the host; see likes.py).
+app.config['LIKES_WRITE_BEHIND'] = (
+    os.environ.get('LIKES_WRITE_BEHIND', 'false').lower() == 'true')
+app.config['LIKES_FLUSH_INTERVAL'] = float(
+    os.environ.get('LIKES_FLUSH_INTERVAL', 0.25))
+app.config['LIKES_BUFFER_SIZE'] = int(os.environ.get('LIKES_BUFFER_SIZE', 10000))
+app.config['LIKES_DURABILITY'] = os.environ.get('LIKES_DURABILITY', 'journal')
+app.config['LIKES_JOURNAL_DIR'] = os.environ.get(
+    'LIKES_JOURNAL_DIR', os.path.join(tempfile.gettempdir(), 'warbler-likes'))
+
+# `flask rollup-notifications` deletes notifications older than this.
+app.config['NOTIFICATIONS_KEEP_DAYS'] = int(
+    os.environ.get('NOTIFICATIONS_KEEP_DAYS', 90))
+
+# Turn away taken usernames and emails at signup before hashing the
+# password, using an in-memory bloom filter (see availability.py).
+app.config['AVAILABILITY_ENABLED'] = (
+    os.environ.get('AVAILABILITY_ENABLED', 'true').lower() == 'true')
+app.config['AVAILABILITY_ERROR_RATE'] = float(
+    os.environ.get('AVAILABILITY_ERROR_RATE', 0.01))
+app.config['AVAILABILITY_SYNC_INTERVAL'] = float(
+    os.environ.get('AVAILABILITY_SYNC_INTERVAL', 5))
+app.config['AVAILABILITY_REBUILD_INTERVAL'] = float(
+    os.environ.get('AVAILABILITY_REBUILD_INTERVAL', 3600))
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+shards.router.init_app(app)
+partitions.init_app(app)
+snowflake.init_app(app)
+limiter.init_app(app)
+init_sessions(app, CURR_USER_KEY)
+app.add_template_filter(tags.linkify_tags)
+app.add_template_filter(images.thumbnail)
+images.proxy.init_app(app)
+trending.init_app(app)
+cache.init_app(app)
+compression.compressor.init_app(app)
+likes.init_app(app)
+availability.init_app(app)
 
 
 ##############################################################################
@@ -33,11 +185,27 @@ connect_db(app)
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
+    g.user = None
+
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user = user_cache.get(session[CURR_USER_KEY])
+        if user is not None and user.deleted_at is None:
+            g.user = user
 
-    else:
-        g.user = None
+
+@app.context_processor
+def add_viewer():
+    """Add the current user, as a UserCard, and their unread count.
+
+    Templates use `viewer` rather than `g.user`, so they can't run queries.
+    """
+
+    user = g.get('user')
+    if user is None:
+        return {'viewer': None, 'unread': 0}
+
+    return {'viewer': readmodels.UserCard.from_user(user),
+            'unread': notifications.unread_count(user.id)}
 
 
 def do_login(user):
@@ -62,13 +230,25 @@ def signup():
 
     If form not valid, present form.
 
-    If the there already is a user with that username: flash message
-    and re-present form.
+    If the there already is a user with that username or email: flash
+    message and re-present form.
     """
 
+    if request.method == 'POST' and not limiter.hit('signup_ip',
+                                                    request.remote_addr):
+        abort(429)
+
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Before User.signup, which spends a bcrypt hash on the password.
+        # One message for both, so signup doesn't say which emails have
+        # accounts either.
+        if (availability.is_taken('username', form.username.data) or
+                availability.is_taken('email', form.email.data)):
+            flash("Username or email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
@@ -79,9 +259,10 @@ def signup():
             db.session.commit()
 
         except IntegrityError:
-            flash("Username already taken", 'danger')
+            flash("Username or email already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(user.username, user.email)
         do_login(user)
 
         return redirect("/")
@@ -90,10 +271,36 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
+@app.route('/users/available')
+def username_available():
+    """Is the 'username' querystring param free? For the signup form.
+
+    Only usernames, which are public anyway; saying which emails have
+    accounts would help find people's accounts.
+    """
+
+    if not limiter.hit('available_ip', request.remote_addr):
+        abort(429)
+
+    username = request.args.get('username', '')
+    if not username:
+        return api_error("username is required", 400)
+
+    return jsonify({'username': username,
+                    'available': not availability.is_taken('username', username)})
+
+
 @app.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
+    # Checked before the form so rejected attempts never reach bcrypt.
+    if request.method == 'POST':
+        username = request.form.get('username', '').lower()
+        if not (limiter.hit('login_ip', request.remote_addr) and
+                limiter.hit('login_username', username)):
+            abort(429)
+
     form = LoginForm()
 
     if form.validate_on_submit():
@@ -131,29 +338,111 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = readmodels.card_query()
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    return stream_template('users/index.html',
+                           users=user_cards(users))
+
+
+def get_active_user_or_404(user_id):
+    """Cached lookup of a user, 404ing for missing or deleted accounts."""
+
+    user = user_cache.get_or_404(user_id)
+    if user.deleted_at is not None:
+        abort(404)
+    return user
+
+
+def summary_for(user):
+    """Profile header stats for `user`, as seen by the current user."""
+
+    return profiles.profile_summary(user.id, g.user.id if g.user else None)
+
+
+# Rows fetched per round trip for the streamed list pages
+STREAM_BATCH_SIZE = 100
+
+# Template pieces joined into each chunk sent while streaming
+STREAM_BUFFER_SIZE = 20
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but send the page out as it renders.
+
+    Pass long lists as iterators (queries with `yield_per`, say): the top
+    of the page goes out straight away, and neither the rows nor the HTML
+    are ever all in memory at once.
+
+    The session is saved before the page renders, so the flashed messages
+    are taken out of it here, and the template's `get_flashed_messages`
+    returns those.
+    """
+
+    flashes = get_flashed_messages(with_categories=True)
+
+    def flashed(with_categories=False, category_filter=()):
+        return [(category, message) if with_categories else message
+                for category, message in flashes
+                if not category_filter or category in category_filter]
+
+    context['get_flashed_messages'] = flashed
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype='text/html')
+
+
+def user_cards(query):
+    """Stream UserCards for a `readmodels.card_query()`, as seen by the current user."""
+
+    return readmodels.user_cards(query.yield_per(STREAM_BATCH_SIZE),
+                                 g.user.id if g.user else None,
+                                 STREAM_BATCH_SIZE)
+
+
+def feed_items(messages, counts=None, known=None):
+    """FeedItems for `messages`, as seen by the current user.
+
+    `counts` defaults to their like counts; see `readmodels.feed_items`.
+    """
+
+    if counts is None:
+        counts = likes.like_counts(messages)
+    liked = (likes.liked_ids(g.user.id, [msg.id for msg in messages])
+             if g.user else set())
+    return readmodels.feed_items(messages, counts, liked, known)
+
+
+def stream_feed_items(messages):
+    """FeedItems for each of `messages`, built a batch at a time."""
 
-    return render_template('users/index.html', users=users)
+    messages = iter(messages)
+    while True:
+        batch = list(islice(messages, STREAM_BATCH_SIZE))
+        if not batch:
+            return
+        yield from feed_items(batch)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = readmodels.UserCard.from_user(get_active_user_or_404(user_id))
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages = partitions.newest(shards.router
+                                 .session_for(user_id)
+                                 .query(*readmodels.MESSAGE_COLUMNS)
+                                 .filter(Message.user_id == user_id)
+                                 .order_by(Message.id.desc()),
+                                 100)
+    return render_template('users/show.html', user=user,
+                           messages=feed_items(messages, known={user.id: user}),
+                           summary=summary_for(user))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -164,8 +453,14 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = readmodels.UserCard.from_user(get_active_user_or_404(user_id))
+    following = (readmodels
+                 .card_query()
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+    return stream_template('users/following.html', user=user,
+                           following=user_cards(following),
+                           summary=summary_for(user))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -176,8 +471,14 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = readmodels.UserCard.from_user(get_active_user_or_404(user_id))
+    followers = (readmodels
+                 .card_query()
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
+    return stream_template('users/followers.html', user=user,
+                           followers=user_cards(followers),
+                           summary=summary_for(user))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -188,10 +489,15 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = get_active_user_or_404(follow_id)
     g.user.following.append(followed_user)
+    feeds.followed(g.user.id, followed_user.id)
+    notifications.notify(followed_user.id, 'follow', g.user.id)
     db.session.commit()
 
+    profiles.invalidate(g.user.id)
+    profiles.invalidate(followed_user.id, g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -203,10 +509,19 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    # By row, not through `g.user.following`, which hides deleted accounts
+    # still waiting to be purged
+    (Follows
+     .query
+     .filter(Follows.user_following_id == g.user.id,
+             Follows.user_being_followed_id == follow_id)
+     .delete(synchronize_session=False))
+    feeds.unfollowed(g.user.id, follow_id)
     db.session.commit()
 
+    profiles.invalidate(g.user.id)
+    profiles.invalidate(follow_id, g.user.id)
+
     return redirect(f"/users/{g.user.id}/following")
 
 
@@ -229,7 +544,14 @@ def profile():
             user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
             user.bio = form.bio.data
 
+            if form.new_password.data:
+                user.password = bcrypt.generate_password_hash(
+                    form.new_password.data).decode('UTF-8')
+                revoke_user_sessions(user.id, keep=getattr(session, 'sid', None))
+
             db.session.commit()
+            user_cache.invalidate(user.id)
+            availability.add(user.username, user.email)
             return redirect(f"/users/{user.id}")
 
         flash("Please enter the correct password", "danger")
@@ -247,11 +569,43 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hide the account right away; its rows are removed in the background.
+    g.user.deleted_at = datetime.utcnow()
+    db.session.commit()
+    user_cache.invalidate(g.user.id)
+    revoke_user_sessions(g.user.id)
+
+    jobs.enqueue('purge_account', user_id=g.user.id)
     db.session.commit()
 
     return redirect("/signup")
 
+@app.route('/users/export')
+def export_user():
+    """Download a ZIP of the current user's data.
+
+    `after` resumes an interrupted download (see export.py).
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if not limiter.hit('export_user', g.user.id):
+        abort(429)
+
+    after = request.args.get('after')
+    try:
+        export.parse_point(after)
+    except ValueError:
+        abort(400)
+
+    return Response(stream_with_context(export.stream_zip(g.user.id, after)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename='
+                             f'"warbler-{g.user.username}.zip"'})
+
+
 @app.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
     """Show list of posts this user likes"""
@@ -260,8 +614,74 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+    user = readmodels.UserCard.from_user(get_active_user_or_404(user_id))
+    if shards.router.enabled:
+        messages = sharded_liked_messages(user_id)
+    else:
+        messages = (db.session
+                    .query(*readmodels.MESSAGE_COLUMNS)
+                    .join(Likes, Likes.message_id == Message.id)
+                    .join(User, User.id == Message.user_id)
+                    .filter(Likes.user_id == user_id, User.deleted_at.is_(None))
+                    .yield_per(STREAM_BATCH_SIZE))
+    return stream_template('users/likes.html', user=user,
+                           messages=stream_feed_items(messages),
+                           summary=summary_for(user))
+
+
+def sharded_liked_messages(user_id):
+    """Yield rows of the messages `user_id` likes, by active users, in like order.
+
+    The likes are on the user's shard and the messages on their authors'
+    shards, so they're gathered a batch of likes at a time.
+    """
+
+    liked = (shards.router
+             .session_for(user_id)
+             .query(Likes.message_id)
+             .filter(Likes.user_id == user_id)
+             .order_by(Likes.id)
+             .yield_per(STREAM_BATCH_SIZE))
+    ids = (row[0] for row in liked)
+
+    while True:
+        batch = list(islice(ids, STREAM_BATCH_SIZE))
+        if not batch:
+            return
+        yield from shards.router.active_messages(batch)
+
+@app.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications, newest first.
+
+    Seeing the first page marks them all read.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    read_id = g.user.notifications_read_id or 0
+    before = request.args.get('before', type=int)
+    groups = notifications.inbox(g.user.id, before=before)
+    if groups and before is None:
+        notifications.mark_read(g.user.id, groups[0].latest)
+
+    older = groups[-1].latest if len(groups) == notifications.PAGE_SIZE else None
+    return render_template('users/notifications.html', groups=groups,
+                           read_id=read_id, older=older)
+
+
+@app.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages mentioning this user, newest first."""
+
+    user = get_active_user_or_404(user_id)
+    before = request.args.get('before', type=int)
+    messages = tags.messages_for_term(f"@{user.username}", before=before)
+
+    return render_term_page(f"@{user.username}", messages)
+
 
 ##############################################################################
 # Messages routes:
@@ -277,24 +697,86 @@ def messages_add():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if request.method == 'POST' and not limiter.hit('post_user', g.user.id):
+        abort(429)
+
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        session = shards.router.session_for(g.user.id)
+        session.add(msg)
+        session.flush()
+        # The indexes and notifications are in the main database
+        tags.index_message(msg)
+        search.index_message(msg)
+        if not shards.router.enabled:
+            feeds.message_posted(msg)
+        notifications.mentioned([msg])
+        shards.router.commit()
+
+        profiles.invalidate(g.user.id)
+
+        hub.publish(g.user.id, msg.id)
+        trending.record_message(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/stream')
+def messages_stream():
+    """Stream ids of new messages from followed users as server-sent events."""
+
+    if not g.user:
+        abort(401)
+
+    following_ids = [f.id for f in g.user.following] + [g.user.id]
+    sub = hub.subscribe(following_ids)
+
+    # The stream can stay open for hours; don't hold a DB connection for it.
+    db.session.close()
+
+    return Response(event_stream(sub), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+@app.route('/messages/<int:message_id>/item')
+def messages_item(message_id):
+    """Render one message as a feed item, for live timeline updates."""
+
+    if not g.user:
+        abort(401)
+
+    msg = shards.router.get_message_or_404(message_id)
+    author = readmodels.UserCard.from_user(get_active_user_or_404(msg.user_id))
+
+    return render_template('messages/item.html',
+                           msg=feed_items([msg], known={author.id: author})[0])
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = shards.router.get_message(message_id)
+    if msg is not None:
+        like_counts = None
+    else:
+        # Old messages may have been moved to the archive
+        archived = partitions.get_archived(message_id)
+        if archived is None:
+            abort(404)
+        msg, like_counts = archived
+
+    user = get_active_user_or_404(msg.user_id)
+    follows = readmodels.followed_ids(g.user.id if g.user else None, [user.id])
+    author = readmodels.UserCard.from_user(user, user.id in follows)
+
+    return render_template('messages/show.html',
+                           message=feed_items([msg], like_counts,
+                                              {author.id: author})[0])
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -305,17 +787,179 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
+    msg = shards.router.get_message_or_404(message_id)
     if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    db.session.delete(msg)
-    db.session.commit()
+    tags.unindex_messages([msg.id])
+    search.unindex_messages([msg.id])
+    feeds.messages_removed([msg.id])
+    if shards.router.enabled:
+        # No foreign keys across shards to cascade the likes
+        shards.router.delete_likes([msg.id])
+    shards.router.session_for(msg.user_id).delete(msg)
+    shards.router.commit()
+    message_cache.invalidate(message_id)
+
+    profiles.invalidate(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Batch API
+
+
+def api_error(message, status):
+    return jsonify({'error': message}), status
+
+
+def api_user():
+    """User making an API request: logged in, or by HTTP Basic credentials.
+
+    Rate limited per username (or user) before any password is checked.
+    """
+
+    auth = request.authorization
+    if g.user:
+        key = g.user.username
+    elif auth and auth.username:
+        key = auth.username
+    else:
+        return None
+
+    if not limiter.hit('ingest_user', key.lower()):
+        abort(429)
+
+    if g.user:
+        return g.user
+    return User.authenticate(auth.username, auth.password or '') or None
+
+
+@app.route('/api/messages/batch', methods=["POST"])
+def messages_batch():
+    """Post a batch of messages for the authenticated user.
+
+    Takes JSON like {"messages": [{"text": "..."}, ...]} and returns a
+    result per item, in order: {"status": "created", "id": ..., "id_str":
+    "..."} or {"status": "invalid", "error": "..."}. Valid items are
+    created even if others in the batch are invalid. Ids are 64-bit, past
+    what a JSON double holds exactly, so JavaScript clients should read
+    `id_str`.
+    """
+
+    user = api_user()
+    if user is None:
+        resp = jsonify({'error': "authentication required"})
+        resp.status_code = 401
+        resp.headers['WWW-Authenticate'] = 'Basic realm="Warbler"'
+        return resp
+
+    # JSON only: a cross-site form can't send it without a CORS preflight
+    data = request.get_json(silent=True) if request.is_json else None
+    items = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return api_error('expected {"messages": [...]}', 400)
+
+    max_batch = app.config['INGEST_MAX_BATCH']
+    if len(items) > max_batch:
+        return api_error(f"at most {max_batch} messages per batch", 413)
+
+    results = []
+    texts = []
+    for item in items:
+        try:
+            texts.append(ingest.validate(item))
+            results.append({'status': 'created'})
+        except ValueError as e:
+            results.append({'status': 'invalid', 'error': str(e)})
+
+    messages = ingest.post_messages(user.id, texts)
+    shards.router.commit()
+
+    created = iter(messages)
+    for result in results:
+        if result['status'] == 'created':
+            id = next(created).id
+            result['id'] = id
+            result['id_str'] = str(id)
+
+    for msg in messages:
+        hub.publish(user.id, msg.id)
+        trending.record_message(msg)
+    profiles.invalidate(user.id)
+
+    metrics.incr('ingest.created', len(messages))
+    metrics.incr('ingest.invalid', len(items) - len(messages))
+
+    return jsonify({'created': len(messages), 'results': results})
+
+
+##############################################################################
+# Hashtags
+
+
+@app.route('/tags/<tag>')
+def show_tag(tag):
+    """Show messages with this hashtag, newest first."""
+
+    term = f"#{tag.lower()}"
+    before = request.args.get('before', type=int)
+    messages = tags.messages_for_term(term, before=before)
+
+    return render_term_page(term, messages)
+
+
+def render_term_page(term, messages):
+    """Render one page of a hashtag or mention timeline."""
+
+    older = messages[-1].id if len(messages) == tags.PAGE_SIZE else None
+
+    return render_template('messages/term.html', term=term,
+                           messages=feed_items(messages), older=older)
+
+
+##############################################################################
+# Search
+
+
+@app.route('/search')
+def search_messages():
+    """Page of messages matching the 'q' querystring param, best first."""
+
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    messages = search.search_messages(query, page=page)
+
+    more = len(messages) == search.PAGE_SIZE
+
+    return render_template('messages/search.html', query=query, page=page,
+                           messages=feed_items(messages), more=more)
+
+
+##############################################################################
+# Images
+
+
+@app.route('/images/<size>/<signature>')
+def proxied_image(size, signature):
+    """Cached thumbnail of the image at the 'url' querystring param."""
+
+    url = request.args.get('url', '')
+    if size not in images.SIZES or not images.check_signature(url, signature):
+        abort(404)
+
+    try:
+        data = images.proxy.thumbnail(url, size)
+    except images.ImageError:
+        return redirect('/static/images/default-pic.png')
+
+    resp = Response(data, mimetype='image/jpeg')
+    resp.headers['Cache-Control'] = 'public, max-age=86400'
+    return resp
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -329,15 +973,12 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = feeds.home_feed(g.user, app.config['FEED_ENGINE'])
 
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=feed_items(messages),
+                               summary=summary_for(g.user),
+                               trending_tags=trending.top_tags(),
+                               trending_messages=trending.top_messages())
 
     else:
         return render_template('home-anon.html')
@@ -350,12 +991,13 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(msg_id)
+    msg = shards.router.get_message_or_404(msg_id)
     if msg.user_id == g.user.id:
         return abort(403)
     
-    g.user.likes.append(msg)
-    db.session.commit()
+    if likes.set_like(g.user.id, msg.id, author_id=msg.user_id):
+        trending.record_like(msg.id)
+        profiles.invalidate(g.user.id)
     return redirect('/')
     
 @app.route('/messages/<int:msg_id>/remove_like', methods=["POST"])
@@ -366,15 +1008,98 @@ def remove_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(msg_id)
+    msg = shards.router.get_message_or_404(msg_id)
     if msg.user_id == g.user.id:
         return abort(403)
     
-    g.user.likes.remove(msg)
-    db.session.commit()
+    if likes.set_like(g.user.id, msg.id, liked=False):
+        trending.record_like(msg.id, -1)
+        profiles.invalidate(g.user.id)
     return redirect('/')
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('backfill-terms')
+def backfill_terms():
+    """Index hashtags and mentions in existing messages."""
+
+    jobs.enqueue('backfill_terms')
+    db.session.commit()
+
+
+@app.cli.command('backfill-feeds')
+def backfill_feeds():
+    """Fill home feeds from existing messages, for FEED_ENGINE=hybrid."""
+
+    jobs.enqueue('backfill_feeds')
+    db.session.commit()
+
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Add existing messages to the full-text search index."""
+
+    jobs.enqueue('reindex_messages')
+    db.session.commit()
+
+
+@app.cli.command('maintain-partitions')
+def maintain_partitions():
+    """Make upcoming message partitions and archive old months; run daily."""
+
+    jobs.enqueue('maintain_partitions')
+    db.session.commit()
+
+
+@app.cli.command('export-user')
+@click.argument('user_id', type=int)
+@click.argument('path')
+def export_user_command(user_id, path):
+    """Write a ZIP of USER_ID's data to PATH; re-run to resume."""
+
+    if User.query.get(user_id) is None:
+        raise click.ClickException(f"There's no user {user_id}")
+
+    counts = export.export_to_file(user_id, path)
+    click.echo(", ".join(f"{n} {section}" for section, n in counts.items()))
+
+
+@app.cli.command('rollup-notifications')
+def rollup_notifications():
+    """Merge each day's notifications and drop expired ones; run daily."""
+
+    jobs.enqueue('rollup_notifications')
+    db.session.commit()
+
+
+##############################################################################
+# Metrics
+
+
+@app.route('/metrics')
+def show_metrics():
+    """Report this process's counters as `name value` lines."""
+
+    lines = [f"{name} {value}" for name, value in sorted(metrics.snapshot().items())]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain")
+
+
+##############################################################################
+# Background worker
+
+
+@app.cli.command()
+@click.option('--burst', is_flag=True, help="Exit once the queue is empty.")
+@click.option('--poll-interval', default=1.0, help="Seconds between polls.")
+def worker(burst, poll_interval):
+    """Run queued background jobs."""
+
+    jobs.work(poll_interval=poll_interval, burst=burst)
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -384,7 +1109,14 @@ def remove_like(msg_id):
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Proxied images are the exception: they never change, so they keep
+    their own long-lived Cache-Control.
+    """
+
+    if request.endpoint == 'proxied_image':
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
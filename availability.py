@@ -0,0 +1,256 @@
+"""Username and email availability for Warbler.
+
+Signing up costs a bcrypt hash, so a taken username or email should be
+turned away before hashing rather than by the unique constraint at
+commit. `Availability` keeps a bloom filter of every username and email
+in memory. A value the filter has never seen is free with no query at
+all; one it has seen is confirmed with a single indexed lookup, since it
+may be a false positive (about AVAILABILITY_ERROR_RATE of free values) or
+a stale entry for a renamed or purged account.
+
+The filter is built from a column-only query the first time it's needed,
+in a background thread so no signup waits for it; until it's ready each
+check is a plain lookup. Before each check it reads only the users added since its last read, by
+id, so other processes' signups reach it within
+AVAILABILITY_SYNC_INTERVAL seconds. This process adds its own signups
+and profile edits straight away. A bloom filter can't forget, so values
+freed by renames and purges stay in it as stale entries, which cost one
+lookup each, until the filter is rebuilt. That happens every
+AVAILABILITY_REBUILD_INTERVAL seconds, or sooner once it holds more
+values than it was sized for. Rebuilds happen in the background too,
+and the old filter answers until the new one is swapped in. With
+JOBS_MODE "local", as in tests, builds run inline.
+
+The unique constraints still decide: a value taken by another process
+since the last sync is caught at commit, as before.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+from flask import current_app
+
+from models import db, User
+import metrics
+
+# Rows read per round trip while building
+BUILD_BATCH_SIZE = 10000
+
+FIELDS = ('username', 'email')
+
+
+class BloomFilter:
+    """Set membership with no false negatives, in `capacity` * ~10 bits."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(bits, 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Two halves of one digest, combined (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+
+class Availability:
+    """Which usernames and emails are free; set up with `init_app`."""
+
+    def __init__(self):
+        self.enabled = True
+        self.error_rate = 0.01
+        self.sync_interval = 5
+        self.rebuild_interval = 3600
+        self._filter = None
+        self._last_id = 0
+        self._synced_at = 0
+        self._built_at = 0
+        self._building = False
+        # Bumped by reset() so a build already running is thrown away
+        self._generation = 0
+        # Values added while a build runs, for the new filter
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.enabled = app.config['AVAILABILITY_ENABLED']
+        self.error_rate = app.config['AVAILABILITY_ERROR_RATE']
+        self.sync_interval = app.config['AVAILABILITY_SYNC_INTERVAL']
+        self.rebuild_interval = app.config['AVAILABILITY_REBUILD_INTERVAL']
+        self.reset()
+
+    def reset(self):
+        """Forget the filter; the next check builds a new one."""
+
+        with self._lock:
+            self._filter = None
+            self._building = False
+            self._pending = []
+            self._generation += 1
+
+    @staticmethod
+    def _key(field, value):
+        return f"{field}:{value}"
+
+    def _build(self, generation):
+        """Read every username and email into a new filter and swap it in."""
+
+        count = db.session.query(db.func.count(User.id)).scalar()
+        # Room to grow before the next rebuild
+        bloom = BloomFilter(max(count * 2, 1000) * len(FIELDS), self.error_rate)
+
+        last_id = 0
+        while True:
+            rows = (db.session
+                    .query(User.id, User.username, User.email)
+                    .filter(User.id > last_id)
+                    .order_by(User.id)
+                    .limit(BUILD_BATCH_SIZE)
+                    .all())
+            for id, username, email in rows:
+                bloom.add(self._key('username', username))
+                bloom.add(self._key('email', email))
+            if rows:
+                last_id = rows[-1][0]
+            if len(rows) < BUILD_BATCH_SIZE:
+                break
+
+        with self._lock:
+            if generation != self._generation:
+                # reset() since this build started; it's out of date
+                return
+            for key in self._pending:
+                bloom.add(key)
+            self._filter = bloom
+            # Users added since the read above come in with the next sync
+            self._last_id = last_id
+            self._built_at = self._synced_at = time.monotonic()
+        metrics.incr('availability.builds')
+
+    def _run_build(self, generation):
+        try:
+            self._build(generation)
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    self._building = False
+                    self._pending = []
+
+    def _start_build(self, generation):
+        """Build the filter: in a thread, or inline with JOBS_MODE "local"."""
+
+        if current_app.config['JOBS_MODE'] == 'local':
+            self._run_build(generation)
+            return
+
+        app = current_app._get_current_object()
+
+        def run():
+            with app.app_context():
+                self._run_build(generation)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _sync(self):
+        """Add users created since the last sync, if it's time to.
+
+        Called holding the lock. Returns the generation to build, when a
+        build is due and none is running, for the caller to start once
+        it has released the lock.
+        """
+
+        now = time.monotonic()
+        if (self._filter is None or
+                now - self._built_at >= self.rebuild_interval or
+                self._filter.count > self._filter.capacity):
+            if not self._building:
+                self._building = True
+                return self._generation
+
+        if (self._filter is None or
+                now - self._synced_at < self.sync_interval):
+            return None
+
+        rows = (db.session
+                .query(User.id, User.username, User.email)
+                .filter(User.id > self._last_id)
+                .order_by(User.id)
+                .all())
+        for id, username, email in rows:
+            self._filter.add(self._key('username', username))
+            self._filter.add(self._key('email', email))
+            self._last_id = id
+        self._synced_at = now
+        return None
+
+    def add(self, username, email):
+        """Record a new or changed user's username and email."""
+
+        keys = [self._key('username', username), self._key('email', email)]
+        with self._lock:
+            if self._filter is not None:
+                for key in keys:
+                    self._filter.add(key)
+            if self._building:
+                self._pending.extend(keys)
+
+    def is_taken(self, field, value):
+        """Is `value` the `field` ("username" or "email") of some user?"""
+
+        if not self.enabled:
+            return self._lookup(field, value)
+
+        with self._lock:
+            build = self._sync()
+        if build is not None:
+            self._start_build(build)
+
+        with self._lock:
+            if self._filter is None:
+                # Not built yet; ask the database
+                maybe = True
+            else:
+                maybe = self._key(field, value) in self._filter
+
+        if not maybe:
+            metrics.incr('availability.filtered')
+            return False
+
+        taken = self._lookup(field, value)
+        if not taken:
+            metrics.incr('availability.false_positive')
+        return taken
+
+    @staticmethod
+    def _lookup(field, value):
+        column = getattr(User, field)
+        return (db.session
+                .query(db.literal(True))
+                .filter(column == value)
+                .first()) is not None
+
+
+availability = Availability()
+
+
+@db.event.listens_for(db.metadata, 'after_drop')
+def reset_all(*args, **kw):
+    """Forget the filter; dropping the tables makes it wrong."""
+
+    availability.reset()
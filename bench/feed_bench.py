@@ -0,0 +1,96 @@
+"""Benchmark the home feed engines against each other.
+
+Fills a scratch database with users who each follow a random set of
+others, then times `feeds.query_feed` and `feeds.merge_feed` for a few
+readers. The query engine's cost grows with how much the followed users
+have posted in total; the merge engine's with how many of them there
+are, times the feed size. On SQLite the query engine reads the covering
+(user_id, timestamp) index into a bounded sorter in C and is hard to
+beat at these sizes; the merge engine's cost is mostly Python and round
+trips, but stays flat as message volume grows.
+
+Run from the repo root:
+
+    python bench/feed_bench.py --users 2000 --messages 1000000 --follows 300
+
+DATABASE_URL picks the database (a throwaway SQLite file by default);
+it is dropped and recreated, so never point it at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler-bench.db')
+# Run background jobs (feed fan-out, say) inline, as they happen
+os.environ.setdefault('JOBS_MODE', 'local')
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows  # noqa: E402
+import feeds  # noqa: E402
+
+
+def fill(num_users, num_messages, follows, batch_size=10000):
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test",
+         'password': "x"}
+        for i in range(1, num_users + 1)])
+
+    start = datetime(2020, 1, 1)
+    for first in range(1, num_messages + 1, batch_size):
+        db.session.bulk_insert_mappings(Message, [
+            {'id': i, 'user_id': random.randint(1, num_users), 'text': f"n{i}",
+             'timestamp': start + timedelta(seconds=i)}
+            for i in range(first, min(first + batch_size, num_messages + 1))])
+
+    users = range(1, num_users + 1)
+    db.session.bulk_insert_mappings(Follows, [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower in users
+        for followed in random.sample(users, min(follows, num_users))
+        if followed != follower])
+    db.session.commit()
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--follows', type=int, default=300)
+    parser.add_argument('--readers', type=int, default=5)
+    args = parser.parse_args()
+
+    with app.app_context():
+        started = time.perf_counter()
+        fill(args.users, args.messages, args.follows)
+        print(f"filled in {time.perf_counter() - started:.2f}s")
+
+        for user_id in random.sample(range(1, args.users + 1), args.readers):
+            user = User.query.get(user_id)
+            ids = [u.id for u in user.following] + [user.id]
+
+            query, expected = timed(lambda: feeds.query_feed(ids))
+            merge, found = timed(lambda: feeds.merge_feed(ids))
+            assert found == expected
+            print(f"user{user_id:<6} follows {len(ids) - 1:5}: "
+                  f"query {query * 1000:8.2f}ms  merge {merge * 1000:8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
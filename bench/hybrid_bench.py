@@ -0,0 +1,137 @@
+"""Benchmark the hybrid feed's celebrity threshold on a skewed follow graph.
+
+Fills a scratch database where who-follows-whom follows a Zipf-like
+distribution, so a handful of accounts have most of the followers. Then,
+for each threshold, posts a sample of messages (authors picked in
+proportion to their follower counts, as traffic tends to be) and reads a
+sample of home feeds, reporting feed rows written per post and read
+latency next to the "query" engine. A threshold above every follower
+count is pure push; a threshold of 0 is pure pull.
+
+Run from the repo root:
+
+    python bench/hybrid_bench.py --users 5000 --follows 100
+
+DATABASE_URL picks the database (a throwaway SQLite file by default);
+it is dropped and recreated, so never point it at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler-bench.db')
+# Run background jobs (feed fan-out, say) inline, as they happen
+os.environ.setdefault('JOBS_MODE', 'local')
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows, FeedEntry  # noqa: E402
+import feeds  # noqa: E402
+import metrics  # noqa: E402
+
+
+def fill(num_users, follows, messages_per_user, skew):
+    db.drop_all()
+    db.create_all()
+
+    users = list(range(1, num_users + 1))
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test",
+         'password': "x"}
+        for i in users])
+
+    weights = [1 / rank ** skew for rank in users]
+    rows = []
+    for follower in users:
+        followed = set(random.choices(users, weights, k=follows))
+        followed.discard(follower)
+        rows += [{'user_following_id': follower, 'user_being_followed_id': id}
+                 for id in followed]
+    db.session.bulk_insert_mappings(Follows, rows)
+
+    start = datetime(2020, 1, 1)
+    db.session.bulk_insert_mappings(Message, [
+        {'user_id': random.choice(users), 'text': "x",
+         'timestamp': start + timedelta(seconds=i)}
+        for i in range(num_users * messages_per_user)])
+    db.session.commit()
+    return weights
+
+
+def run(threshold, readers, authors):
+    app.config['FEED_CELEBRITY_THRESHOLD'] = threshold
+    feeds._follower_counts.clear()
+    FeedEntry.query.delete()
+    db.session.commit()
+
+    for user_id in readers:
+        feeds.backfill_feed(user_id)
+
+    metrics.reset()
+    started = time.perf_counter()
+    for author_id in authors:
+        msg = Message(text="new", user_id=author_id)
+        db.session.add(msg)
+        db.session.flush()
+        feeds.message_posted(msg)
+        db.session.commit()
+    write = (time.perf_counter() - started) / len(authors)
+    pushed = metrics.get('feeds.pushed') / len(authors)
+
+    # Follower counts are cached between requests, so warm them up first
+    for user_id in readers:
+        feeds.hybrid_feed(User.query.get(user_id))
+
+    hybrid = query = 0.0
+    for user_id in readers:
+        db.session.expunge_all()
+        started = time.perf_counter()
+        found = feeds.hybrid_feed(User.query.get(user_id))
+        hybrid += time.perf_counter() - started
+
+        db.session.expunge_all()
+        started = time.perf_counter()
+        expected = feeds.home_feed(User.query.get(user_id), 'query')
+        query += time.perf_counter() - started
+        assert [m.id for m in found] == [m.id for m in expected]
+
+    return write, pushed, hybrid / len(readers), query / len(readers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--follows', type=int, default=100)
+    parser.add_argument('--messages-per-user', type=int, default=20)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--readers', type=int, default=20)
+    args = parser.parse_args()
+
+    with app.app_context():
+        app.config['FEED_ENGINE'] = 'hybrid'
+
+        weights = fill(args.users, args.follows, args.messages_per_user,
+                       args.skew)
+        counts = feeds.follower_counts(range(1, args.users + 1))
+        top = sorted(counts.values(), reverse=True)
+        print(f"follower counts: max {top[0]}, p99 {top[len(top) // 100]}, "
+              f"median {top[len(top) // 2]}")
+
+        users = list(range(1, args.users + 1))
+        readers = random.sample(users, args.readers)
+        authors = random.choices(users, weights, k=args.posts)
+
+        for threshold in [top[0] + 1, top[len(top) // 100], 100, 10, 0]:
+            write, pushed, hybrid, query = run(threshold, readers, authors)
+            print(f"threshold {threshold:6}: {pushed:8.1f} rows/post "
+                  f"{write * 1000:7.2f}ms/post  read hybrid "
+                  f"{hybrid * 1000:6.2f}ms  query {query * 1000:6.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
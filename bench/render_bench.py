@@ -0,0 +1,209 @@
+"""Benchmark rendering from ORM instances against read models.
+
+Fills a scratch database, then builds and renders two pages both ways,
+each from an empty session as in a fresh request:
+
+- feed: a reader's 100 newest messages from the users they follow, with
+  author, like count and whether the reader likes each one
+- cards: a list of one user's followers, with a follow button for each
+
+The ORM way hands Message and User instances to the template, which then
+loads `msg.user` and `viewer.likes` / `viewer.following` as it renders.
+The read model way runs column-only queries up front (see readmodels.py)
+and renders FeedItems and UserCards. Reports the best time, the peak
+memory allocated (tracemalloc) and the number of queries.
+
+Run from the repo root:
+
+    python bench/render_bench.py --users 2000 --messages 200000 --likes 500
+
+DATABASE_URL picks the database (a throwaway SQLite file by default);
+it is dropped and recreated, so never point it at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler-bench.db')
+# Run background jobs (feed fan-out, say) inline, as they happen
+os.environ.setdefault('JOBS_MODE', 'local')
+
+from app import app  # noqa: E402
+from models import db, User, Message, Follows, Likes  # noqa: E402
+import likes  # noqa: E402
+import readmodels  # noqa: E402
+
+FEED_SIZE = 100
+
+ORM_FEED = """{% for msg in messages %}
+<a href="/users/{{ msg.user.id }}"><img src="{{ msg.user.image_url }}"></a>
+@{{ msg.user.username }} {{ msg.timestamp.strftime('%d %B %Y') }} {{ msg.text }}
+{% if viewer.likes_message(msg) %}liked{% endif %} {{ like_counts.get(msg.id, 0) }}
+{% endfor %}"""
+
+READ_MODEL_FEED = """{% for msg in messages %}
+<a href="/users/{{ msg.author.id }}"><img src="{{ msg.author.image_url }}"></a>
+@{{ msg.author.username }} {{ msg.timestamp.strftime('%d %B %Y') }} {{ msg.text }}
+{% if msg.liked %}liked{% endif %} {{ msg.likes }}
+{% endfor %}"""
+
+ORM_CARDS = """{% for user in users %}
+<img src="{{ user.header_image_url }}"><img src="{{ user.image_url }}">
+@{{ user.username }} {{ user.bio }}
+{% if viewer.is_following(user) %}Unfollow{% else %}Follow{% endif %}
+{% endfor %}"""
+
+READ_MODEL_CARDS = """{% for user in users %}
+<img src="{{ user.header_image_url }}"><img src="{{ user.image_url }}">
+@{{ user.username }} {{ user.bio }}
+{% if user.viewer_follows %}Unfollow{% else %}Follow{% endif %}
+{% endfor %}"""
+
+
+def fill(num_users, num_messages, follows, num_likes, batch_size=10000):
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test",
+         'password': "x", 'bio': f"bio of user {i}"}
+        for i in range(1, num_users + 1)])
+
+    start = datetime(2020, 1, 1)
+    for first in range(1, num_messages + 1, batch_size):
+        db.session.bulk_insert_mappings(Message, [
+            {'id': i, 'user_id': random.randint(1, num_users), 'text': f"n{i}",
+             'timestamp': start + timedelta(seconds=i)}
+            for i in range(first, min(first + batch_size, num_messages + 1))])
+
+    users = range(1, num_users + 1)
+    db.session.bulk_insert_mappings(Follows, [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower in users
+        for followed in random.sample(users, min(follows, num_users))
+        if followed != follower])
+
+    messages = range(1, num_messages + 1)
+    for user_id in users:
+        db.session.bulk_insert_mappings(Likes, [
+            {'user_id': user_id, 'message_id': message_id}
+            for message_id in random.sample(messages, min(num_likes,
+                                                          num_messages))])
+    db.session.commit()
+
+
+def orm_feed(viewer_id, ids):
+    viewer = User.query.get(viewer_id)
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(ids))
+                .order_by(Message.id.desc())
+                .limit(FEED_SIZE)
+                .all())
+    return app.jinja_env.from_string(ORM_FEED).render(
+        messages=messages, viewer=viewer,
+        like_counts=Message.like_counts(messages))
+
+
+def read_model_feed(viewer_id, ids):
+    rows = (db.session
+            .query(*readmodels.MESSAGE_COLUMNS)
+            .filter(Message.user_id.in_(ids))
+            .order_by(Message.id.desc())
+            .limit(FEED_SIZE)
+            .all())
+    items = readmodels.feed_items(
+        rows, Message.like_counts(rows),
+        likes.liked_ids(viewer_id, [row.id for row in rows]))
+    return app.jinja_env.from_string(READ_MODEL_FEED).render(messages=items)
+
+
+def orm_cards(viewer_id, user_id):
+    viewer = User.query.get(viewer_id)
+    users = (User
+             .active()
+             .join(Follows, Follows.user_following_id == User.id)
+             .filter(Follows.user_being_followed_id == user_id)
+             .all())
+    return app.jinja_env.from_string(ORM_CARDS).render(users=users,
+                                                       viewer=viewer)
+
+
+def read_model_cards(viewer_id, user_id):
+    users = readmodels.user_cards(
+        readmodels
+        .card_query()
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id),
+        viewer_id)
+    return app.jinja_env.from_string(READ_MODEL_CARDS).render(users=users)
+
+
+def measure(fn, repeat=5):
+    """(result, best seconds, peak bytes allocated, queries) of a fresh-session call."""
+
+    queries = []
+
+    def count(*args):
+        queries.append(1)
+
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.remove()
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+
+    db.session.remove()
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    tracemalloc.start()
+    assert fn() == result
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.event.remove(db.engine, 'before_cursor_execute', count)
+
+    return result, best, peak, len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--follows', type=int, default=300)
+    parser.add_argument('--likes', type=int, default=500)
+    parser.add_argument('--readers', type=int, default=3)
+    args = parser.parse_args()
+
+    with app.app_context():
+        started = time.perf_counter()
+        fill(args.users, args.messages, args.follows, args.likes)
+        print(f"filled in {time.perf_counter() - started:.2f}s")
+
+        for viewer_id in random.sample(range(1, args.users + 1), args.readers):
+            ids = [row[0] for row in (db.session
+                                      .query(Follows.user_being_followed_id)
+                                      .filter(Follows.user_following_id
+                                              == viewer_id))] + [viewer_id]
+            user_id = random.choice(ids)
+
+            pages = [('feed', orm_feed, read_model_feed, (viewer_id, ids)),
+                     ('cards', orm_cards, read_model_cards, (viewer_id, user_id))]
+            for name, orm, read_model, page_args in pages:
+                html, *before = measure(lambda: orm(*page_args))
+                same, *after = measure(lambda: read_model(*page_args))
+                assert same == html
+                print(f"user{viewer_id:<6} {name:5}  " + "  ".join(
+                    f"{label} {t * 1000:7.2f}ms {peak / 1024:6.0f}KiB "
+                    f"{queries:3} queries"
+                    for label, (t, peak, queries) in (('orm', before),
+                                                      ('read model', after))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Benchmark full-text search against a LIKE scan.
+
+Fills a scratch database with random messages, indexes them, then times
+the same queries through `search.search_messages` and through
+`Message.text LIKE '%word%'`. LIKE gets to stop at the first page of
+unranked hits, so it only loses badly on rare terms; the index has to
+rank every match, so very common words are its worst case.
+
+Run from the repo root:
+
+    python bench/search_bench.py --messages 1000000
+
+DATABASE_URL picks the database (a throwaway SQLite file by default);
+it is dropped and recreated, so never point it at real data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', 'sqlite:////tmp/warbler-bench.db')
+# Run background jobs (feed fan-out, say) inline, as they happen
+os.environ.setdefault('JOBS_MODE', 'local')
+
+from app import app  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import search  # noqa: E402
+
+WORDS = ("warble tweet bird song nest feather flock wing sky tree morning "
+         "coffee code python flask postgres index query cache queue").split()
+
+
+def fill(num_messages, num_users=1000, batch_size=10000):
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test",
+         'password': "x"}
+        for i in range(1, num_users + 1)])
+
+    for start in range(1, num_messages + 1, batch_size):
+        ids = range(start, min(start + batch_size, num_messages + 1))
+        rows = [{'id': i, 'user_id': random.randint(1, num_users),
+                 'text': " ".join(random.choices(WORDS, k=8)) + f" n{i}"}
+                for i in ids]
+        db.session.bulk_insert_mappings(Message, rows)
+
+        started = time.perf_counter()
+        search.index_messages(Message(id=r['id'], text=r['text']) for r in rows)
+        db.session.commit()
+        yield len(rows), time.perf_counter() - started
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        indexed = index_time = 0
+        for count, elapsed in fill(args.messages):
+            indexed += count
+            index_time += elapsed
+        print(f"indexed {indexed} messages in {index_time:.2f}s "
+              f"({indexed / index_time:.0f}/s)")
+
+        for query in ["coffee", "python flask", f"n{args.messages // 2}"]:
+            fts, found = timed(lambda: search.search_messages(query))
+            like, _ = timed(lambda: (Message
+                                     .query
+                                     .filter(*[Message.text.like(f"%{word}%")
+                                               for word in query.split()])
+                                     .limit(search.PAGE_SIZE)
+                                     .all()))
+            print(f"{query!r:>16}: fts {fts * 1000:8.2f}ms  "
+                  f"like {like * 1000:8.2f}ms  ({len(found)} results)")
+
+
+if __name__ == '__main__':
+    main()
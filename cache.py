@@ -0,0 +1,278 @@
+"""Caching for Warbler.
+
+`LocalCache` is a small in-process LRU with a TTL. `ModelCache` puts a
+cache-aside layer in front of primary-key lookups of a model: it stores
+a compact JSON projection of the row's columns, first in a `LocalCache`
+and optionally in a shared tier (`SQLiteCache`), and hands back an ORM
+instance merged into the session without a query. Relationships still
+lazy-load as usual.
+
+`SQLiteFile` is the base of the host-wide SQLite stores here and in
+ratelimit.py and session_store.py, all standing in for memcached or
+Redis.
+
+Keys carry a version number, so changing a projection's columns only
+needs a bump to stop old entries in the shared tier from being read.
+Routes that change a cached row call `invalidate`.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User, Message
+import metrics
+
+_MISSING = object()
+
+_caches = weakref.WeakSet()
+
+
+class LocalCache:
+    """Thread-safe LRU of up to `max_entries` items, each kept `ttl` seconds."""
+
+    def __init__(self, max_entries=10000, ttl=30, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is _MISSING:
+                return default
+
+            value, expires = item
+            if expires <= self.clock():
+                del self._items[key]
+                return default
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` for `ttl` seconds (the cache's `ttl` by default)."""
+
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, self.clock() +
+                                (self.ttl if ttl is None else ttl))
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def sqlite_path(url):
+    """The file in a "sqlite:///path/to/file.db" URL, or None for other URLs."""
+
+    prefix = 'sqlite:///'
+    return url[len(prefix):] if url.startswith(prefix) else None
+
+
+class SQLiteFile:
+    """Base for state in a SQLite file shared by every process on a host.
+
+    Subclasses pass the statements that create their table, whose
+    `expires` column holds a `time.time()`. Each thread gets its own
+    connection, in autocommit mode. Every PRUNE_INTERVAL seconds or so, a
+    write also deletes the rows that have expired, so keys seen only once
+    (an IP address in a credential stuffing run, say) don't pile up.
+    """
+
+    TABLE = None
+
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, path, schema):
+        self.path = path
+        self._local = threading.local()
+        self._pruned = time.time()
+
+        conn = self._connect()
+        for statement in schema:
+            conn.execute(statement)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _written(self, now):
+        """Call after a write at `now`; prunes expired rows when it's time."""
+
+        if now - self._pruned >= self.PRUNE_INTERVAL:
+            self._pruned = now
+            self._connect().execute(
+                f"DELETE FROM {self.TABLE} WHERE expires < ?", (now,))
+
+
+class SQLiteCache(SQLiteFile):
+    """String values in a SQLite file shared by every process on a host."""
+
+    TABLE = 'cache'
+
+    def __init__(self, path, ttl=300):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"])
+        self.ttl = ttl
+        _caches.add(self)
+
+    def get(self, key, default=None):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires >= ?",
+            (key, time.time())).fetchone()
+        return row[0] if row else default
+
+    def set(self, key, value):
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, now + self.ttl))
+        self._written(now)
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connect().execute("DELETE FROM cache")
+
+
+@db.event.listens_for(db.metadata, 'after_drop')
+def clear_all(*args, **kw):
+    """Empty every cache; dropping the tables makes all of them wrong."""
+
+    for cache in list(_caches):
+        cache.clear()
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _decode(column, value):
+    if value is not None and isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class ModelCache:
+    """Cache-aside primary-key lookups of `model`, projected to `columns`.
+
+    Columns left out (say, a password hash) are simply unloaded on the
+    returned instance and fetched from the database if touched.
+    """
+
+    def __init__(self, model, columns, version=1, ttl=60, max_entries=10000):
+        self.model = model
+        self.name = model.__tablename__
+        self.columns = [model.__table__.c[name] for name in columns]
+        self.version = version
+        self.local = LocalCache(max_entries=max_entries, ttl=ttl)
+        self.shared = None
+
+        metrics.gauge(f"cache.{self.name}.hit_ratio", self.hit_ratio)
+
+    def key(self, id):
+        return f"{self.name}:v{self.version}:{id}"
+
+    def hit_ratio(self):
+        hits = (metrics.get(f"cache.{self.name}.local_hit") +
+                metrics.get(f"cache.{self.name}.shared_hit"))
+        total = hits + metrics.get(f"cache.{self.name}.miss")
+        return round(hits / total, 4) if total else 0.0
+
+    def _load(self, id):
+        """Fetch the projection from the database; None if there's no row."""
+
+        row = (db.session
+               .query(*[getattr(self.model, c.key) for c in self.columns])
+               .filter(self.model.id == id)
+               .first())
+        if row is None:
+            return None
+        return json.dumps([_encode(value) for value in row],
+                          separators=(',', ':'))
+
+    def get(self, id):
+        """The instance with primary key `id`, or None."""
+
+        key = self.key(id)
+        data = self.local.get(key)
+
+        if data is None and self.shared is not None:
+            data = self.shared.get(key)
+            if data is not None:
+                self.local.set(key, data)
+                metrics.incr(f"cache.{self.name}.shared_hit")
+        elif data is not None:
+            metrics.incr(f"cache.{self.name}.local_hit")
+
+        if data is None:
+            metrics.incr(f"cache.{self.name}.miss")
+            data = self._load(id)
+            if data is None:
+                return None
+
+            self.local.set(key, data)
+            if self.shared is not None:
+                self.shared.set(key, data)
+
+        values = {c.key: _decode(c, v) for c, v in zip(self.columns, json.loads(data))}
+        obj = self.model(**values)
+        make_transient_to_detached(obj)
+        return db.session.merge(obj, load=False)
+
+    def get_or_404(self, id):
+        obj = self.get(id)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def invalidate(self, id):
+        """Forget `id` in both tiers; call after changing or deleting it."""
+
+        key = self.key(id)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+
+user_cache = ModelCache(User, ['id', 'email', 'username', 'image_url',
+                               'header_image_url', 'bio', 'location',
+                               'deleted_at'])
+message_cache = ModelCache(Message, ['id', 'text', 'timestamp', 'user_id'])
+
+
+def init_app(app):
+    """Attach the shared tier named by CACHE_SHARED, if any."""
+
+    url = app.config['CACHE_SHARED']
+    if not url:
+        return
+
+    if not url.startswith('sqlite:///'):
+        raise ValueError(f"Unknown shared cache {url!r}")
+
+    shared = SQLiteCache(url[len('sqlite:///'):])
+    user_cache.shared = shared
+    message_cache.shared = shared
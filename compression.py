@@ -0,0 +1,166 @@
+"""Response compression for Warbler.
+
+Text responses (HTML, JSON, CSS, JavaScript) are compressed with brotli
+or gzip, whichever the client accepts with the higher preference (brotli
+on a tie). Left alone are:
+
+- bodies under COMPRESS_MIN_SIZE bytes, where the saving doesn't pay for
+  the CPU
+- anything already encoded, other types (images are compressed already),
+  server-sent events (each event must go out as soon as it's written) and
+  files sent straight from disk
+- error and partial responses
+
+Streamed responses are compressed as they go, flushing after each chunk
+so the browser can still paint the top of the page early.
+
+For each endpoint, `/metrics` reports the counters compression.<endpoint>
+.responses, .bytes_in, .bytes_out and .cpu_us (CPU time spent
+compressing, in microseconds).
+"""
+
+import time
+import zlib
+
+import brotli
+from flask import request
+
+import metrics
+
+COMPRESSIBLE_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data):
+        return (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def chunk(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class Compressor:
+    """Compresses eligible responses; registered with `init_app`."""
+
+    def __init__(self):
+        self.min_size = 500
+        self.gzip_level = 6
+        self.brotli_quality = 4
+
+    def init_app(self, app):
+        self.min_size = app.config['COMPRESS_MIN_SIZE']
+        self.gzip_level = app.config['COMPRESS_LEVEL']
+        self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+        if app.config['COMPRESS_ENABLED']:
+            app.after_request(self.compress)
+
+    def encoder(self):
+        """An encoder for the best encoding the request accepts, or None."""
+
+        accepted = request.accept_encodings
+        br, gzip = accepted['br'], accepted['gzip']
+        if br and br >= gzip:
+            return BrotliEncoder(self.brotli_quality)
+        if gzip:
+            return GzipEncoder(self.gzip_level)
+        return None
+
+    def compress(self, response):
+        if (response.mimetype not in COMPRESSIBLE_TYPES or
+                response.direct_passthrough or
+                not 200 <= response.status_code < 300 or
+                response.status_code in (204, 206) or
+                'Content-Encoding' in response.headers or
+                request.method == 'HEAD'):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        if not response.is_streamed and len(response.get_data()) < self.min_size:
+            return response
+
+        encoder = self.encoder()
+        if encoder is None:
+            return response
+
+        response.headers['Content-Encoding'] = encoder.name
+        name = f"compression.{request.endpoint or 'unknown'}"
+
+        if response.is_streamed:
+            response.response = _stream(response.iter_encoded(),
+                                        response.response, encoder, name)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            started = time.thread_time()
+            compressed = encoder.chunk(data) + encoder.finish()
+            _record(name, len(data), len(compressed),
+                    time.thread_time() - started)
+            response.set_data(compressed)
+
+        return response
+
+
+def _stream(chunks, original, encoder, name):
+    """Compress `chunks` one by one, then record totals and close `original`."""
+
+    bytes_in = bytes_out = 0
+    cpu = 0.0
+
+    try:
+        for data in chunks:
+            started = time.thread_time()
+            compressed = encoder.chunk(data)
+            cpu += time.thread_time() - started
+            bytes_in += len(data)
+            bytes_out += len(compressed)
+            if compressed:
+                yield compressed
+
+        started = time.thread_time()
+        compressed = encoder.finish()
+        cpu += time.thread_time() - started
+        bytes_out += len(compressed)
+        yield compressed
+
+        _record(name, bytes_in, bytes_out, cpu)
+    finally:
+        if hasattr(original, 'close'):
+            original.close()
+
+
+def _record(name, bytes_in, bytes_out, cpu):
+    metrics.incr(f"{name}.responses")
+    metrics.incr(f"{name}.bytes_in", bytes_in)
+    metrics.incr(f"{name}.bytes_out", bytes_out)
+    metrics.incr(f"{name}.cpu_us", int(cpu * 1000000))
+
+
+compressor = Compressor()
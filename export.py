@@ -0,0 +1,274 @@
+"""Per-user data export for Warbler.
+
+An export is a ZIP of:
+
+- `profile.json`
+- `archived/`, `messages/`, `likes/`, `following/` and `followers/`: JSON
+  lines, one row per line, split into files of up to CHUNK_ROWS rows
+  named after their first row's key
+- `manifest.json`: row counts, written last, so its presence means the
+  archive is complete
+
+`archived/` holds the messages `partitions.maintain_partitions` has moved
+out of the database, read from just the archive blocks holding the user's
+messages; the rest come from the database. Archiving keeps only each message's like count, so `likes/`
+leaves out the user's likes of archived messages, and the manifest says
+so.
+
+Rows are read in key order in keyset batches of BATCH_SIZE, each an index
+range scan, and written into the ZIP as they arrive. Memory stays flat
+however many rows an account has, no transaction is held open for the
+whole export, and the time taken grows only with the rows exported.
+
+Exports resume from a point "<section>" (everything up to and including
+that section is done) or "<section>:<key>" (that section is done up to
+the row with that key). `GET /users/export?after=...` streams just the
+rest; take the point from the last complete file of an interrupted
+download. `flask export-user` keeps finished chunk files next to the
+output and picks up after them when re-run.
+"""
+
+import glob
+import json
+import os
+import shutil
+import zipfile
+from datetime import datetime
+from itertools import chain, islice
+
+from models import db, User, Message, Likes, Follows
+from shards import router
+import partitions
+
+BATCH_SIZE = 5000
+
+CHUNK_ROWS = 100000
+
+# Bytes to gather before handing a piece of the ZIP to the client
+FLUSH_BYTES = 64 * 1024
+
+
+def _archived(user_id, after, limit):
+    rows = partitions.archive.user_rows(user_id, after)
+    return [{'id': row['id'], 'text': row['text'],
+             'timestamp': row['timestamp'], 'likes': row['likes']}
+            for row in islice(rows, limit)]
+
+
+def _messages(user_id, after, limit):
+    query = (router.session_for(user_id)
+             .query(Message.id, Message.text, Message.timestamp)
+             .filter(Message.user_id == user_id))
+    if after is not None:
+        query = query.filter(Message.id > after)
+    return [{'id': id, 'text': text, 'timestamp': timestamp.isoformat()}
+            for id, text, timestamp in query.order_by(Message.id).limit(limit)]
+
+
+def _likes(user_id, after, limit):
+    query = (router.session_for(user_id)
+             .query(Likes.id, Likes.message_id)
+             .filter(Likes.user_id == user_id))
+    if after is not None:
+        query = query.filter(Likes.id > after)
+    return [{'id': id, 'message_id': message_id}
+            for id, message_id in query.order_by(Likes.id).limit(limit)]
+
+
+def _follows(user_column, other_column):
+    def rows(user_id, after, limit):
+        query = (db.session
+                 .query(other_column, User.username)
+                 .join(User, User.id == other_column)
+                 .filter(user_column == user_id))
+        if after is not None:
+            query = query.filter(other_column > after)
+        return [{'user_id': id, 'username': username}
+                for id, username in query.order_by(other_column).limit(limit)]
+    return rows
+
+
+# name -> (rows(user_id, after, limit), key field); in export order
+SECTIONS = {
+    'archived': (_archived, 'id'),
+    'messages': (_messages, 'id'),
+    'likes': (_likes, 'id'),
+    'following': (_follows(Follows.user_following_id,
+                           Follows.user_being_followed_id), 'user_id'),
+    'followers': (_follows(Follows.user_being_followed_id,
+                           Follows.user_following_id), 'user_id'),
+}
+
+PROFILE_COLUMNS = ['id', 'username', 'email', 'bio', 'location', 'image_url',
+                   'header_image_url']
+
+
+def parse_point(after):
+    """(index into ['profile', *SECTIONS], key) to start from.
+
+    Raises ValueError for a malformed point.
+    """
+
+    names = ['profile', *SECTIONS]
+    if not after:
+        return 0, None
+
+    section, colon, key = after.partition(':')
+    index = names.index(section)
+    if not colon:
+        return index + 1, None
+    if section == 'profile':
+        raise ValueError("The profile has no keys")
+    return index, int(key)
+
+
+def _rows(user_id, section, after):
+    """Every row of `section` with a key above `after`, in batches."""
+
+    fetch, key = SECTIONS[section]
+    while True:
+        batch = fetch(user_id, after, BATCH_SIZE)
+        yield from batch
+        if len(batch) < BATCH_SIZE:
+            return
+        after = batch[-1][key]
+
+
+def _lines(rows):
+    for row in rows:
+        yield json.dumps(row, separators=(',', ':')).encode() + b"\n"
+
+
+def files(user_id, after=None, counts=None):
+    """(name, iterator of byte strings) for each file of the export.
+
+    Rows are only read as each file's iterator is consumed, so consume them
+    in order. Rows written are added up by section in `counts`, if given.
+    """
+
+    start, key = parse_point(after)
+
+    if start == 0:
+        user = User.query.get(user_id)
+        profile = {name: getattr(user, name) for name in PROFILE_COLUMNS}
+        yield 'profile.json', [json.dumps(profile, indent=2).encode()]
+
+    for section in list(SECTIONS)[max(start - 1, 0):]:
+        rows = _rows(user_id, section, key)
+        key = None
+        key_field = SECTIONS[section][1]
+
+        for first in rows:
+            chunk = chain([first], islice(rows, CHUNK_ROWS - 1))
+            if counts is not None:
+                chunk = _counted(chunk, counts, section)
+            yield f"{section}/{first[key_field]:020d}.jsonl", _lines(chunk)
+
+
+def _counted(rows, counts, section):
+    for row in rows:
+        counts[section] = counts.get(section, 0) + 1
+        yield row
+
+
+def _manifest(user_id, after, counts):
+    return json.dumps({'user_id': user_id, 'after': after,
+                       'rows': counts,
+                       'excluded': ["likes of archived messages"],
+                       'exported_at': datetime.utcnow().isoformat()},
+                      indent=2).encode()
+
+
+class _Sink:
+    """Write-only file for ZipFile that hands back what's been written.
+
+    It can't seek, so ZipFile writes each file's sizes after its data.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+def stream_zip(user_id, after=None):
+    """Yield the export ZIP of `user_id` piece by piece."""
+
+    sink = _Sink()
+    counts = {}
+
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files(user_id, after, counts):
+            with archive.open(name, 'w') as f:
+                for piece in data:
+                    f.write(piece)
+                    if sink.size >= FLUSH_BYTES:
+                        yield sink.take()
+        archive.writestr('manifest.json', _manifest(user_id, after, counts))
+
+    yield sink.take()
+
+
+def _resume_point(parts):
+    """The point after the chunk files already in `parts`, or None."""
+
+    for section in reversed(list(SECTIONS)):
+        chunks = glob.glob(os.path.join(parts, section, '*.jsonl'))
+        if chunks:
+            with open(max(chunks), 'rb') as f:
+                for line in f:
+                    pass
+            last = json.loads(line)
+            return f"{section}:{last[SECTIONS[section][1]]}"
+
+    if os.path.exists(os.path.join(parts, 'profile.json')):
+        return 'profile'
+    return None
+
+
+def export_to_file(user_id, path):
+    """Write the export of `user_id` to the ZIP at `path`; returns row counts.
+
+    Finished files are kept in `<path>.parts` until the ZIP is written, so
+    an interrupted run picks up where it stopped when run again.
+    """
+
+    parts = f"{path}.parts"
+    after = _resume_point(parts)
+
+    for name, data in files(user_id, after):
+        part = os.path.join(parts, name)
+        os.makedirs(os.path.dirname(part), exist_ok=True)
+        with open(f"{part}.tmp", 'wb') as f:
+            f.writelines(data)
+        os.replace(f"{part}.tmp", part)
+
+    # Counted while copying, so rows from earlier runs are included
+    counts = {}
+    with zipfile.ZipFile(f"{path}.tmp", 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.write(os.path.join(parts, 'profile.json'), 'profile.json')
+        for section in SECTIONS:
+            for part in sorted(glob.glob(os.path.join(parts, section, '*.jsonl'))):
+                with open(part, 'rb') as src, \
+                        archive.open(os.path.relpath(part, parts), 'w') as dst:
+                    for line in src:
+                        dst.write(line)
+                        counts[section] = counts.get(section, 0) + 1
+        archive.writestr('manifest.json', _manifest(user_id, None, counts))
+
+    os.replace(f"{path}.tmp", path)
+    shutil.rmtree(parts)
+    return counts
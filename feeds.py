@@ -0,0 +1,438 @@
+"""Home feed engines for Warbler.
+
+The home page shows the newest messages from the people a user follows
+(and their own). Two engines build that list, picked per deployment with
+FEED_ENGINE:
+
+- "query": one `user_id IN (...) ORDER BY id DESC LIMIT n` query.
+  Simple, but the database sorts every message of every followed user.
+- "merge": take each followed user's newest `n` message ids straight off
+  the (user_id, id) index and merge those already-sorted lists,
+  so the work is bounded by followed users x n, however much they've
+  posted. Postgres does this in one LATERAL join; elsewhere the per-user
+  lists come back in a few UNION ALL queries and are merged with heapq,
+  reading deeper into a user's list only when it can reach the page.
+- "hybrid": messages are pushed into each follower's `feed_entries` when
+  posted, so reading a feed is one primary key range scan. Accounts with at
+  least FEED_CELEBRITY_THRESHOLD followers are the exception: pushing to
+  all of their followers would swamp writes, so their messages are pulled
+  at read time as in "merge" and merged with the pushed ones.
+
+Message ids are time-ordered (see snowflake.py), so every engine sorts
+and seeks on ids alone.
+
+With MESSAGE_SHARDS set, only "query" is available: it runs on each shard
+holding a followed user's messages and the results are merged (see
+shards.py).
+
+Switching an existing deployment to "hybrid" needs `flask backfill-feeds`
+to fill the feeds from what's already been posted.
+"""
+
+import heapq
+from itertools import islice
+
+from flask import current_app
+
+from cache import LocalCache
+from jobs import task, enqueue
+from models import db, User, Message, Follows, FeedEntry
+from shards import router
+import metrics
+import partitions
+
+FEED_SIZE = 100
+
+# Followed users per UNION ALL query in the heapq engine (SQLite allows
+# at most 500 terms in a compound SELECT)
+MERGE_CHUNK_SIZE = 200
+
+# Rows per followed user in the heapq engine's first pass
+MERGE_MIN_DEPTH = 5
+
+# Followers pushed to per run of the `fan_out` task
+FANOUT_BATCH_SIZE = 1000
+
+# user_id -> follower count
+_follower_counts = LocalCache(ttl=60)
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _by_ids(ids):
+    """Messages for `ids`, in the same order, skipping deleted accounts."""
+
+    if not ids:
+        return []
+
+    found = {msg.id: msg
+             for msg in (Message
+                         .query
+                         .join(User, User.id == Message.user_id)
+                         .filter(Message.id.in_(ids),
+                                 User.deleted_at.is_(None)))}
+    return [found[id] for id in ids if id in found]
+
+
+def _following_ids(user_id):
+    """Ids of the active users `user_id` follows, without loading them."""
+
+    return [row[0] for row in (db.session
+                               .query(Follows.user_being_followed_id)
+                               .join(User, User.id == Follows.user_being_followed_id)
+                               .filter(Follows.user_following_id == user_id,
+                                       User.deleted_at.is_(None)))]
+
+
+def query_feed(user_ids, limit=FEED_SIZE):
+    """Newest `limit` messages by `user_ids`, sorted by the database."""
+
+    if router.enabled:
+        return router.newest_messages(user_ids, limit)
+
+    return partitions.newest(Message
+                             .query
+                             .filter(Message.user_id.in_(user_ids))
+                             .order_by(Message.id.desc()),
+                             limit)
+
+
+def _lateral_ids(user_ids, limit):
+    sql = ("SELECT recent.id FROM unnest(:user_ids) AS followed (user_id) "
+           "CROSS JOIN LATERAL ("
+           "SELECT id FROM messages "
+           "WHERE messages.user_id = followed.user_id "
+           "ORDER BY id DESC LIMIT :limit) AS recent "
+           "ORDER BY recent.id DESC LIMIT :limit")
+    rows = db.session.execute(sql, {'user_ids': list(user_ids), 'limit': limit})
+    return [row[0] for row in rows]
+
+
+def _recent_per_user(user_ids, limit, since_id=None):
+    """{user_id: [message id, ...] newest first} for `user_ids`.
+
+    With `since_id`, messages older than that one are left out.
+    """
+
+    recent = {}
+    since_clause = "AND id >= :since_id " if since_id is not None else ""
+    for start in range(0, len(user_ids), MERGE_CHUNK_SIZE):
+        chunk = user_ids[start:start + MERGE_CHUNK_SIZE]
+        params = {'limit': limit, 'since_id': since_id}
+        selects = []
+        for i, user_id in enumerate(chunk):
+            params[f'u{i}'] = user_id
+            selects.append(
+                f"SELECT * FROM (SELECT user_id, id FROM messages "
+                f"WHERE user_id = :u{i} {since_clause}"
+                f"ORDER BY id DESC LIMIT :limit) AS u{i}")
+
+        for user_id, id in db.session.execute(
+                " UNION ALL ".join(selects), params):
+            recent.setdefault(user_id, []).append(id)
+
+    # Rows of one user come back in index order, but don't rely on it
+    for rows in recent.values():
+        rows.sort(reverse=True)
+    return recent
+
+
+def _heapq_ids(user_ids, limit):
+    """Merge per-user lists, fetching only as deep into each as needed.
+
+    The first pass takes a few rows per user, about twice their fair share
+    of the page. A user whose list was cut short can still contribute if
+    the oldest row fetched for them would make the page, so only those
+    users are fetched again at full depth.
+    """
+
+    user_ids = list(user_ids)
+    depth = min(limit, max(MERGE_MIN_DEPTH, 2 * limit // len(user_ids) + 1))
+    recent = _recent_per_user(user_ids, depth)
+
+    while True:
+        page = list(islice(heapq.merge(*recent.values(), reverse=True), limit))
+        cutoff = page[-1] if len(page) == limit else None
+
+        short = [user_id for user_id, rows in recent.items()
+                 if len(rows) == depth and (cutoff is None or rows[-1] > cutoff)]
+        if depth == limit or not short:
+            return page
+
+        depth = limit
+        recent.update(_recent_per_user(short, depth))
+
+
+def merge_feed(user_ids, limit=FEED_SIZE):
+    """Newest `limit` messages by `user_ids`, merged from per-user top lists."""
+
+    if not user_ids:
+        return []
+
+    if _dialect() == 'postgresql':
+        ids = _lateral_ids(user_ids, limit)
+    else:
+        ids = _heapq_ids(user_ids, limit)
+    return _by_ids(ids)
+
+
+##############################################################################
+# Hybrid push/pull feeds
+
+
+def follower_counts(user_ids):
+    """{user_id: number of followers} for `user_ids`, cached for a minute."""
+
+    counts = {}
+    missing = []
+    for user_id in user_ids:
+        count = _follower_counts.get(user_id)
+        if count is None:
+            missing.append(user_id)
+        else:
+            counts[user_id] = count
+
+    if missing:
+        fetched = dict(db.session
+                       .query(Follows.user_being_followed_id, db.func.count())
+                       .filter(Follows.user_being_followed_id.in_(missing))
+                       .group_by(Follows.user_being_followed_id))
+        for user_id in missing:
+            counts[user_id] = fetched.get(user_id, 0)
+            _follower_counts.set(user_id, counts[user_id])
+
+    return counts
+
+
+def is_celebrity(user_id):
+    """Whether `user_id`'s messages are pulled at read time, not pushed."""
+
+    threshold = current_app.config['FEED_CELEBRITY_THRESHOLD']
+    return follower_counts([user_id])[user_id] >= threshold
+
+
+def _hybrid():
+    return current_app.config['FEED_ENGINE'] == 'hybrid'
+
+
+def _push(rows):
+    """Insert feed entries, skipping any that are already there."""
+
+    if not rows:
+        return
+
+    if _dialect() == 'postgresql':
+        sql = ("INSERT INTO feed_entries "
+               "(user_id, message_id, author_id) "
+               "VALUES (:user_id, :message_id, :author_id) "
+               "ON CONFLICT DO NOTHING")
+    else:
+        sql = ("INSERT OR IGNORE INTO feed_entries "
+               "(user_id, message_id, author_id) "
+               "VALUES (:user_id, :message_id, :author_id)")
+
+    db.session.execute(sql, rows)
+    metrics.incr('feeds.pushed', len(rows))
+
+
+def _entries(messages, user_ids):
+    return [{'user_id': user_id, 'message_id': msg.id,
+             'author_id': msg.user_id}
+            for msg in messages for user_id in user_ids]
+
+
+def _recent_messages(author_id, limit=FEED_SIZE):
+    return (Message
+            .query
+            .filter(Message.user_id == author_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+            .all())
+
+
+@task
+def fan_out(author_id, message_ids=None, after_id=0,
+            batch_size=FANOUT_BATCH_SIZE):
+    """Push messages to a batch of the author's followers, then re-enqueue.
+
+    Without `message_ids`, pushes the author's recent messages instead (for
+    an author who has just dropped below the celebrity threshold).
+    """
+
+    if message_ids is None:
+        messages = _recent_messages(author_id)
+    else:
+        messages = Message.query.filter(Message.id.in_(message_ids)).all()
+    if not messages:
+        return
+
+    followers = [row[0] for row in (db.session
+                                    .query(Follows.user_following_id)
+                                    .filter(Follows.user_being_followed_id == author_id,
+                                            Follows.user_following_id > after_id)
+                                    .order_by(Follows.user_following_id)
+                                    .limit(batch_size))]
+    if not followers:
+        return
+
+    _push(_entries(messages, followers))
+
+    enqueue('fan_out', author_id=author_id, message_ids=message_ids,
+            after_id=followers[-1], batch_size=batch_size)
+    db.session.commit()
+
+
+@task
+def backfill_feed(user_id):
+    """Fill a user's feed from their own and followed non-celebrities' posts."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        return
+
+    for author in [user] + list(user.following):
+        if author is user or not is_celebrity(author.id):
+            _push(_entries(_recent_messages(author.id), [user_id]))
+    db.session.commit()
+
+
+@task
+def backfill_feeds(after_id=0, batch_size=100):
+    """Enqueue `backfill_feed` for a batch of users, then re-enqueue."""
+
+    user_ids = [row[0] for row in (db.session
+                                   .query(User.id)
+                                   .filter(User.id > after_id,
+                                           User.deleted_at.is_(None))
+                                   .order_by(User.id)
+                                   .limit(batch_size))]
+    if not user_ids:
+        return
+
+    for user_id in user_ids:
+        enqueue('backfill_feed', user_id=user_id)
+
+    enqueue('backfill_feeds', after_id=user_ids[-1], batch_size=batch_size)
+    db.session.commit()
+
+
+def messages_posted(messages):
+    """Push new (flushed) messages by one author to their and followers' feeds.
+
+    Only pushes to followers if the author isn't a celebrity. Call before
+    committing, so the feed entries and fan-out job commit with the messages.
+    """
+
+    if not _hybrid() or not messages:
+        return
+
+    author_id = messages[0].user_id
+    _push(_entries(messages, [author_id]))
+    if not is_celebrity(author_id):
+        enqueue('fan_out', author_id=author_id,
+                message_ids=[msg.id for msg in messages])
+
+
+def message_posted(msg):
+    """Push a single new message; see `messages_posted`."""
+
+    messages_posted([msg])
+
+
+def messages_removed(message_ids):
+    """Drop deleted messages from every feed."""
+
+    ids = list(message_ids)
+    if ids:
+        (FeedEntry
+         .query
+         .filter(FeedEntry.message_id.in_(ids))
+         .delete(synchronize_session=False))
+
+
+def followed(user_id, followed_id):
+    """Start `user_id`'s feed off with `followed_id`'s recent messages."""
+
+    _follower_counts.delete(followed_id)
+    if _hybrid() and not is_celebrity(followed_id):
+        _push(_entries(_recent_messages(followed_id), [user_id]))
+
+
+def unfollowed(user_id, followed_id):
+    """Drop `followed_id`'s messages from `user_id`'s feed."""
+
+    _follower_counts.delete(followed_id)
+    if not _hybrid():
+        return
+
+    (FeedEntry
+     .query
+     .filter(FeedEntry.user_id == user_id, FeedEntry.author_id == followed_id)
+     .delete(synchronize_session=False))
+
+    # Someone who just stopped being a celebrity had nothing pushed lately
+    threshold = current_app.config['FEED_CELEBRITY_THRESHOLD']
+    if follower_counts([followed_id])[followed_id] == threshold - 1:
+        enqueue('fan_out', author_id=followed_id)
+
+
+def _pushed(user_id, limit):
+    return [row[0] for row in (db.session
+                               .query(FeedEntry.message_id)
+                               .filter(FeedEntry.user_id == user_id)
+                               .order_by(FeedEntry.message_id.desc())
+                               .limit(limit))]
+
+
+def hybrid_feed(user, limit=FEED_SIZE):
+    """Newest `limit` messages for `user`: their pushed feed plus celebrities."""
+
+    threshold = current_app.config['FEED_CELEBRITY_THRESHOLD']
+    pulled = [user_id for user_id, count
+              in follower_counts(_following_ids(user.id)).items()
+              if count >= threshold]
+
+    # Pulled messages older than a full page of pushed ones can't make it
+    pushed = _pushed(user.id, limit)
+    since_id = pushed[-1] if len(pushed) == limit else None
+
+    streams = [pushed]
+    streams += _recent_per_user(pulled, limit, since_id).values()
+
+    # A message can be both pushed and pulled if its author crossed the
+    # threshold since it was posted; the copies come out side by side
+    ids = []
+    for id in heapq.merge(*streams, reverse=True):
+        if not ids or ids[-1] != id:
+            ids.append(id)
+            if len(ids) == limit:
+                break
+    return _by_ids(ids)
+
+
+def _own_and_following(user):
+    return _following_ids(user.id) + [user.id]
+
+
+ENGINES = {
+    'query': lambda user, limit: query_feed(_own_and_following(user), limit),
+    'merge': lambda user, limit: merge_feed(_own_and_following(user), limit),
+    'hybrid': hybrid_feed,
+}
+
+
+def engine_for(name):
+    """The feed function registered as `name`; it takes (user, limit)."""
+
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError(f"Unknown feed engine {name!r}")
+
+
+def home_feed(user, engine='query', limit=FEED_SIZE):
+    """Newest `limit` messages by `user` and everyone they follow."""
+
+    return engine_for(engine)(user, limit)
@@ -25,6 +25,8 @@ class UserEditForm(FlaskForm):
     image_url = StringField('(Optional) Image URL', validators=[Optional()])
     header_image_url = StringField('(Optional) Header Image URL', validators=[Optional()])
     bio = TextAreaField('(Optional) Bio', validators=[Optional()])
+    new_password = PasswordField('(Optional) New Password',
+                                 validators=[Optional(), Length(min=6)])
     password = PasswordField('Password', validators=[Length(min=6)])
 
 class LoginForm(FlaskForm):
@@ -0,0 +1,324 @@
+"""Image proxy and thumbnails for Warbler.
+
+Profile and header images are arbitrary external URLs. Rather than have
+every page load wait on (and download the full size from) a third-party
+host, templates point at `/images/<size>/<signature>?url=...`, which
+fetches the image once, cuts a thumbnail for every size in `SIZES`, and
+keeps them in a disk cache that evicts the least recently used files
+once it grows past IMAGE_CACHE_MAX_BYTES.
+
+URLs are signed with the app's secret key so the endpoint only proxies
+images our own pages link to, and hosts resolving to private or loopback
+addresses are refused unless IMAGE_PROXY_ALLOW_PRIVATE is set. Images
+over IMAGE_PROXY_MAX_PIXELS aren't decoded, and a URL that fails is
+remembered for IMAGE_PROXY_FAILURE_TTL seconds rather than fetched again
+on every request.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+from flask import current_app
+from PIL import Image, ImageOps
+
+from cache import LocalCache
+import metrics
+
+# name -> (width, height); twice the CSS size, for high-density screens
+SIZES = {
+    'timeline-image': (96, 96),
+    'card-image': (140, 140),
+    'profile-avatar': (400, 400),
+}
+
+JPEG_QUALITY = 85
+
+
+class ImageError(Exception):
+    """Raised when a URL can't be fetched or isn't a usable image."""
+
+
+class DiskCache:
+    """Files in `directory`, evicting the least recently used past `max_bytes`.
+
+    Recency is each file's modification time, bumped on every read, so
+    the cache survives restarts and can be shared by processes on a host.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if not name.endswith('.tmp'):
+                self._sizes[name] = os.path.getsize(os.path.join(directory, name))
+        self._total = sum(self._sizes.values())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Contents of `key`, or None."""
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            self._total += len(data) - self._sizes.get(key, 0)
+            self._sizes[key] = len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Delete the oldest files until the cache fits (lock held)."""
+
+        def mtime(name):
+            try:
+                return os.path.getmtime(self._path(name))
+            except FileNotFoundError:
+                return 0
+
+        for name in sorted(self._sizes, key=mtime):
+            if self._total <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+            self._total -= self._sizes.pop(name)
+            metrics.incr('images.evicted')
+
+
+def _check_host(url, allow_private):
+    """Raise ImageError unless `url` is http(s) on a public address."""
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f"Not an http(s) URL: {url!r}")
+
+    if allow_private:
+        return
+
+    try:
+        infos = socket.getaddrinfo(parts.hostname, None)
+    except socket.gaierror as e:
+        raise ImageError(f"Can't resolve {parts.hostname}: {e}")
+
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0])
+        if not address.is_global:
+            raise ImageError(f"{parts.hostname} is not a public address")
+
+
+class _CheckedRedirects(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to hosts `_check_host` accepts."""
+
+    def __init__(self, allow_private):
+        self.allow_private = allow_private
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        try:
+            _check_host(newurl, self.allow_private)
+        except ImageError as e:
+            raise urllib.error.HTTPError(newurl, code, str(e), headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _thumbnail(image, size):
+    """JPEG bytes of `image` cropped and scaled to fill `size`."""
+
+    image = ImageOps.fit(image, size, Image.LANCZOS)
+    if image.mode != 'RGB':
+        # Flatten any transparency onto white
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, 'white')
+        image.paste(rgba, mask=rgba)
+
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+class ImageProxy:
+    """Fetches external images and serves cached thumbnails of them."""
+
+    def __init__(self, app=None):
+        self.cache = None
+        self.timeout = 5
+        self.max_bytes = 5 * 1024 * 1024
+        self.max_pixels = 25 * 1000 * 1000
+        self.allow_private = False
+        # url -> error message of a recent failed fetch
+        self._failures = LocalCache(ttl=300)
+        # url -> [lock, number of requests holding or waiting for it]
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache = DiskCache(app.config['IMAGE_CACHE_DIR'],
+                               app.config['IMAGE_CACHE_MAX_BYTES'])
+        self.timeout = app.config['IMAGE_PROXY_TIMEOUT']
+        self.max_bytes = app.config['IMAGE_PROXY_MAX_BYTES']
+        self.max_pixels = app.config['IMAGE_PROXY_MAX_PIXELS']
+        self.allow_private = app.config['IMAGE_PROXY_ALLOW_PRIVATE']
+        self._failures = LocalCache(ttl=app.config['IMAGE_PROXY_FAILURE_TTL'])
+
+    def _key(self, url, size):
+        return f"{hashlib.sha256(url.encode()).hexdigest()}-{size}.jpg"
+
+    @contextmanager
+    def _url_lock(self, url):
+        """Hold `url`'s lock; it's dropped once nobody holds or waits for it."""
+
+        with self._locks_lock:
+            entry = self._locks.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[url]
+
+    def _fetch(self, url):
+        """The decoded image at `url`."""
+
+        _check_host(url, self.allow_private)
+        opener = urllib.request.build_opener(_CheckedRedirects(self.allow_private))
+        request = urllib.request.Request(url, headers={'User-Agent': 'Warbler'})
+
+        try:
+            with opener.open(request, timeout=self.timeout) as resp:
+                data = resp.read(self.max_bytes + 1)
+        except (urllib.error.URLError, OSError) as e:
+            raise ImageError(f"Can't fetch {url}: {e}")
+
+        if len(data) > self.max_bytes:
+            raise ImageError(f"{url} is over {self.max_bytes} bytes")
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            # Let JPEG decode at reduced size when that's all we need
+            image.draft('RGB', max(SIZES.values()))
+        except Exception as e:
+            raise ImageError(f"{url} is not an image: {e}")
+
+        # A small file can decode to a huge bitmap, so check before decoding
+        width, height = image.size
+        if width * height > self.max_pixels:
+            raise ImageError(f"{url} is over {self.max_pixels} pixels")
+
+        try:
+            image.load()
+        except Exception as e:
+            raise ImageError(f"{url} is not an image: {e}")
+        return image
+
+    def thumbnail(self, url, size):
+        """JPEG bytes of `url` at `size` (a key of SIZES).
+
+        On a miss, fetches `url` and caches every size at once, so each
+        image is fetched only once however many sizes pages ask for.
+        Raises ImageError if it can't be fetched or decoded, or failed to
+        be recently.
+        """
+
+        key = self._key(url, size)
+        data = self.cache.get(key)
+        if data is not None:
+            metrics.incr('images.hit')
+            return data
+
+        # One fetch per URL at a time; the rest wait for its result
+        with self._url_lock(url):
+            data = self.cache.get(key)
+            if data is not None:
+                metrics.incr('images.hit')
+                return data
+
+            failure = self._failures.get(url)
+            if failure is not None:
+                metrics.incr('images.failure_hit')
+                raise ImageError(failure)
+
+            metrics.incr('images.miss')
+            started = time.perf_counter()
+            try:
+                image = self._fetch(url)
+            except ImageError as e:
+                metrics.incr('images.fetch_error')
+                self._failures.set(url, str(e))
+                raise
+            metrics.incr('images.fetch_ms',
+                         int((time.perf_counter() - started) * 1000))
+
+            for name, dimensions in SIZES.items():
+                thumb = _thumbnail(image, dimensions)
+                self.cache.set(self._key(url, name), thumb)
+                if name == size:
+                    data = thumb
+        return data
+
+
+proxy = ImageProxy()
+
+
+def sign(url):
+    """Signature proving `url` came from one of our pages."""
+
+    key = current_app.config['SECRET_KEY'].encode()
+    return hmac.new(key, url.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def check_signature(url, signature):
+    return hmac.compare_digest(sign(url), signature)
+
+
+def thumbnail(url, size):
+    """Template filter: proxied `size` thumbnail of `url`.
+
+    Local paths (like the default avatar) and empty values are left alone.
+    """
+
+    if not url or not url.startswith(('http://', 'https://')):
+        return url
+    if size not in SIZES:
+        raise ValueError(f"Unknown image size {size!r}")
+
+    return (f"/images/{size}/{sign(url)}?"
+            f"{urllib.parse.urlencode({'url': url})}")
@@ -0,0 +1,64 @@
+"""Batch message ingestion for Warbler.
+
+Importers and bots post many messages at once through
+`POST /api/messages/batch`. Each item is validated on its own, the valid
+ones are inserted with a single multi-row INSERT, and the search, tag and
+feed indexes (and mention notifications) are updated with one bulk call
+each, rather than running the per-message path of the web form once per
+item. With MESSAGE_SHARDS set the rows go to the user's shard; the
+indexes stay in the main database.
+"""
+
+from models import Message
+import feeds
+import notifications
+import search
+from shards import router
+import snowflake
+import tags
+
+MAX_TEXT_LENGTH = Message.__table__.c.text.type.length
+
+
+def validate(item):
+    """The message text in `item`, or raise ValueError saying what's wrong."""
+
+    if not isinstance(item, dict):
+        raise ValueError("item must be an object")
+
+    text = item.get('text')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("text is required")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ValueError(f"text is over {MAX_TEXT_LENGTH} characters")
+    return text
+
+
+def post_messages(user_id, texts):
+    """Insert messages by `user_id` and index them; returns the Messages.
+
+    Ids are made up front, so all the rows go in one multi-row INSERT with
+    no need to read ids back. The returned Messages aren't in the session;
+    they carry just the inserted columns, for indexing and publishing.
+    Call before committing (`shards.router.commit()`).
+    """
+
+    if not texts:
+        return []
+
+    rows = []
+    for text in texts:
+        id = snowflake.next_id()
+        rows.append({'id': id, 'text': text, 'user_id': user_id,
+                     'timestamp': snowflake.timestamp(id)})
+
+    router.session_for(user_id).execute(
+        Message.__table__.insert().values(rows), mapper=Message.__mapper__)
+
+    messages = [Message(**row) for row in rows]
+    tags.index_messages(messages)
+    search.index_messages(messages)
+    if not router.enabled:
+        feeds.messages_posted(messages)
+    notifications.mentioned(messages)
+    return messages
@@ -0,0 +1,158 @@
+"""Background jobs for Warbler.
+
+Routes call `enqueue()` for slow side effects and return straight away.
+Jobs are rows in the `jobs` table; `flask worker` claims them one at a
+time, hiding each claimed job from other workers for a visibility timeout
+so a crashed worker's job gets picked up again later.
+
+With JOBS_MODE set to "local" (what the tests use) jobs run in-process
+as soon as they are enqueued and the table is never used.
+"""
+
+import json
+import logging
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from models import db, Job
+
+log = logging.getLogger(__name__)
+
+TASKS = {}
+
+_local = threading.local()
+
+
+def task(fn):
+    """Register `fn` as the handler for jobs named after it."""
+
+    TASKS[fn.__name__] = fn
+    return fn
+
+
+def enqueue(task_name, **payload):
+    """Schedule `task_name` to run with `payload` as keyword arguments.
+
+    In local mode the task runs right away and None is returned; a task
+    enqueued from inside another local task runs after it finishes rather
+    than recursively. Otherwise the new Job is added to the session and the
+    caller commits it along with the rest of its work.
+    """
+
+    if task_name not in TASKS:
+        raise KeyError(f"No task registered as {task_name!r}")
+
+    if current_app.config['JOBS_MODE'] == 'local':
+        _run_local(task_name, payload)
+        return None
+
+    job = Job(name=task_name, payload=json.dumps(payload))
+    db.session.add(job)
+    return job
+
+
+def _run_local(task_name, payload):
+    """Run a task in-process, draining any tasks it enqueues in turn."""
+
+    pending = getattr(_local, 'pending', None)
+    if pending is not None:
+        pending.append((task_name, payload))
+        return
+
+    _local.pending = pending = deque([(task_name, payload)])
+    try:
+        while pending:
+            name, kwargs = pending.popleft()
+            TASKS[name](**kwargs)
+    finally:
+        _local.pending = None
+
+
+def claim_next():
+    """Claim the next runnable job, or return None if there isn't one.
+
+    The claim is committed before returning so other workers skip the job
+    until its visibility timeout runs out.
+    """
+
+    now = datetime.utcnow()
+    timeout = current_app.config['JOBS_VISIBILITY_TIMEOUT']
+
+    job = (Job
+           .query
+           .filter(Job.status == 'queued',
+                   Job.run_at <= now,
+                   db.or_(Job.locked_until.is_(None),
+                          Job.locked_until < now))
+           .order_by(Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.attempts += 1
+    job.locked_until = now + timedelta(seconds=timeout)
+    db.session.commit()
+    return job
+
+
+def run(job):
+    """Run a claimed job; delete it on success, reschedule it on failure.
+
+    Failed jobs are retried with exponential backoff until they have been
+    tried JOBS_MAX_ATTEMPTS times, after which they are marked "failed" and
+    left in the table for inspection.
+    """
+
+    try:
+        TASKS[job.name](**json.loads(job.payload))
+    except Exception:
+        db.session.rollback()
+        job.last_error = traceback.format_exc()
+        job.locked_until = None
+
+        if job.attempts >= current_app.config['JOBS_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            log.error("Job %s failed for good:\n%s", job, job.last_error)
+        else:
+            backoff = 2 ** job.attempts
+            job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+            log.warning("Job %s failed, retrying in %ss", job, backoff)
+
+        db.session.commit()
+        return False
+
+    db.session.delete(job)
+    db.session.commit()
+    return True
+
+
+def work_once():
+    """Claim and run a single job. Returns False if the queue was empty."""
+
+    job = claim_next()
+    if job is None:
+        return False
+
+    run(job)
+    return True
+
+
+def work(poll_interval=1.0, burst=False):
+    """Process jobs forever, sleeping `poll_interval` when the queue is empty.
+
+    With `burst`, return as soon as the queue has been drained instead.
+    """
+
+    while True:
+        if not work_once():
+            if burst:
+                return
+            time.sleep(poll_interval)
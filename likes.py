@@ -0,0 +1,438 @@
+"""Liking and unliking messages, optionally write-behind.
+
+With LIKES_WRITE_BEHIND off (the default) each click commits its `likes`
+row straight away. With it on, a click only records an intent in an
+in-process buffer, keyed by (user, message) so that repeated clicks
+collapse into the last one, and a background thread writes the buffer
+every LIKES_FLUSH_INTERVAL seconds: one batched delete for the unlikes and
+one batched insert-if-missing for the likes (and their notifications, see
+notifications.py), in a single transaction. Hot messages then cost a few
+large commits instead of one per click.
+
+The buffer holds up to LIKES_BUFFER_SIZE intents; a click that would go
+over flushes it first, in the request.
+
+LIKES_DURABILITY decides what a crash can lose:
+
+- "none": the intents not flushed yet (up to an interval's worth)
+- "journal": nothing if only the process dies. Each intent is appended to
+  a journal in LIKES_JOURNAL_DIR before the click returns, and journals
+  left by dead processes are replayed at startup.
+- "fsync": nothing, at the price of a disk flush per click
+
+`like_counts` and `liked_ids` overlay this process's unwritten
+intents on what's in the database, so people see their own clicks at
+once; other processes see them after the next flush.
+
+Write-behind isn't available with MESSAGE_SHARDS set.
+"""
+
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Likes
+from shards import router
+import metrics
+import notifications
+import profiles
+
+log = logging.getLogger(__name__)
+
+# Skips messages deleted since the click, and likes that already exist
+INSERT_SQL = ("INSERT INTO likes (user_id, message_id) "
+              "SELECT :user_id, :message_id "
+              "WHERE EXISTS (SELECT 1 FROM messages WHERE id = :message_id) "
+              "AND NOT EXISTS (SELECT 1 FROM likes "
+              "WHERE user_id = :user_id AND message_id = :message_id)")
+
+DELETE_SQL = ("DELETE FROM likes "
+              "WHERE user_id = :user_id AND message_id = :message_id")
+
+
+class Journal:
+    """Append-only log of one process's intents, for replay after a crash.
+
+    The process holds an exclusive lock on `<pid>.lock` while it runs, so
+    journals whose lock is free were left by a process that's gone. Each
+    flush starts a new segment (`<pid>.<n>.log`); segments are deleted once
+    everything in them is in the database.
+    """
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self._lock_file = None
+        self._file = None
+        self._segment = 0
+        self._closed = []
+
+    def _path(self, pid, segment):
+        return os.path.join(self.directory, f"{pid}.{segment}.log")
+
+    def _segments(self, pid):
+        """Paths of `pid`'s segments, oldest first."""
+
+        paths = glob.glob(os.path.join(self.directory, f"{pid}.*.log"))
+        return sorted(paths, key=lambda path: int(path.split('.')[-2]))
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        pid = os.getpid()
+        self._lock_file = open(os.path.join(self.directory, f"{pid}.lock"), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # After any segments left under this pid, which `recover` replays
+        existing = self._segments(pid)
+        self._segment = int(existing[-1].split('.')[-2]) + 1 if existing else 0
+        self._closed = []
+        self._file = open(self._path(pid, self._segment), 'a')
+
+    def close(self):
+        """Close the files (leaving them for recovery) without deleting them."""
+
+        for f in (self._file, self._lock_file):
+            if f is not None:
+                f.close()
+        self._file = self._lock_file = None
+
+    def append(self, user_id, message_id, liked):
+        self._file.write(f"{user_id} {message_id} {int(liked)}\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Start a new segment; returns the paths of all closed segments."""
+
+        self._file.close()
+        self._closed.append(self._file.name)
+        self._segment += 1
+        self._file = open(self._path(os.getpid(), self._segment), 'a')
+        return list(self._closed)
+
+    def delete(self, paths):
+        for path in paths:
+            os.remove(path)
+            self._closed.remove(path)
+
+    def recover(self):
+        """(intents, paths) from dead processes' journals, oldest first.
+
+        Remove the paths with `discard` once the intents are safe elsewhere.
+        """
+
+        if not os.path.isdir(self.directory):
+            return [], []
+
+        intents = []
+        paths = []
+        for lock_path in glob.glob(os.path.join(self.directory, '*.lock')):
+            pid = os.path.basename(lock_path)[:-len('.lock')]
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # still running
+
+                segments = self._segments(pid)
+                for path in segments:
+                    with open(path) as f:
+                        for line in f:
+                            # A line cut short by the crash is ignored
+                            parts = line.split()
+                            if len(parts) == 3 and line.endswith('\n'):
+                                intents.append((int(parts[0]), int(parts[1]),
+                                                parts[2] == '1'))
+                paths.extend(segments)
+                if pid != str(os.getpid()):
+                    paths.append(lock_path)
+
+        return intents, paths
+
+    def discard(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # another process recovered it too
+
+
+class LikeBuffer:
+    """Pending like/unlike intents, written to the database in batches."""
+
+    def __init__(self):
+        self.enabled = False
+        self.interval = 0.25
+        self.max_pending = 10000
+        self.journal = None
+        self._engine = None
+        self._pending = {}   # (user_id, message_id) -> liked
+        self._flushing = {}  # the batch being written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.enabled = app.config['LIKES_WRITE_BEHIND']
+        if not self.enabled:
+            return
+
+        if app.config.get('MESSAGE_SHARDS'):
+            raise ValueError("LIKES_WRITE_BEHIND needs MESSAGE_SHARDS unset")
+
+        durability = app.config['LIKES_DURABILITY']
+        if durability not in ('none', 'journal', 'fsync'):
+            raise ValueError(f"Unknown LIKES_DURABILITY {durability!r}")
+
+        self.interval = app.config['LIKES_FLUSH_INTERVAL']
+        self.max_pending = app.config['LIKES_BUFFER_SIZE']
+        self._engine = db.get_engine(app)
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if durability != 'none':
+            journal = Journal(app.config['LIKES_JOURNAL_DIR'],
+                              fsync=durability == 'fsync')
+            recovered, paths = journal.recover()
+            journal.open()
+            self.journal = journal
+            # Into this process's journal before the old ones go
+            for intent in recovered:
+                self.record(*intent)
+            journal.discard(paths)
+            metrics.incr('likes.recovered', len(recovered))
+
+    def record(self, user_id, message_id, liked):
+        """Buffer an intent, flushing first if the buffer is full."""
+
+        key = (user_id, message_id)
+        while True:
+            with self._lock:
+                if key in self._pending or len(self._pending) < self.max_pending:
+                    if self.journal is not None:
+                        self.journal.append(user_id, message_id, liked)
+                    self._pending[key] = liked
+                    break
+
+            metrics.incr('likes.buffer_full')
+            self.flush()
+
+        metrics.incr('likes.buffered')
+        self._start()
+
+    def intent(self, user_id, message_id):
+        """The unwritten intent for this pair (True/False), or None."""
+
+        key = (user_id, message_id)
+        with self._lock:
+            return self._pending.get(key, self._flushing.get(key))
+
+    def pending(self):
+        """Copy of all unwritten intents, {(user_id, message_id): liked}."""
+
+        with self._lock:
+            intents = dict(self._flushing)
+            intents.update(self._pending)
+        return intents
+
+    def flush(self):
+        """Write the pending intents in one transaction; returns how many.
+
+        If the write fails the intents go back in the buffer (under any
+        newer ones) and their journal segments are kept.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+                segments = self.journal.rotate() if self.journal else []
+
+            try:
+                self._write(batch)
+            except Exception:
+                with self._lock:
+                    batch.update(self._pending)
+                    self._pending = batch
+                    self._flushing = {}
+                metrics.incr('likes.flush_error')
+                raise
+
+            with self._lock:
+                self._flushing = {}
+            if self.journal is not None:
+                self.journal.delete(segments)
+
+        for user_id in {user_id for user_id, message_id in batch}:
+            profiles.invalidate(user_id)
+        metrics.incr('likes.flushes')
+        metrics.incr('likes.flushed', len(batch))
+        return len(batch)
+
+    def _write(self, batch):
+        # Sorted, so concurrent flushes from other processes lock rows in
+        # the same order
+        rows = sorted(batch.items())
+        likes = [{'user_id': u, 'message_id': m} for (u, m), liked in rows if liked]
+        unlikes = [{'user_id': u, 'message_id': m} for (u, m), liked in rows if not liked]
+
+        with self._engine.begin() as connection:
+            if unlikes:
+                connection.execute(db.text(DELETE_SQL), unlikes)
+            if likes:
+                connection.execute(db.text(notifications.LIKE_SQL),
+                                   [dict(like, **notifications.event_values())
+                                    for like in likes])
+                connection.execute(db.text(INSERT_SQL), likes)
+
+    def _start(self):
+        """Start the flusher thread, if it isn't running (say, after a fork)."""
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='likes-flusher',
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Writing buffered likes failed; will retry")
+
+    def _after_fork(self):
+        # The parent writes its own intents; the child needs its own journal
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._thread = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = Journal(self.journal.directory, self.journal.fsync)
+            self.journal.open()
+
+
+buffer = LikeBuffer()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=buffer._after_fork)
+
+
+@atexit.register
+def _flush_at_exit():
+    if buffer.enabled:
+        buffer.flush()
+
+
+def init_app(app):
+    buffer.init_app(app)
+
+
+def set_like(user_id, message_id, liked=True, author_id=None):
+    """Record `user_id` liking (or, with liked=False, unliking) a message.
+
+    A like notifies the message's author, `author_id`. Returns whether
+    that changed anything: liking a message twice, or unliking one that
+    isn't liked, does nothing.
+    """
+
+    # Likes are kept with the liker's other rows
+    session = router.session_for(user_id)
+    existing = (session
+                .query(Likes)
+                .filter(Likes.user_id == user_id, Likes.message_id == message_id))
+
+    if buffer.enabled:
+        current = buffer.intent(user_id, message_id)
+        if current is None:
+            current = existing.first() is not None
+        if current == liked:
+            return False
+        buffer.record(user_id, message_id, liked)
+        return True
+
+    if not liked:
+        changed = existing.delete() > 0
+        session.commit()
+        return changed
+
+    if existing.first() is not None:
+        return False
+
+    session.add(Likes(user_id=user_id, message_id=message_id))
+    notifications.notify(author_id, 'like', user_id, message_id)
+    try:
+        session.commit()
+    except IntegrityError:
+        # Liked by a concurrent request since the check
+        session.rollback()
+        db.session.rollback()
+        return False
+    if router.enabled:
+        # Notifications are in the main database
+        db.session.commit()
+    return True
+
+
+def like_counts(messages):
+    """Map message id -> likes (see Message.like_counts), with unwritten clicks."""
+
+    counts = router.like_counts(messages)
+    if not buffer.enabled:
+        return counts
+
+    ids = {msg.id for msg in messages}
+    intents = {key: liked for key, liked in buffer.pending().items()
+               if key[1] in ids}
+    if not intents:
+        return counts
+
+    # Whether each clicked pair is in the database already decides whether
+    # the click changes the count
+    written = {(user_id, message_id) for user_id, message_id in
+               db.session
+               .query(Likes.user_id, Likes.message_id)
+               .filter(Likes.message_id.in_({m for u, m in intents}),
+                       Likes.user_id.in_({u for u, m in intents}))}
+
+    for key, liked in intents.items():
+        change = int(liked) - int(key in written)
+        if change:
+            counts[key[1]] = counts.get(key[1], 0) + change
+    return counts
+
+
+def liked_ids(user_id, message_ids):
+    """Which of `message_ids` `user_id` likes, counting unwritten clicks."""
+
+    ids = set(message_ids)
+    if not ids:
+        return set()
+
+    liked = {row[0] for row in (router
+                                .session_for(user_id)
+                                .query(Likes.message_id)
+                                .filter(Likes.user_id == user_id,
+                                        Likes.message_id.in_(ids)))}
+
+    if buffer.enabled:
+        for message_id in ids:
+            intent = buffer.intent(user_id, message_id)
+            if intent is True:
+                liked.add(message_id)
+            elif intent is False:
+                liked.discard(message_id)
+    return liked
@@ -0,0 +1,112 @@
+"""Live timeline updates for Warbler.
+
+New message ids are published on a hub under their author's id; each
+`/messages/stream` connection subscribes to the authors its viewer
+follows and relays ids to the browser as server-sent events. The browser
+then fetches just those messages instead of reloading the whole feed.
+
+`MemoryHub` only reaches subscribers in the same process. A shared
+backend (Redis pub/sub, Postgres LISTEN/NOTIFY) only has to provide the
+same `subscribe`/`publish` pair and `Subscription` behaviour.
+"""
+
+import queue
+import threading
+from collections import defaultdict
+
+import metrics
+
+
+class Subscription:
+    """One listener's bounded inbox on a hub.
+
+    If a slow client lets the inbox fill up, the oldest ids are dropped;
+    the browser can always fall back to reloading.
+    """
+
+    def __init__(self, hub, topics, maxsize=100):
+        self.hub = hub
+        self.topics = set(topics)
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, item):
+        while True:
+            try:
+                self._queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    metrics.incr("live.dropped")
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """Next published item, or None if `timeout` passes first."""
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class MemoryHub:
+    """In-process pub/sub keyed by topic."""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        sub = Subscription(self, topics)
+
+        with self._lock:
+            for topic in sub.topics:
+                self._subscribers[topic].add(sub)
+
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._subscribers.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subscribers[topic]
+
+    def publish(self, topic, item):
+        """Send `item` to everyone subscribed to `topic`."""
+
+        with self._lock:
+            subs = list(self._subscribers.get(topic, ()))
+
+        for sub in subs:
+            sub.put(item)
+
+        metrics.incr("live.published")
+
+
+hub = MemoryHub()
+
+
+def event_stream(sub, keepalive=15):
+    """Yield SSE frames for `sub` forever, closing it when the client leaves.
+
+    A comment line goes out every `keepalive` seconds of silence so proxies
+    don't time the connection out.
+    """
+
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            item = sub.get(timeout=keepalive)
+            if item is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"data: {item}\n\n"
+    finally:
+        sub.close()
@@ -0,0 +1,52 @@
+"""In-process counters for Warbler.
+
+Counters live in the worker process that bumps them; `/metrics` reports
+the current process's values in a plain `name value` text format.
+"""
+
+import threading
+from collections import Counter
+
+_counters = Counter()
+_gauges = {}
+_lock = threading.Lock()
+
+
+def incr(name, amount=1):
+    """Add `amount` to counter `name`."""
+
+    with _lock:
+        _counters[name] += amount
+
+
+def get(name):
+    """Current value of counter `name` (0 if never bumped)."""
+
+    with _lock:
+        return _counters[name]
+
+
+def gauge(name, fn):
+    """Report `fn()` as `name` whenever metrics are read."""
+
+    with _lock:
+        _gauges[name] = fn
+
+
+def snapshot():
+    """Copy of all counters, plus current gauge values, as a plain dict."""
+
+    with _lock:
+        values = dict(_counters)
+        gauges = list(_gauges.items())
+
+    for name, fn in gauges:
+        values[name] = fn()
+    return values
+
+
+def reset():
+    """Zero every counter (for tests)."""
+
+    with _lock:
+        _counters.clear()
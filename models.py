@@ -5,14 +5,26 @@ from datetime import datetime
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
+import snowflake
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Message ids are 64-bit (see snowflake.py). On SQLite the primary key
+# must be declared INTEGER to be the table's rowid, which is 64-bit anyway.
+MessageId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # For "who does this user follow" lookups, in order; the primary
+        # key already covers lookups by the followed user
+        db.Index('follows_user_following_id', 'user_following_id',
+                 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -31,6 +43,11 @@ class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
+    __table_args__ = (
+        # Each user's likes in order, for exports
+        db.Index('likes_user_id_id', 'user_id', 'id'),
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -43,7 +60,7 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        MessageId,
         db.ForeignKey('messages.id', ondelete='cascade'),
     )
 
@@ -94,20 +111,33 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Set when the account is deleted; the rows are purged later by a
+    # background task and until then the user is hidden everywhere.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Newest notification the user has seen (see notifications.py)
+    notifications_read_id = db.Column(
+        MessageId,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=db.and_(Follows.user_following_id == id,
+                              deleted_at.is_(None))
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=db.and_(Follows.user_being_followed_id == id,
+                              deleted_at.is_(None))
     )
 
     likes = db.relationship(
@@ -135,6 +165,12 @@ class User(db.Model):
         is_post_liked = [post for post in self.likes if post.id == msg.id]
         return len(is_post_liked) == 1
 
+    @classmethod
+    def active(cls):
+        """Query for users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -165,7 +201,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -179,10 +215,19 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        # Each user's messages newest first, for per-user feed lookups
+        db.Index('messages_user_id_id', 'user_id', 'id'),
+        # A partition per month on Postgres (see partitions.py)
+        {'postgresql_partition_by': 'RANGE (id)'},
+    )
 
+    # Time-ordered, so sorting and paging by id is sorting by time
     id = db.Column(
-        db.Integer,
+        MessageId,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -193,7 +238,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -204,6 +249,203 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    @classmethod
+    def like_counts(cls, messages, session=None):
+        """Map message id -> number of likes for each of `messages`.
+
+        Counts come from one grouped query over `likes`, so a whole page of
+        messages costs a single round trip. Messages with no likes are left
+        out of the result; look them up with `.get(msg.id, 0)`. `session`
+        defaults to `db.session`.
+        """
+
+        ids = [msg.id for msg in messages]
+        if not ids:
+            return {}
+
+        rows = ((session or db.session)
+                .query(Likes.message_id, db.func.count(Likes.id))
+                .filter(Likes.message_id.in_(ids))
+                .group_by(Likes.message_id)
+                .all())
+        return dict(rows)
+
+
+@db.event.listens_for(Message, 'before_insert')
+def assign_message_id(mapper, connection, message):
+    """Give a new message its id now, and take its timestamp from the id.
+
+    That keeps the displayed time and the id order in agreement. Inserts
+    that don't go through the ORM fall back to the column defaults.
+    """
+
+    if message.id is None:
+        message.id = snowflake.next_id()
+        if message.timestamp is None:
+            message.timestamp = snowflake.timestamp(message.id)
+
+
+class MessageTerm(db.Model):
+    """A hashtag or @mention found in a message.
+
+    `term` is the lowercased tag or username including its leading "#" or
+    "@". The (term, message_id) primary key doubles as the index for
+    paging through a term's messages newest first. There's no foreign key
+    on `message_id`, so the index stays in the main database when messages
+    are on shards; deleting a message unindexes it (`tags.unindex_messages`).
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        primary_key=True,
+    )
+
+
+class FeedEntry(db.Model):
+    """A message pushed into a user's home feed when it was posted.
+
+    Only used by the "hybrid" feed engine (see feeds.py). The primary key
+    reads a feed newest first, since message ids are time-ordered.
+    `author_id` is copied from the message so an unfollowed author's
+    messages can be dropped without touching `messages`.
+    """
+
+    __tablename__ = 'feed_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+        index=True,
+    )
+
+
+class Notification(db.Model):
+    """Someone followed, liked or mentioned `user_id`.
+
+    Rows are written once per event and grouped when read (see
+    notifications.py). Ids are time-ordered like message ids, and `day`
+    (days since snowflake.EPOCH) is the grouping bucket. `actor_id` is the
+    latest actor; `count` is how many actors the row stands for, which is
+    more than one only once a rollup has merged a day's rows. There's no
+    foreign key on `message_id`, so archived messages keep theirs.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        # A user's inbox newest first
+        db.Index('notifications_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        MessageId,
+        primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        MessageId,
+    )
+
+    day = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, waiting for or claimed by a worker."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default="{}",
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="queued",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        index=True,
+    )
+
+    locked_until = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} ({self.status})>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,275 @@
+"""Notification inbox for Warbler.
+
+Following someone, liking their warble or @mentioning them leaves a
+`Notification` row for them. Writing one is a plain insert, with no
+read-modify-write of a counter row that hot accounts would queue up on;
+buffered likes (see likes.py) add theirs in the same batched statement
+as the like itself, and only for likes that are actually new.
+
+The inbox groups rows as it reads them, by (kind, message, day), into
+entries like "alice and 40 others liked your warble". The daily
+`rollup_notifications` task merges each finished day's groups into one
+row apiece and drops rows older than NOTIFICATIONS_KEEP_DAYS, so reading
+an inbox only aggregates today's rows one by one. Pages go back with
+keyset pagination on the newest id in each group ("before this id").
+
+The unread count in the navbar is cached for 30 seconds and capped at
+UNREAD_CAP, so it costs at most a short index range scan per user.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from cache import LocalCache
+from jobs import task, enqueue
+from models import db, User, Notification
+import metrics
+import readmodels
+from shards import router
+import snowflake
+import tags
+
+PAGE_SIZE = 30
+
+UNREAD_CAP = 99
+
+ROLLUP_DAYS = 7
+
+ROLLUP_BATCH_SIZE = 1000
+
+# Everyone who hasn't already liked the message, except its author.
+# Run before inserting the like, with the `likes.INSERT_SQL` parameters
+# plus an `id` and `day` from `event_values()`.
+LIKE_SQL = ("INSERT INTO notifications "
+            "(id, user_id, kind, actor_id, message_id, day, count) "
+            "SELECT :id, messages.user_id, 'like', :user_id, :message_id, :day, 1 "
+            "FROM messages WHERE messages.id = :message_id "
+            "AND messages.user_id != :user_id "
+            "AND NOT EXISTS (SELECT 1 FROM likes "
+            "WHERE user_id = :user_id AND message_id = :message_id)")
+
+# `actor` (the latest) is a UserCard; `text` is the message's, if any
+Group = namedtuple('Group', ['kind', 'latest', 'timestamp', 'actors', 'actor',
+                             'message_id', 'text'])
+
+# user_id -> unread count
+_unread = LocalCache(ttl=30)
+
+
+def day_of(id):
+    """The grouping bucket (days since snowflake.EPOCH) of `id`."""
+
+    return (snowflake.timestamp(id) - snowflake.EPOCH).days
+
+
+def event_values():
+    """A new notification's `id` and `day`."""
+
+    id = snowflake.next_id()
+    return {'id': id, 'day': day_of(id)}
+
+
+def _actors():
+    # A merged row counts its actors in `count`; fresh rows are one actor
+    # each, and may repeat one (liking, unliking and liking again).
+    # Groups are either one merged row plus any late arrivals or only
+    # fresh rows, so this is exact for the latter and close for the former.
+    return (db.func.max(Notification.count) +
+            db.func.count(db.distinct(Notification.actor_id)) - 1)
+
+
+def notify_many(rows):
+    """Insert notifications; `rows` are dicts of user_id, kind, actor_id
+    and (optionally) message_id. Call before committing.
+    """
+
+    rows = [{'message_id': None, 'count': 1, **event_values(), **row}
+            for row in rows if row['user_id'] != row['actor_id']]
+    if not rows:
+        return
+
+    db.session.execute(Notification.__table__.insert(), rows)
+    for user_id in {row['user_id'] for row in rows}:
+        _unread.delete(user_id)
+    metrics.incr('notifications.written', len(rows))
+
+
+def notify(user_id, kind, actor_id, message_id=None):
+    """Tell `user_id` that `actor_id` did `kind` ("follow", "like" or
+    "mention"), optionally to or in `message_id`. Call before committing.
+    """
+
+    notify_many([{'user_id': user_id, 'kind': kind, 'actor_id': actor_id,
+                  'message_id': message_id}])
+
+
+def mentioned(messages):
+    """Notify the users @mentioned in `messages` (flushed, with ids)."""
+
+    mentions = [(msg, term[1:]) for msg in messages
+                for term in tags.extract_terms(msg.text) if term[0] == '@']
+    if not mentions:
+        return
+
+    names = {name for msg, name in mentions}
+    users = dict(db.session
+                 .query(db.func.lower(User.username), User.id)
+                 .filter(db.func.lower(User.username).in_(names),
+                         User.deleted_at.is_(None)))
+
+    notify_many([{'user_id': users[name], 'kind': 'mention',
+                  'actor_id': msg.user_id, 'message_id': msg.id}
+                 for msg, name in mentions if name in users])
+
+
+def inbox(user_id, before=None, limit=PAGE_SIZE):
+    """Up to `limit` Groups for `user_id`, newest first.
+
+    Pass the `latest` of the previous page's last Group as `before` for the
+    next. Actors whose accounts are deleted are left out.
+    """
+
+    latest = db.func.max(Notification.id).label('latest')
+    query = (db.session
+             .query(Notification.kind, Notification.message_id,
+                    Notification.day, latest, _actors())
+             .join(User, User.id == Notification.actor_id)
+             .filter(Notification.user_id == user_id,
+                     User.deleted_at.is_(None))
+             .group_by(Notification.kind, Notification.message_id,
+                       Notification.day)
+             .order_by(latest.desc()))
+
+    if before is not None:
+        # Whole days only, so no group is cut short
+        query = (query
+                 .filter(Notification.day <= day_of(before))
+                 .having(db.func.max(Notification.id) < before))
+
+    rows = query.limit(limit).all()
+    if not rows:
+        return []
+
+    actor_ids = dict(db.session
+                     .query(Notification.id, Notification.actor_id)
+                     .filter(Notification.id.in_([row.latest for row in rows])))
+    actors = readmodels.authors(set(actor_ids.values()))
+    message_ids = {row.message_id for row in rows} - {None}
+    texts = {row.id: row.text
+             for row in router.messages_by_ids(list(message_ids))}
+
+    return [Group(kind, latest, snowflake.timestamp(latest), count,
+                  actors[actor_ids[latest]], message_id, texts.get(message_id))
+            for kind, message_id, day, latest, count in rows]
+
+
+def mark_read(user_id, latest):
+    """Record that `user_id` has seen everything up to id `latest`."""
+
+    (User
+     .query
+     .filter(User.id == user_id,
+             db.or_(User.notifications_read_id.is_(None),
+                    User.notifications_read_id < latest))
+     .update({'notifications_read_id': latest}, synchronize_session=False))
+    db.session.commit()
+    _unread.delete(user_id)
+
+
+def unread_count(user_id):
+    """Notifications `user_id` hasn't seen, up to UNREAD_CAP + 1."""
+
+    count = _unread.get(user_id)
+    if count is not None:
+        return count
+
+    read_id = (db.session
+               .query(User.notifications_read_id)
+               .filter(User.id == user_id)
+               .as_scalar())
+    unread = (db.session
+              .query(Notification.id)
+              .filter(Notification.user_id == user_id,
+                      Notification.id > db.func.coalesce(read_id, 0))
+              .limit(UNREAD_CAP + 1)
+              .subquery())
+    count = db.session.query(db.func.count()).select_from(unread).scalar()
+
+    _unread.set(user_id, count)
+    return count
+
+
+def _today():
+    return (datetime.utcnow() - snowflake.EPOCH).days
+
+
+def _day_start(day):
+    # Days are id ranges, so these filters are primary key range scans
+    return snowflake.min_id(snowflake.EPOCH + timedelta(days=day))
+
+
+@task
+def rollup_notifications(day=None, batch_size=ROLLUP_BATCH_SIZE):
+    """Drop expired rows, then merge groups day by day; re-enqueues itself.
+
+    Started with no `day`, it deletes rows older than
+    NOTIFICATIONS_KEEP_DAYS a batch at a time, then merges the last
+    ROLLUP_DAYS finished days, up to `batch_size` groups per run.
+    """
+
+    today = _today()
+
+    if day is None:
+        keep_days = current_app.config['NOTIFICATIONS_KEEP_DAYS']
+        expired = [id for id, in db.session
+                   .query(Notification.id)
+                   .filter(Notification.id < _day_start(today - keep_days))
+                   .limit(batch_size)]
+        if expired:
+            (Notification
+             .query
+             .filter(Notification.id.in_(expired))
+             .delete(synchronize_session=False))
+            enqueue('rollup_notifications', batch_size=batch_size)
+            db.session.commit()
+            return
+        day = max(today - ROLLUP_DAYS, 0)
+
+    if day >= today:
+        return
+
+    in_day = db.and_(Notification.id >= _day_start(day),
+                     Notification.id < _day_start(day + 1))
+
+    groups = (db.session
+              .query(Notification.user_id, Notification.kind,
+                     Notification.message_id, db.func.max(Notification.id),
+                     _actors())
+              .filter(in_day)
+              .group_by(Notification.user_id, Notification.kind,
+                        Notification.message_id)
+              .having(db.func.count() > 1)
+              .limit(batch_size)
+              .all())
+
+    for user_id, kind, message_id, latest, count in groups:
+        in_group = db.and_(in_day,
+                           Notification.user_id == user_id,
+                           Notification.kind == kind,
+                           Notification.message_id == message_id)
+        (Notification
+         .query
+         .filter(in_group, Notification.id != latest)
+         .delete(synchronize_session=False))
+        (Notification
+         .query
+         .filter(Notification.id == latest)
+         .update({'count': count}, synchronize_session=False))
+
+    metrics.incr('notifications.rolled_up', len(groups))
+    next_day = day if len(groups) == batch_size else day + 1
+    if next_day < today:
+        enqueue('rollup_notifications', day=next_day, batch_size=batch_size)
+    db.session.commit()
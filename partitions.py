@@ -0,0 +1,414 @@
+"""Monthly partitions of `messages`, and the archive of old months.
+
+Message ids are time-ordered (see snowflake.py), so a calendar month of
+messages is a range of ids:
+
+- Postgres: `messages` is partitioned by RANGE (id), one partition per
+  month (`messages_2024_05`), plus `messages_default` for anything outside
+  them. This month's and the next PARTITIONS_AHEAD months' partitions are
+  made by `create_all()` and by the `maintain_partitions` task.
+- SQLite: a month is the same id range of the one `messages` table, whose
+  rows are stored in id order, so a range read touches only that month's
+  pages.
+
+`newest()` reads the latest rows of a query a few recent months at a
+time, stopping as soon as it has enough, so the feed and profile pages
+don't look at old partitions at all for active users.
+
+`maintain_partitions` (run it daily, with `flask maintain-partitions`)
+moves each month older than MESSAGE_ARCHIVE_AFTER_MONTHS out of the
+database, into a gzipped JSON-lines file in MESSAGE_ARCHIVE_DIR, along
+with each message's like count; the month's likes, tags, feed entries and
+search entries are deleted. `get_archived()` reads one message back for
+the message page. Archive files are written in independently gzipped
+blocks with an index next to them, so that's one small read; a second
+index of each author's blocks lets `tasks.purge_account` find and remove
+a deleted account's archived messages.
+"""
+
+import bisect
+import glob
+import gzip
+import heapq
+import json
+import os
+import tempfile
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import LocalCache, message_cache
+from jobs import task, enqueue
+from models import db, Message, MessageTerm, Likes, FeedEntry
+import metrics
+import search
+import snowflake
+
+# Months of partitions made ahead of time on Postgres
+PARTITIONS_AHEAD = 2
+
+# How far back (in months, partition-aligned) each step of `newest` reads
+# before going back to the start
+RECENT_WINDOWS = (1, 3, 12)
+
+# Messages per gzip block in an archive file
+BLOCK_SIZE = 1000
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def add_months(month, n):
+    years, month_index = divmod(month.month - 1 + n, 12)
+    return datetime(month.year + years, month_index + 1, 1)
+
+
+def month_ids(month):
+    """(first id, first id of the next month) for the month starting `month`."""
+
+    return snowflake.min_id(month), snowflake.min_id(add_months(month, 1))
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def create_partitions(connection, now=None):
+    """Make this month's and the next PARTITIONS_AHEAD months' partitions.
+
+    Only Postgres has partitions; elsewhere this does nothing.
+    """
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT")
+
+    this_month = month_start(now or datetime.utcnow())
+    for n in range(PARTITIONS_AHEAD + 1):
+        month = add_months(this_month, n)
+        first, last = month_ids(month)
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+            f"PARTITION OF messages FOR VALUES FROM ({first}) TO ({last})")
+
+
+@db.event.listens_for(db.metadata, 'after_create')
+def create_initial_partitions(target, connection, **kw):
+    create_partitions(connection)
+
+
+def newest(query, limit, now=None):
+    """The first `limit` rows of `query`, which is ordered by id descending.
+
+    Reads this month first, then back to 3 and 12 months ago, and only then
+    everything older, stopping once `limit` rows are found. Each step's id
+    range lets Postgres skip every other partition.
+    """
+
+    this_month = month_start(now or datetime.utcnow())
+    rows = []
+    upper = None
+
+    for months in RECENT_WINDOWS + (None,):
+        step = query
+        if months is not None:
+            lower = snowflake.min_id(add_months(this_month, 1 - months))
+            step = step.filter(Message.id >= lower)
+        if upper is not None:
+            step = step.filter(Message.id < upper)
+
+        rows.extend(step.limit(limit - len(rows)).all())
+        if len(rows) >= limit or months is None:
+            return rows
+        upper = lower
+
+
+##############################################################################
+# Archive
+
+
+class Archive:
+    """Gzipped JSON-lines files of archived messages, one per month.
+
+    Each file is a series of gzip members of up to BLOCK_SIZE messages in
+    id order; `<file>.idx` lists each block's [first id, offset, length],
+    and `<file>.users` maps each author's id to the numbers of the blocks
+    holding their messages.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.path.join(tempfile.gettempdir(),
+                                                   'warbler-archive')
+        self._indexes = LocalCache(max_entries=1000, ttl=300)
+
+    def path(self, month):
+        return os.path.join(self.directory, f"messages-{month:%Y-%m}.jsonl.gz")
+
+    def _load(self, path):
+        index = self._indexes.get(path)
+        if index is None:
+            try:
+                with open(path) as f:
+                    index = json.load(f)
+            except FileNotFoundError:
+                return None
+            self._indexes.set(path, index)
+        return index
+
+    def _index(self, month):
+        return self._load(self.path(month) + '.idx') or []
+
+    def _user_blocks(self, month, user_id):
+        """Numbers of `month`'s blocks with messages by `user_id`.
+
+        Files archived before there was a `.users` index give every block.
+        """
+
+        users = self._load(self.path(month) + '.users')
+        if users is None:
+            return list(range(len(self._index(month))))
+        return users.get(str(user_id), [])
+
+    def _read_block(self, month, offset, length):
+        with open(self.path(month), 'rb') as f:
+            f.seek(offset)
+            data = gzip.decompress(f.read(length))
+        return [json.loads(line) for line in data.splitlines()]
+
+    def rows(self, month):
+        """Every archived message of `month`, in id order."""
+
+        for first, offset, length in self._index(month):
+            yield from self._read_block(month, offset, length)
+
+    def months(self):
+        """Months with an archive file, oldest first."""
+
+        names = glob.glob(os.path.join(self.directory, 'messages-*.jsonl.gz'))
+        return sorted(datetime.strptime(os.path.basename(name)[9:16], '%Y-%m')
+                      for name in names)
+
+    def user_months(self, user_id):
+        """Months with archived messages by `user_id`, oldest first."""
+
+        return [month for month in self.months()
+                if self._user_blocks(month, user_id)]
+
+    def user_rows(self, user_id, after=None):
+        """Every archived message by `user_id` with an id above `after`, in id order.
+
+        Only the blocks holding their messages are read, so this takes time
+        in proportion to the user's archived messages, not the archive's.
+        """
+
+        for month in self.months():
+            if after is not None and month_ids(month)[1] <= after:
+                continue
+
+            index = self._index(month)
+            for n in self._user_blocks(month, user_id):
+                if after is not None and n + 1 < len(index) and \
+                        index[n + 1][0] <= after:
+                    continue
+                for row in self._read_block(month, *index[n][1:]):
+                    if row['user_id'] == user_id and (after is None or
+                                                      row['id'] > after):
+                        yield row
+
+    def get(self, id):
+        """The archived message `id` as a dict, or None."""
+
+        month = month_start(snowflake.timestamp(id))
+        index = self._index(month)
+        n = bisect.bisect_right([first for first, offset, length in index], id)
+        if n == 0:
+            return None
+
+        for row in self._read_block(month, *index[n - 1][1:]):
+            if row['id'] == id:
+                return row
+        return None
+
+    def write(self, month, rows):
+        """Add `rows` (an iterable of dicts in id order) to `month`'s file.
+
+        Rows already archived for the month are kept. Both are merged and
+        written a block at a time, so memory doesn't grow with the month.
+        The new file and index replace the old ones only once they're
+        complete.
+        """
+
+        self._rewrite(month, _merge_by_id(self.rows(month), rows))
+
+    def remove_user(self, month, user_id):
+        """Rewrite `month`'s file without `user_id`'s messages; returns how many went."""
+
+        removed = 0
+
+        def kept():
+            nonlocal removed
+            for row in self.rows(month):
+                if row['user_id'] == user_id:
+                    removed += 1
+                else:
+                    yield row
+
+        self._rewrite(month, kept())
+        return removed
+
+    def _rewrite(self, month, rows):
+        """Replace `month`'s file and indexes with `rows`, a block at a time."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month)
+
+        index = []
+        users = {}
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            for n, block in enumerate(_blocks(rows, BLOCK_SIZE)):
+                data = gzip.compress(''.join(
+                    json.dumps(row, separators=(',', ':')) + '\n'
+                    for row in block).encode())
+                index.append([block[0]['id'], f.tell(), len(data)])
+                f.write(data)
+                for user_id in {row['user_id'] for row in block}:
+                    users.setdefault(str(user_id), []).append(n)
+        os.replace(tmp, path)
+
+        for suffix, data in (('.idx', index), ('.users', users)):
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, path + suffix)
+            self._indexes.delete(path + suffix)
+
+
+def _merge_by_id(old, new):
+    """Merge two id-ordered streams of rows; `new` wins on a repeated id."""
+
+    last = None
+    for row in heapq.merge(new, old, key=lambda row: row['id']):
+        if row['id'] != last:
+            yield row
+            last = row['id']
+
+
+def _blocks(rows, size):
+    rows = iter(rows)
+    while True:
+        block = list(islice(rows, size))
+        if not block:
+            return
+        yield block
+
+
+archive = Archive()
+
+
+def init_app(app):
+    archive.directory = app.config['MESSAGE_ARCHIVE_DIR']
+
+
+def get_archived(id):
+    """(Message, like counts) for an archived message, or None.
+
+    The Message is detached from the database but its `user` loads as
+    usual.
+    """
+
+    row = archive.get(id)
+    if row is None:
+        return None
+
+    msg = Message(id=row['id'], text=row['text'], user_id=row['user_id'],
+                  timestamp=datetime.fromisoformat(row['timestamp']))
+    make_transient_to_detached(msg)
+    return db.session.merge(msg, load=False), {msg.id: row['likes']}
+
+
+def _month_blocks(first, last):
+    """Yield the month's messages as lists of archive dicts, in id order.
+
+    Each list is one keyset batch of up to BLOCK_SIZE rows.
+    """
+
+    after = first - 1
+    while True:
+        block = (db.session
+                 .query(Message.id, Message.text, Message.timestamp,
+                        Message.user_id)
+                 .filter(Message.id > after, Message.id < last)
+                 .order_by(Message.id)
+                 .limit(BLOCK_SIZE)
+                 .all())
+        if not block:
+            return
+
+        likes = Message.like_counts(block)
+        yield [{'id': msg.id, 'text': msg.text,
+                'timestamp': msg.timestamp.isoformat(),
+                'user_id': msg.user_id, 'likes': likes.get(msg.id, 0)}
+               for msg in block]
+        after = block[-1].id
+
+
+@task
+def maintain_partitions():
+    """Make upcoming partitions and archive the oldest month due, if any.
+
+    Archives one month per run and re-enqueues itself until nothing older
+    than MESSAGE_ARCHIVE_AFTER_MONTHS is left in the database.
+    """
+
+    create_partitions(db.session.connection())
+
+    cutoff = add_months(month_start(datetime.utcnow()),
+                        -current_app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'])
+    oldest = db.session.query(db.func.min(Message.id)).scalar()
+    if oldest is None or oldest >= snowflake.min_id(cutoff):
+        db.session.commit()
+        return
+
+    month = month_start(snowflake.timestamp(oldest))
+    first, last = month_ids(month)
+    archived = []
+
+    def rows():
+        # Each block is unindexed and dropped from the cache as it's
+        # written; a failed write rolls the unindexing back with the rest
+        for block in _month_blocks(first, last):
+            ids = [row['id'] for row in block]
+            search.unindex_messages(ids)
+            for id in ids:
+                message_cache.invalidate(id)
+            archived.append(len(ids))
+            yield from block
+
+    archive.write(month, rows())
+
+    in_month = Message.id.between(first, last - 1)
+    for column in (Likes.message_id, MessageTerm.message_id,
+                   FeedEntry.message_id):
+        (db.session
+         .query(column.class_)
+         .filter(column.between(first, last - 1))
+         .delete(synchronize_session=False))
+    Message.query.filter(in_month).delete(synchronize_session=False)
+
+    name = partition_name(month)
+    if (db.session.get_bind().dialect.name == 'postgresql' and
+            db.session.execute("SELECT to_regclass(:name)",
+                               {'name': name}).scalar() is not None):
+        db.session.execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+        db.session.execute(f"DROP TABLE {name}")
+
+    metrics.incr('partitions.archived', sum(archived))
+
+    enqueue('maintain_partitions')
+    db.session.commit()
@@ -0,0 +1,108 @@
+"""Profile header stats for Warbler.
+
+The stats block on every profile page (and the home page sidebar) shows a
+user's message, following, follower and like counts, plus whether the
+viewer follows them. `profile_summary` fetches all of that in a single
+query of scalar subqueries and caches it briefly, instead of loading four
+relationships just to take their lengths. With MESSAGE_SHARDS set, the
+message and like counts come from the user's shard in a query of their
+own.
+"""
+
+from cache import LocalCache
+from models import db, User, Message, Follows, Likes
+from readmodels import ProfileSummary
+from shards import router
+
+# (user_id,) -> counts; (user_id, viewer_id) -> viewer follows user
+_cache = LocalCache(ttl=30)
+
+
+def _count(query):
+    return query.with_entities(db.func.count()).as_scalar()
+
+
+def _follows_query(user_id, viewer_id):
+    return (db.session
+            .query(Follows)
+            .filter(Follows.user_being_followed_id == user_id,
+                    Follows.user_following_id == viewer_id)
+            .exists())
+
+
+def _count_columns(user_id):
+    """Scalar subqueries for the four counts, skipping deleted accounts."""
+
+    active = User.deleted_at.is_(None)
+
+    messages = Message.query.filter(Message.user_id == user_id)
+    following = (Follows.query
+                 .join(User, User.id == Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user_id, active))
+    followers = (Follows.query
+                 .join(User, User.id == Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user_id, active))
+    likes = (Likes.query
+             .join(Message, Message.id == Likes.message_id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id, active))
+
+    if router.enabled:
+        messages, likes = (db.literal(n) for n in _shard_counts(user_id))
+        return [messages, _count(following), _count(followers), likes]
+    return [_count(q) for q in (messages, following, followers, likes)]
+
+
+def _shard_counts(user_id):
+    """(messages, likes) of `user_id`, counted on their shard.
+
+    The shard can't join to `users`, so likes of a deleted account's
+    messages count until `tasks.purge_account` removes them.
+    """
+
+    session = router.session_for(user_id)
+    return session.query(
+        _count(session.query(Message).filter(Message.user_id == user_id)),
+        _count(session.query(Likes).filter(Likes.user_id == user_id))).one()
+
+
+def profile_summary(user_id, viewer_id=None):
+    """ProfileSummary of `user_id` as seen by `viewer_id` (None if anonymous).
+
+    Counts are cached for 30 seconds; the routes that change them call
+    `invalidate`.
+    """
+
+    counts = _cache.get((user_id,))
+    viewer_follows = False
+    need_viewer = viewer_id is not None and viewer_id != user_id
+
+    if need_viewer:
+        viewer_follows = _cache.get((user_id, viewer_id))
+
+    columns = []
+    if counts is None:
+        columns += _count_columns(user_id)
+    if need_viewer and viewer_follows is None:
+        columns.append(_follows_query(user_id, viewer_id))
+
+    if columns:
+        row = list(db.session.query(*columns).one())
+
+        if counts is None:
+            counts = tuple(row[:4])
+            _cache.set((user_id,), counts)
+            row = row[4:]
+        if row:
+            viewer_follows = bool(row[0])
+            _cache.set((user_id, viewer_id), viewer_follows)
+
+    return ProfileSummary(*counts, viewer_follows=viewer_follows)
+
+
+def invalidate(user_id, viewer_id=None):
+    """Drop cached counts for `user_id` (and the `viewer_id` follow flag)."""
+
+    _cache.delete((user_id,))
+    if viewer_id is not None:
+        _cache.delete((user_id, viewer_id))
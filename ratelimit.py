@@ -0,0 +1,160 @@
+"""Token-bucket rate limiting for Warbler.
+
+Each limit is a bucket of `capacity` tokens that refills evenly over
+`period` seconds; every request takes one token and is rejected when the
+bucket is empty. Buckets are keyed by limit name plus whatever the route
+chooses (client IP, username, user id).
+
+Bucket state lives in a backend picked by RATELIMIT_STORAGE:
+
+- "memory": a per-process `cache.LocalCache`, bounded to the most recent
+  buckets
+- "sqlite:///path/to/file.db": a `cache.SQLiteFile` shared by every
+  process on the host
+
+A bucket left alone for its whole period is full again, the same as a
+new one, so either way it's dropped once its period is up.
+"""
+
+import threading
+import time
+
+from cache import LocalCache, SQLiteFile, sqlite_path
+import metrics
+
+# name -> (capacity, period in seconds)
+DEFAULT_LIMITS = {
+    'login_ip': (20, 60),
+    'login_username': (5, 60),
+    'signup_ip': (5, 3600),
+    'available_ip': (60, 60),
+    'post_user': (30, 60),
+    'ingest_user': (60, 60),
+    'export_user': (10, 3600),
+}
+
+
+def _refill(tokens, updated, now, capacity, period):
+    """Tokens in a bucket last seen at `updated` holding `tokens`."""
+
+    return min(capacity, tokens + (now - updated) * capacity / period)
+
+
+class MemoryBackend:
+    """Buckets in a LocalCache, evicting the least recently used past `max_keys`."""
+
+    def __init__(self, max_keys=100000):
+        self._buckets = LocalCache(max_entries=max_keys)
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, period):
+        """Take a token from bucket `key`; False if it was empty."""
+
+        now = self._buckets.clock()
+
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = _refill(tokens, updated, now, capacity, period)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets.set(key, (tokens, now), ttl=period)
+
+        return allowed
+
+
+class SQLiteBackend(SQLiteFile):
+    """Buckets in a SQLite file, so every process on a host shares them."""
+
+    TABLE = 'buckets'
+
+    def __init__(self, path):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, "
+            "tokens REAL NOT NULL, updated REAL NOT NULL, "
+            "expires REAL NOT NULL)"])
+
+    def take(self, key, capacity, period):
+        """Take a token from bucket `key`; False if it was empty."""
+
+        now = time.time()
+        conn = self._connect()
+
+        # IMMEDIATE takes the write lock up front, so the read-modify-write
+        # below can't interleave with another process.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?",
+                (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = _refill(tokens, updated, now, capacity, period)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated, expires) "
+                "VALUES (?, ?, ?, ?)", (key, tokens, now, now + period))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._written(now)
+        return allowed
+
+
+def backend_from_url(url):
+    """Build the backend named by a RATELIMIT_STORAGE value."""
+
+    if url == 'memory':
+        return MemoryBackend()
+
+    path = sqlite_path(url)
+    if path is not None:
+        return SQLiteBackend(path)
+
+    raise ValueError(f"Unknown rate limit storage {url!r}")
+
+
+class RateLimiter:
+    """Checks requests against the configured limits."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.limits = dict(DEFAULT_LIMITS)
+        self.enabled = True
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.backend = backend_from_url(app.config['RATELIMIT_STORAGE'])
+        self.limits.update(app.config.get('RATELIMIT_LIMITS', {}))
+        self.enabled = app.config['RATELIMIT_ENABLED']
+
+    def hit(self, limit, key):
+        """Count a request against `limit` for `key`; False means reject.
+
+        Bumps `ratelimit.<limit>.hit` for every check and
+        `ratelimit.<limit>.rejected` for each rejection.
+        """
+
+        if not self.enabled:
+            return True
+
+        capacity, period = self.limits[limit]
+        allowed = self.backend.take(f"{limit}:{key}", capacity, period)
+
+        metrics.incr(f"ratelimit.{limit}.hit")
+        if not allowed:
+            metrics.incr(f"ratelimit.{limit}.rejected")
+
+        return allowed
+
+
+limiter = RateLimiter()
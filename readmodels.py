@@ -0,0 +1,161 @@
+"""Read models for rendering Warbler pages.
+
+Templates get these instead of User and Message instances. Each one is
+an immutable record of plain values with `__slots__`: it holds only what
+a page shows, costs a fraction of an ORM instance to build and keep, and
+has no relationships, so nothing a template does can run a query.
+
+- `UserCard`: a user as shown in lists, page headers and feed items.
+  `viewer_follows` is only filled in where the page shows a follow button.
+- `FeedItem`: a message with its author's card, its like count and
+  whether the viewer likes it.
+- `ProfileSummary`: the profile header counts (see profiles.py).
+
+They're built from column-only queries. Anything with `id`, `text`,
+`timestamp` and `user_id` (a column row, or a Message from one of the
+feed finders) can be made into FeedItems; the caller supplies the like
+counts and liked ids, which depend on likes.py's write-behind buffer.
+"""
+
+from itertools import islice
+
+from models import db, User, Message, Follows
+
+
+class ReadModel:
+    """Immutable record; subclasses name their fields in `__slots__`."""
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self.__slots__):
+            raise TypeError(f"{type(self).__name__} takes "
+                            f"{len(self.__slots__)} fields")
+
+        values = dict(zip(self.__slots__, args))
+        for name, value in kwargs.items():
+            if name in values or name not in self.__slots__:
+                raise TypeError(f"{type(self).__name__} got an unexpected "
+                                f"or repeated field {name!r}")
+            values[name] = value
+
+        missing = [name for name in self.__slots__ if name not in values]
+        if missing:
+            raise TypeError(f"{type(self).__name__} is missing {missing}")
+
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}"
+                           for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class UserCard(ReadModel):
+    __slots__ = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                 'location', 'viewer_follows')
+
+    @classmethod
+    def from_user(cls, user, viewer_follows=False):
+        """Card for a User already in hand (from `user_cache`, say)."""
+
+        return cls(*(getattr(user, column.key) for column in CARD_COLUMNS),
+                   viewer_follows=viewer_follows)
+
+
+class FeedItem(ReadModel):
+    __slots__ = ('id', 'text', 'timestamp', 'author', 'likes', 'liked')
+
+
+class ProfileSummary(ReadModel):
+    __slots__ = ('messages', 'following', 'followers', 'likes',
+                 'viewer_follows')
+
+
+# Columns read for a UserCard, in field order
+CARD_COLUMNS = (User.id, User.username, User.image_url, User.header_image_url,
+                User.bio, User.location)
+
+# Columns read for a FeedItem
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp, Message.user_id)
+
+
+def card_query():
+    """Column-only query of active users, to filter and pass to `user_cards`."""
+
+    return db.session.query(*CARD_COLUMNS).filter(User.deleted_at.is_(None))
+
+
+def followed_ids(viewer_id, user_ids):
+    """Which of `user_ids` `viewer_id` follows."""
+
+    if viewer_id is None or not user_ids:
+        return set()
+
+    return {row[0] for row in (db.session
+                               .query(Follows.user_being_followed_id)
+                               .filter(Follows.user_following_id == viewer_id,
+                                       Follows.user_being_followed_id
+                                       .in_(user_ids)))}
+
+
+def user_cards(rows, viewer_id=None, batch_size=100):
+    """Yield a UserCard for each row of CARD_COLUMNS, a batch at a time.
+
+    `viewer_follows` costs one query per batch. Pass a query with
+    `yield_per` to stream a long list.
+    """
+
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+
+        follows = followed_ids(viewer_id, [row[0] for row in batch])
+        for row in batch:
+            yield UserCard(*row, viewer_follows=row[0] in follows)
+
+
+def authors(user_ids):
+    """Map user id -> UserCard for `user_ids`, in one query."""
+
+    if not user_ids:
+        return {}
+
+    rows = db.session.query(*CARD_COLUMNS).filter(User.id.in_(user_ids))
+    return {card.id: card for card in user_cards(rows, batch_size=len(user_ids))}
+
+
+def feed_items(messages, counts, liked=frozenset(), known=None):
+    """A FeedItem for each of `messages`, in order.
+
+    `counts` maps message id -> likes and `liked` holds the ids the viewer
+    likes. Authors missing from `known` (user id -> UserCard) are read in
+    one query.
+    """
+
+    cards = dict(known or {})
+    cards.update(authors({msg.user_id for msg in messages} - cards.keys()))
+
+    return [FeedItem(msg.id, msg.text, msg.timestamp, cards[msg.user_id],
+                     counts.get(msg.id, 0), msg.id in liked)
+            for msg in messages]
@@ -0,0 +1,153 @@
+"""Full-text message search for Warbler.
+
+Message text is copied into a search index when a message is posted and
+removed when it's deleted, so searching never scans `messages`:
+
+- SQLite: an FTS5 table `messages_fts` whose rowid is the message id,
+  ranked with bm25()
+- Postgres: a `message_search` table of tsvectors with a GIN index,
+  ranked with ts_rank()
+
+The index tables are created and dropped alongside the models by
+`db.create_all()` / `db.drop_all()`. They're in the main database and
+have no foreign key to `messages`, which may be on shards (see shards.py).
+"""
+
+import re
+
+from jobs import task, enqueue
+from models import db, User, Message
+import shards
+
+PAGE_SIZE = 20
+
+REINDEX_BATCH_SIZE = 1000
+
+WORD_RE = re.compile(r'\w+')
+
+
+def _dialect(bind):
+    return bind.dialect.name
+
+
+@db.event.listens_for(db.metadata, 'after_create')
+def create_index(target, connection, **kw):
+    if _dialect(connection) == 'sqlite':
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text)")
+    else:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS message_search ("
+            "message_id BIGINT PRIMARY KEY, "
+            "document TSVECTOR NOT NULL)")
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS message_search_document "
+            "ON message_search USING GIN (document)")
+
+
+@db.event.listens_for(db.metadata, 'before_drop')
+def drop_index(target, connection, **kw):
+    if _dialect(connection) == 'sqlite':
+        connection.execute("DROP TABLE IF EXISTS messages_fts")
+    else:
+        connection.execute("DROP TABLE IF EXISTS message_search")
+
+
+def index_messages(messages):
+    """Add `messages` (already flushed, so they have ids) to the index."""
+
+    rows = [{'id': msg.id, 'text': msg.text} for msg in messages]
+    if not rows:
+        return
+
+    if _dialect(db.session.get_bind()) == 'sqlite':
+        sql = "INSERT OR REPLACE INTO messages_fts (rowid, text) VALUES (:id, :text)"
+    else:
+        sql = ("INSERT INTO message_search (message_id, document) "
+               "VALUES (:id, to_tsvector('english', :text)) "
+               "ON CONFLICT (message_id) "
+               "DO UPDATE SET document = EXCLUDED.document")
+
+    db.session.execute(sql, rows)
+
+
+def index_message(msg):
+    """Add a single flushed message to the index."""
+
+    index_messages([msg])
+
+
+def unindex_messages(message_ids):
+    """Remove messages from the index by id."""
+
+    ids = list(message_ids)
+    if not ids:
+        return
+
+    if _dialect(db.session.get_bind()) == 'sqlite':
+        sql = "DELETE FROM messages_fts WHERE rowid = :id"
+    else:
+        sql = "DELETE FROM message_search WHERE message_id = :id"
+
+    db.session.execute(sql, [{'id': id} for id in ids])
+
+
+def search_messages(query, page=1, per_page=PAGE_SIZE):
+    """Messages matching every word of `query`, best match first.
+
+    Returns a list of Messages for the given 1-based `page` (rows of
+    `readmodels.MESSAGE_COLUMNS` with MESSAGE_SHARDS set). Messages by
+    deleted accounts are skipped.
+    """
+
+    words = WORD_RE.findall(query)
+    if not words:
+        return []
+
+    params = {'limit': per_page, 'offset': (page - 1) * per_page}
+
+    if _dialect(db.session.get_bind()) == 'sqlite':
+        # Quote each word so FTS5 query syntax in user input is inert
+        params['match'] = " ".join(f'"{word}"' for word in words)
+        sql = ("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match "
+               "ORDER BY bm25(messages_fts), rowid DESC "
+               "LIMIT :limit OFFSET :offset")
+    else:
+        params['query'] = " ".join(words)
+        sql = ("SELECT message_id FROM message_search, "
+               "plainto_tsquery('english', :query) AS query "
+               "WHERE document @@ query "
+               "ORDER BY ts_rank(document, query) DESC, message_id DESC "
+               "LIMIT :limit OFFSET :offset")
+
+    ids = [row[0] for row in db.session.execute(sql, params)]
+    if not ids:
+        return []
+    if shards.router.enabled:
+        return shards.router.active_messages(ids)
+
+    found = {msg.id: msg for msg in (Message
+                                     .query
+                                     .join(User, User.id == Message.user_id)
+                                     .filter(Message.id.in_(ids),
+                                             User.deleted_at.is_(None)))}
+    return [found[id] for id in ids if id in found]
+
+
+@task
+def reindex_messages(after_id=0, batch_size=REINDEX_BATCH_SIZE):
+    """Index a batch of messages with ids above `after_id`, then re-enqueue."""
+
+    messages = (Message
+                .query
+                .filter(Message.id > after_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all())
+    if not messages:
+        return
+
+    index_messages(messages)
+
+    enqueue('reindex_messages', after_id=messages[-1].id, batch_size=batch_size)
+    db.session.commit()
@@ -0,0 +1,255 @@
+"""Server-side sessions for Warbler.
+
+With SESSION_STORE set, the session cookie carries only an opaque random
+id; the session data (the logged-in user's id plus any flashed messages)
+lives in a store on the server. The store is only read the first time a
+request touches the session, and only written when it changes. Because
+the server holds the data, every session belonging to a user can be
+revoked at once. Logging in or out issues a new id and drops the old one,
+so an id planted in someone's browser before they log in is worthless.
+
+SESSION_STORE may be:
+
+- "cookie": Flask's default signed cookie sessions (no revocation)
+- "memory": a per-process `cache.LocalCache`; only safe with a single app
+  process
+- "sqlite:///path/to/file.db": a `cache.SQLiteFile` shared by every
+  process on the host
+"""
+
+import json
+import secrets
+import threading
+import time
+from collections.abc import MutableMapping
+
+from flask import current_app
+from flask.sessions import SessionInterface, SessionMixin
+
+from cache import LocalCache, SQLiteFile, sqlite_path
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':'))
+
+
+class MemoryStore:
+    """Sessions in a LocalCache, bounded to `max_sessions` entries.
+
+    `_by_user` maps each user id to their session ids; ids the cache has
+    since evicted or expired are weeded out as that user's sessions change,
+    and from every user once the map grows to twice the cache's size.
+    """
+
+    def __init__(self, max_sessions=100000):
+        self.max_sessions = max_sessions
+        self._sessions = LocalCache(max_entries=max_sessions)
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        entry = self._sessions.get(sid)
+        return json.loads(entry[0]) if entry is not None else None
+
+    def set(self, sid, data, user_id, ttl):
+        with self._lock:
+            self._sessions.set(sid, (_dumps(data), user_id), ttl=ttl)
+            if user_id is not None:
+                self._by_user[user_id] = self._live(user_id) | {sid}
+                if len(self._by_user) > 2 * self.max_sessions:
+                    for other in list(self._by_user):
+                        self._by_user[other] = self._live(other)
+                        if not self._by_user[other]:
+                            del self._by_user[other]
+
+    def delete(self, sid):
+        self._sessions.delete(sid)
+
+    def delete_user(self, user_id, keep=None):
+        with self._lock:
+            for sid in self._live(user_id) - {keep}:
+                self._sessions.delete(sid)
+            self._by_user[user_id] = self._live(user_id)
+
+    def _live(self, user_id):
+        """`user_id`'s session ids that are still in the cache as theirs."""
+
+        live = set()
+        for sid in self._by_user.get(user_id, ()):
+            entry = self._sessions.get(sid)
+            if entry is not None and entry[1] == user_id:
+                live.add(sid)
+        return live
+
+
+class SQLiteStore(SQLiteFile):
+    """Sessions in a SQLite file, so every process on a host shares them."""
+
+    TABLE = 'sessions'
+
+    def __init__(self, path):
+        super().__init__(path, [
+            "CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, "
+            "user_id INTEGER, data TEXT NOT NULL, expires REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS sessions_user_id ON sessions (user_id)"])
+
+    def get(self, sid):
+        row = self._connect().execute(
+            "SELECT data FROM sessions WHERE sid = ? AND expires >= ?",
+            (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, sid, data, user_id, ttl):
+        now = time.time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sessions (sid, user_id, data, expires) "
+            "VALUES (?, ?, ?, ?)", (sid, user_id, _dumps(data), now + ttl))
+        self._written(now)
+
+    def delete(self, sid):
+        self._connect().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def delete_user(self, user_id, keep=None):
+        self._connect().execute(
+            "DELETE FROM sessions WHERE user_id = ? AND sid IS NOT ?",
+            (user_id, keep))
+
+
+def store_from_url(url):
+    """Build the store named by a SESSION_STORE value."""
+
+    if url == 'memory':
+        return MemoryStore()
+
+    path = sqlite_path(url)
+    if path is not None:
+        return SQLiteStore(path)
+
+    raise ValueError(f"Unknown session store {url!r}")
+
+
+class LazySession(SessionMixin, MutableMapping):
+    """Session whose data is fetched from the store on first access.
+
+    Changing the `user_key` entry rotates the id (see `rotate`).
+    """
+
+    def __init__(self, store, sid=None, user_key=None):
+        self.store = store
+        self.user_key = user_key
+        self.sid = sid
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            self._data = self.store.get(self.sid) if self.sid else None
+
+            if self._data is None:
+                # Unknown, expired or revoked: start over with a fresh id
+                self.sid = None
+                self.new = True
+                self._data = {}
+
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key == self.user_key and self.data.get(key) != value:
+            self.rotate()
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        if key == self.user_key and key in self.data:
+            self.rotate()
+        del self.data[key]
+        self.modified = True
+
+    def rotate(self):
+        """Drop the stored session; it's saved again under a new id."""
+
+        if self.sid:
+            self.store.delete(self.sid)
+        self.sid = None
+        self.new = True
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps session data in `store`, sending only its id in the cookie.
+
+    `user_key` names the session entry holding the logged-in user's id, so
+    the store can index sessions by user for revocation.
+    """
+
+    def __init__(self, store, user_key):
+        self.store = store
+        self.user_key = user_key
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        return LazySession(self.store, sid or None, self.user_key)
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session.modified:
+            return
+
+        if not session:
+            if session.sid:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+
+        ttl = app.permanent_session_lifetime.total_seconds()
+        self.store.set(session.sid, dict(session), session.get(self.user_key), ttl)
+
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def init_sessions(app, user_key):
+    """Switch `app` to server-side sessions if SESSION_STORE asks for it."""
+
+    url = app.config['SESSION_STORE']
+    if url != 'cookie':
+        app.session_interface = ServerSessionInterface(store_from_url(url),
+                                                       user_key)
+
+
+def revoke_user_sessions(user_id, keep=None):
+    """Log `user_id` out everywhere, except the session with id `keep`.
+
+    Does nothing with cookie sessions, which can't be revoked.
+    """
+
+    interface = current_app.session_interface
+    if isinstance(interface, ServerSessionInterface):
+        interface.store.delete_user(user_id, keep=keep)
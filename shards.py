@@ -0,0 +1,254 @@
+"""Sharding messages and likes by user id.
+
+With MESSAGE_SHARDS set to a comma-separated list of database URLs, each
+user's messages and likes live on one of those databases, picked from the
+user id by `shard_for`; users, follows and everything else stay in the
+main database. Unset (the default), there's a single database and the
+router hands back `db.session` for everything.
+
+`router.session_for(user_id)` is a session that reads and writes
+`messages` and `likes` on that user's shard and every other table in the
+main database, so `msg.user` and the like lazy-load as usual. The two
+databases are committed one after the other, not atomically.
+
+Reads across users scatter one query to each shard involved and gather
+the results: the home feed merges each shard's newest messages by id
+(ids are time-ordered, see snowflake.py), like counts are summed, and a
+message looked up by id is tried on each shard in turn. A message's
+likes can be on any shard, so deleting it deletes them on every shard.
+
+The hashtag and search indexes stay in the main database, with no
+foreign key to `messages`; their pages look the messages up here. The
+hybrid feed isn't available with MESSAGE_SHARDS set.
+"""
+
+import heapq
+from itertools import islice
+
+import sqlalchemy
+from flask import abort
+from sqlalchemy import orm
+
+from cache import message_cache
+from models import db, User, Message, Likes
+from readmodels import MESSAGE_COLUMNS
+import partitions
+
+SHARDED_MODELS = (Message, Likes)
+
+
+def jump_hash(key, buckets):
+    """Bucket in range(`buckets`) for the integer `key`.
+
+    This is Lamping and Veach's jump consistent hash: going from n to n + 1
+    buckets moves only 1 / (n + 1) of the keys, all into the new bucket.
+    """
+
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def _shard_metadata():
+    """The sharded tables as they're created on a shard.
+
+    Foreign keys are left out, since they'd point at the main database (or,
+    for likes, at another shard). Unique constraints are kept: a user's
+    likes are all on one shard, so "one like per message" still holds.
+    """
+
+    metadata = db.MetaData()
+    for model in SHARDED_MODELS:
+        table = model.__table__
+        columns = [db.Column(c.name, c.type, primary_key=c.primary_key,
+                             nullable=c.nullable, autoincrement=c.autoincrement)
+                   for c in table.columns]
+        indexes = [db.Index(index.name, *[c.name for c in index.columns])
+                   for index in table.indexes]
+        uniques = [db.UniqueConstraint(*[c.name for c in constraint.columns],
+                                       name=constraint.name)
+                   for constraint in table.constraints
+                   if isinstance(constraint, db.UniqueConstraint)]
+        db.Table(table.name, metadata, *columns, *indexes, *uniques)
+    return metadata
+
+
+class ShardRouter:
+    """Picks the database for a user's messages and likes."""
+
+    def __init__(self):
+        self.metadata = _shard_metadata()
+        self.engines = []
+        self._sessions = []
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def init_app(self, app):
+        """Connect to the shards listed in MESSAGE_SHARDS, if any."""
+
+        urls = [url.strip()
+                for url in (app.config.get('MESSAGE_SHARDS') or '').split(',')
+                if url.strip()]
+        if urls and app.config['FEED_ENGINE'] != 'query':
+            raise ValueError("MESSAGE_SHARDS needs FEED_ENGINE=query")
+
+        self.remove()
+        for engine in self.engines:
+            engine.dispose()
+
+        main = db.get_engine(app)
+        self.engines = [sqlalchemy.create_engine(url) for url in urls]
+        self._sessions = [
+            orm.scoped_session(orm.sessionmaker(
+                bind=main,
+                binds={model: engine for model in SHARDED_MODELS}))
+            for engine in self.engines]
+
+        if 'shards' not in app.extensions:
+            app.extensions['shards'] = self
+            app.teardown_appcontext(self.remove)
+
+    def remove(self, exception=None):
+        """End this thread's shard sessions (at the end of each request)."""
+
+        for session in self._sessions:
+            session.remove()
+
+    def shard_for(self, user_id):
+        """Index into `engines` of the shard holding `user_id`'s rows."""
+
+        return jump_hash(user_id, len(self.engines))
+
+    def session_for(self, user_id):
+        """Session for `user_id`'s messages and likes."""
+
+        if not self.enabled:
+            return db.session
+        return self._sessions[self.shard_for(user_id)]
+
+    def sessions(self):
+        """A session for each shard, to scatter a query to all of them."""
+
+        return list(self._sessions) if self.enabled else [db.session]
+
+    def group(self, user_ids):
+        """[(session, user ids on its shard)] for the shards `user_ids` use."""
+
+        if not self.enabled:
+            return [(db.session, list(user_ids))]
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return [(self._sessions[n], ids) for n, ids in sorted(groups.items())]
+
+    def commit(self):
+        """Commit every shard session, then the main one."""
+
+        for session in self._sessions:
+            session.commit()
+        db.session.commit()
+
+    def newest_messages(self, user_ids, limit):
+        """Newest `limit` messages by `user_ids`, across their shards.
+
+        Each shard returns its own newest `limit`, already sorted by id, so
+        merging those lists and keeping the first `limit` is exact.
+        """
+
+        results = [partitions.newest(session
+                                     .query(Message)
+                                     .filter(Message.user_id.in_(ids))
+                                     .order_by(Message.id.desc()),
+                                     limit)
+                   for session, ids in self.group(user_ids)]
+        merged = heapq.merge(*results, key=lambda msg: msg.id, reverse=True)
+        return list(islice(merged, limit))
+
+    def like_counts(self, messages):
+        """Map message id -> likes, summed over the shards (see Message.like_counts)."""
+
+        counts = {}
+        for session in self.sessions():
+            for id, count in Message.like_counts(messages, session).items():
+                counts[id] = counts.get(id, 0) + count
+        return counts
+
+    def messages_by_ids(self, ids):
+        """Rows of MESSAGE_COLUMNS for `ids`, in the same order.
+
+        Each shard is asked for all of them; ids no shard has are left out.
+        """
+
+        if not ids:
+            return []
+
+        found = {}
+        for session in self.sessions():
+            for row in (session
+                        .query(*MESSAGE_COLUMNS)
+                        .filter(Message.id.in_(ids))):
+                found[row.id] = row
+        return [found[id] for id in ids if id in found]
+
+    def active_messages(self, ids):
+        """`messages_by_ids`, leaving out messages by deleted users."""
+
+        rows = self.messages_by_ids(ids)
+        if not rows:
+            return []
+
+        active = {row[0] for row in (db.session
+                                     .query(User.id)
+                                     .filter(User.id.in_({row.user_id
+                                                          for row in rows}),
+                                             User.deleted_at.is_(None)))}
+        return [row for row in rows if row.user_id in active]
+
+    def delete_likes(self, message_ids):
+        """Delete every like of `message_ids`, on every shard."""
+
+        for session in self.sessions():
+            (session
+             .query(Likes)
+             .filter(Likes.message_id.in_(message_ids))
+             .delete(synchronize_session=False))
+
+    def get_message(self, id):
+        """Message `id` from whichever shard has it, or None."""
+
+        if not self.enabled:
+            return message_cache.get(id)
+
+        for session in self._sessions:
+            msg = session.query(Message).get(id)
+            if msg is not None:
+                return msg
+        return None
+
+    def get_message_or_404(self, id):
+        msg = self.get_message(id)
+        if msg is None:
+            abort(404)
+        return msg
+
+
+router = ShardRouter()
+
+
+@db.event.listens_for(db.metadata, 'after_create')
+def create_shards(target, connection, **kw):
+    for engine in router.engines:
+        router.metadata.create_all(engine)
+
+
+@db.event.listens_for(db.metadata, 'after_drop')
+def drop_shards(target, connection, **kw):
+    router.remove()
+    for engine in router.engines:
+        router.metadata.drop_all(engine)
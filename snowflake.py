@@ -0,0 +1,143 @@
+"""Time-ordered 64-bit message ids.
+
+An id packs, from the top bit down:
+
+- 41 bits: milliseconds since EPOCH (good for about 69 years)
+- 10 bits: the worker (process) that made it
+- 12 bits: a per-worker sequence within the millisecond
+
+so ids sort by creation time, and the primary key doubles as the
+timeline index. Each process claims its own worker number by taking an
+exclusive lock on a file in MESSAGE_ID_LOCK_DIR, from the range in
+MESSAGE_ID_WORKERS ("first-last"); give each host a disjoint range when
+several hosts write messages.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2020, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def parse_workers(value):
+    """range() of worker numbers from "first-last" (or a single number)."""
+
+    first, _, last = str(value).partition('-')
+    workers = range(int(first), int(last or first) + 1)
+    if not workers or workers[0] < 0 or workers[-1] > MAX_WORKER:
+        raise ValueError(f"Worker range must be within 0-{MAX_WORKER}: {value!r}")
+    return workers
+
+
+class IdGenerator:
+    """Makes unique, increasing ids for one process."""
+
+    def __init__(self, workers=range(MAX_WORKER + 1), lock_dir=None,
+                 clock=time.time):
+        self.workers = workers
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(),
+                                                 'warbler-ids')
+        self.clock = clock
+        self.worker_id = None
+        self._lock_file = None
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _claim_worker(self):
+        """Lock the first free worker number's file; held until exit."""
+
+        os.makedirs(self.lock_dir, exist_ok=True)
+        for worker_id in self.workers:
+            f = open(os.path.join(self.lock_dir, f"{worker_id}.lock"), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+
+            self._lock_file = f
+            return worker_id
+
+        raise RuntimeError(f"No free message id worker in {self.workers}")
+
+    def release(self):
+        """Give up the worker number (so another process can claim it)."""
+
+        with self._lock:
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+            self.worker_id = None
+
+    def _after_fork(self):
+        # The child shares the parent's lock, so it must claim its own number
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self.worker_id = None
+
+    def next_id(self):
+        with self._lock:
+            if self.worker_id is None:
+                self.worker_id = self._claim_worker()
+
+            now = int(self.clock() * 1000) - EPOCH_MS
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            else:
+                # Same millisecond, or the clock stepped back: carry on from
+                # the last id so ids never repeat or go backwards
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+
+            return ((self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) |
+                    (self.worker_id << SEQUENCE_BITS) |
+                    self._sequence)
+
+
+generator = IdGenerator()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=generator._after_fork)
+
+
+def next_id():
+    """A new message id from this process's generator."""
+
+    return generator.next_id()
+
+
+def timestamp(id):
+    """UTC datetime, to the millisecond, at which `id` was made."""
+
+    return EPOCH + timedelta(milliseconds=id >> (WORKER_BITS + SEQUENCE_BITS))
+
+
+def min_id(dt):
+    """Smallest id made at or after the UTC datetime `dt`."""
+
+    ms = (dt - EPOCH) // timedelta(milliseconds=1)
+    return max(ms, 0) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+def init_app(app):
+    """Set the worker range and lock directory from config."""
+
+    generator.release()
+    generator.workers = parse_workers(app.config['MESSAGE_ID_WORKERS'])
+    if app.config.get('MESSAGE_ID_LOCK_DIR'):
+        generator.lock_dir = app.config['MESSAGE_ID_LOCK_DIR']
@@ -0,0 +1,148 @@
+"""Hashtag and @mention index for Warbler.
+
+Terms are pulled out of a message's text when it's posted and stored as
+`MessageTerm` rows, so a tag or mention timeline is a range scan over the
+(term, message_id) primary key rather than a LIKE over every message.
+Timelines page with keyset pagination on message id ("before this id").
+The index is in the main database; with MESSAGE_SHARDS set, a timeline's
+messages are gathered from the shards.
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+from jobs import task, enqueue
+from models import db, User, Message, MessageTerm
+import shards
+
+TERM_RE = re.compile(r'(?<!\w)([#@])(\w+)')
+
+PAGE_SIZE = 50
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def extract_terms(text):
+    """Set of "#tag" / "@username" terms in `text`, lowercased."""
+
+    return {f"{sigil}{word.lower()}" for sigil, word in TERM_RE.findall(text)}
+
+
+def index_messages(messages):
+    """Insert index rows for the terms of `messages` in one statement.
+
+    Each message must already have an id (flush it first if it's new).
+    """
+
+    rows = [{'term': term, 'message_id': msg.id}
+            for msg in messages for term in extract_terms(msg.text)]
+    if rows:
+        db.session.execute(MessageTerm.__table__.insert(), rows)
+
+
+def index_message(msg):
+    """Insert index rows for a single flushed message's terms."""
+
+    index_messages([msg])
+
+
+def unindex_messages(message_ids):
+    """Remove the index rows of messages by id."""
+
+    ids = list(message_ids)
+    if ids:
+        (MessageTerm
+         .query
+         .filter(MessageTerm.message_id.in_(ids))
+         .delete(synchronize_session=False))
+
+
+def messages_for_term(term, before=None, limit=PAGE_SIZE):
+    """Up to `limit` messages indexed under `term`, newest first.
+
+    Pass the smallest id from the previous page as `before` for the next.
+    Messages by deleted accounts are skipped. With MESSAGE_SHARDS set these
+    are rows of `readmodels.MESSAGE_COLUMNS` rather than Messages.
+    """
+
+    if shards.router.enabled:
+        return _sharded_messages_for_term(term.lower(), before, limit)
+
+    query = (Message
+             .query
+             .join(MessageTerm, MessageTerm.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(MessageTerm.term == term.lower(),
+                     User.deleted_at.is_(None)))
+
+    if before is not None:
+        query = query.filter(MessageTerm.message_id < before)
+
+    return query.order_by(MessageTerm.message_id.desc()).limit(limit).all()
+
+
+def _sharded_messages_for_term(term, before, limit):
+    # Read the index a page at a time until deleted accounts' messages
+    # are made up for
+    messages = []
+    while len(messages) < limit:
+        query = (db.session
+                 .query(MessageTerm.message_id)
+                 .filter(MessageTerm.term == term))
+        if before is not None:
+            query = query.filter(MessageTerm.message_id < before)
+        ids = [row[0] for row in
+               query.order_by(MessageTerm.message_id.desc()).limit(limit)]
+
+        messages += shards.router.active_messages(ids)
+        if len(ids) < limit:
+            break
+        before = ids[-1]
+    return messages[:limit]
+
+
+def linkify_tags(text):
+    """Jinja filter: escape `text` and turn its hashtags into tag links."""
+
+    html = Markup()
+    last = 0
+
+    for match in TERM_RE.finditer(text):
+        sigil, word = match.groups()
+        if sigil != '#':
+            continue
+
+        html += escape(text[last:match.start()])
+        html += Markup('<a href="/tags/%s">#%s</a>') % (word.lower(), word)
+        last = match.end()
+
+    return html + escape(text[last:])
+
+
+@task
+def backfill_terms(after_id=0, batch_size=BACKFILL_BATCH_SIZE):
+    """Index a batch of messages with ids above `after_id`, then re-enqueue.
+
+    Safe to re-run: each batch's old index rows are replaced.
+    """
+
+    messages = (Message
+                .query
+                .filter(Message.id > after_id)
+                .order_by(Message.id)
+                .limit(batch_size)
+                .all())
+    if not messages:
+        return
+
+    ids = [msg.id for msg in messages]
+    (MessageTerm
+     .query
+     .filter(MessageTerm.message_id.in_(ids))
+     .delete(synchronize_session=False))
+
+    index_messages(messages)
+
+    enqueue('backfill_terms', after_id=ids[-1], batch_size=batch_size)
+    db.session.commit()
@@ -0,0 +1,114 @@
+"""Background tasks for Warbler.
+
+Each function here is registered with `jobs.task` and is run by a worker
+(or inline, in local mode) via `jobs.enqueue()`.
+"""
+
+import logging
+
+from cache import message_cache
+from jobs import task, enqueue
+import partitions
+import search
+from shards import router
+import tags
+from models import (db, User, Message, Follows, Likes, FeedEntry,
+                    Notification)
+
+log = logging.getLogger(__name__)
+
+PURGE_BATCH_SIZE = 1000
+
+
+def _purge_steps(user_id):
+    """(label, session, key column, criterion) for everything tied to `user_id`.
+
+    Steps are in delete order. Each batch selects up to N keys matching the
+    criterion and deletes rows matching both the criterion and those keys.
+    The user's messages and likes are on their shard (see shards.py); the
+    likes on their messages can be on any shard, so with MESSAGE_SHARDS
+    set those go with each batch of messages instead.
+    """
+
+    shard = router.session_for(user_id)
+    message_ids = db.session.query(Message.id).filter(Message.user_id == user_id)
+
+    steps = [("likes", shard, Likes.id, Likes.user_id == user_id)]
+    if not router.enabled:
+        steps.append(("likes on messages", db.session, Likes.id,
+                      Likes.message_id.in_(message_ids)))
+    return steps + [
+        ("following", db.session, Follows.user_being_followed_id,
+         Follows.user_following_id == user_id),
+        ("followers", db.session, Follows.user_following_id,
+         Follows.user_being_followed_id == user_id),
+        ("feed", db.session, FeedEntry.message_id, FeedEntry.user_id == user_id),
+        ("feed entries", db.session, FeedEntry.message_id,
+         FeedEntry.author_id == user_id),
+        ("notifications", db.session, Notification.id,
+         Notification.user_id == user_id),
+        ("notifications sent", db.session, Notification.id,
+         Notification.actor_id == user_id),
+        ("messages", shard, Message.id, Message.user_id == user_id),
+    ]
+
+
+@task
+def purge_account(user_id, batch_size=PURGE_BATCH_SIZE, purged=0):
+    """Delete one batch of a soft-deleted user's rows, then re-enqueue.
+
+    Each run removes at most `batch_size` rows and commits, so no single
+    transaction holds locks for long. `purged` carries the running total
+    from run to run. Then their archived messages are taken out of the
+    archive files, a month per run. Once nothing else refers to the user,
+    the user row itself goes.
+    """
+
+    user = User.query.get(user_id)
+    if user is None or user.deleted_at is None:
+        return
+
+    for label, session, key, criterion in _purge_steps(user_id):
+        keys = [row[0] for row in
+                session.query(key).filter(criterion).limit(batch_size)]
+        if not keys:
+            continue
+
+        (session
+         .query(key.class_)
+         .filter(criterion, key.in_(keys))
+         .delete(synchronize_session=False))
+
+        if key is Message.id:
+            if router.enabled:
+                router.delete_likes(keys)
+            tags.unindex_messages(keys)
+            search.unindex_messages(keys)
+            for message_id in keys:
+                message_cache.invalidate(message_id)
+
+        purged += len(keys)
+        log.info("Purging user %s: removed %s %s (%s rows so far)",
+                 user_id, len(keys), label, purged)
+
+        enqueue('purge_account', user_id=user_id, batch_size=batch_size,
+                purged=purged)
+        router.commit()
+        return
+
+    # Then the archive files, a month per run (see partitions.py)
+    months = partitions.archive.user_months(user_id)
+    if months:
+        removed = partitions.archive.remove_user(months[0], user_id)
+        purged += removed
+        log.info("Purging user %s: removed %s archived messages of %s "
+                 "(%s rows so far)", user_id, removed,
+                 f"{months[0]:%Y-%m}", purged)
+        enqueue('purge_account', user_id=user_id, batch_size=batch_size,
+                purged=purged)
+        db.session.commit()
+        return
+
+    db.session.delete(user)
+    db.session.commit()
+    log.info("Purged user %s (%s rows)", user_id, purged + 1)
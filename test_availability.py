@@ -0,0 +1,167 @@
+"""Username and email availability tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_availability.py
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from models import db, bcrypt, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from availability import availability, BloomFilter
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the bloom filter on its own."""
+
+    def test_membership(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}")
+
+        self.assertTrue(all(f"user{i}" in bloom for i in range(1000)))
+        false_positives = sum(f"other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class AvailabilityTestCase(TestCase):
+    """Test the signup pre-check and the availability endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        metrics.reset()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("taken", "taken@test.com", "password", None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        self.hashes = 0
+        hash_password = bcrypt.generate_password_hash
+
+        def counting(*args, **kw):
+            self.hashes += 1
+            return hash_password(*args, **kw)
+
+        bcrypt.generate_password_hash = counting
+
+    def tearDown(self):
+        del bcrypt.generate_password_hash
+        availability.sync_interval = app.config['AVAILABILITY_SYNC_INTERVAL']
+        db.session.rollback()
+
+    def signup(self, username, email):
+        return self.client.post("/signup", data={
+            "username": username, "email": email, "password": "password"},
+            follow_redirects=True).get_data(as_text=True)
+
+    def available(self, username):
+        resp = self.client.get(f"/users/available?username={username}")
+        self.assertEqual(resp.status_code, 200)
+        return resp.json['available']
+
+    def test_taken_values_skip_the_hash(self):
+        # The same message for both, so it doesn't say which is taken
+        self.assertIn("Username or email already taken",
+                      self.signup("taken", "new@test.com"))
+        self.assertIn("Username or email already taken",
+                      self.signup("new", "taken@test.com"))
+        self.assertEqual(self.hashes, 0)
+        self.assertEqual(User.query.count(), 1)
+
+        self.signup("new", "new@test.com")
+        self.assertEqual(self.hashes, 1)
+        self.assertEqual(User.query.count(), 2)
+
+    def test_endpoint(self):
+        self.assertFalse(self.available("taken"))
+        self.assertTrue(self.available("free"))
+        # Free without asking the database
+        self.assertEqual(metrics.get("availability.filtered"), 1)
+
+        self.signup("new", "new@test.com")
+        self.assertFalse(self.available("new"))
+
+        resp = self.client.get("/users/available")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_other_processes_signups(self):
+        availability.sync_interval = 0
+        self.assertTrue(self.available("elsewhere"))
+
+        db.session.add(User(username="elsewhere", email="elsewhere@test.com",
+                            password="unused"))
+        db.session.commit()
+
+        self.assertFalse(self.available("elsewhere"))
+
+    def test_renames(self):
+        self.assertFalse(self.available("taken"))
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        self.client.post("/users/profile/", data={
+            "username": "renamed", "email": "taken@test.com",
+            "password": "password"})
+
+        self.assertFalse(self.available("renamed"))
+        # Still in the filter, but the database says it's free
+        self.assertTrue(self.available("taken"))
+        self.assertEqual(metrics.get("availability.false_positive"), 1)
+
+    def test_build_in_background(self):
+        app.config['JOBS_MODE'] = 'queue'
+        availability.reset()
+        started = threading.Event()
+        release = threading.Event()
+        build = availability._build
+
+        def slow_build(generation):
+            started.set()
+            release.wait(5)
+            build(generation)
+
+        availability._build = slow_build
+        try:
+            # The build waits, but checks don't: they ask the database
+            self.assertFalse(self.available("taken"))
+            self.assertTrue(started.wait(5))
+            self.assertTrue(self.available("free"))
+            self.assertEqual(metrics.get("availability.filtered"), 0)
+            self.assertEqual(metrics.get("availability.builds"), 0)
+
+            release.set()
+            deadline = time.monotonic() + 5
+            while (metrics.get("availability.builds") == 0 and
+                   time.monotonic() < deadline):
+                time.sleep(0.01)
+
+            self.assertTrue(self.available("free"))
+            self.assertEqual(metrics.get("availability.filtered"), 1)
+        finally:
+            release.set()
+            del availability._build
+            app.config['JOBS_MODE'] = 'local'
@@ -0,0 +1,168 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_cache.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from cache import LocalCache, SQLiteCache, user_cache, message_cache
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LocalCacheTestCase(TestCase):
+    """Test the in-process LRU."""
+
+    def test_lru_eviction(self):
+        cache = LocalCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache = LocalCache(ttl=10, clock=clock)
+        cache.set("a", 1)
+
+        clock.now = 9
+        self.assertEqual(cache.get("a"), 1)
+        clock.now = 10
+        self.assertIsNone(cache.get("a"))
+
+    def test_ttl_per_item(self):
+        clock = FakeClock()
+        cache = LocalCache(ttl=10, clock=clock)
+        cache.set("a", 1, ttl=20)
+
+        clock.now = 15
+        self.assertEqual(cache.get("a"), 1)
+
+
+class SQLiteCacheTestCase(TestCase):
+    """Test the shared tier."""
+
+    def test_prunes_expired_rows(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SQLiteCache(os.path.join(tmp, "cache.db"), ttl=-1)
+            cache.PRUNE_INTERVAL = 0
+            cache.set("old", "1")
+            cache.ttl = 60
+            cache.set("new", "2")
+
+            keys = cache._connect().execute("SELECT key FROM cache")
+            self.assertEqual([key for key, in keys], ["new"])
+
+
+class ModelCacheTestCase(TestCase):
+    """Test cache-aside lookups of users and messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        metrics.reset()
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        msg = Message(text="cache me", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_hit_after_miss(self):
+        db.session.expunge_all()
+        msg = message_cache.get(self.msg_id)
+        self.assertEqual(msg.text, "cache me")
+
+        db.session.expunge_all()
+        msg = message_cache.get(self.msg_id)
+        self.assertEqual(msg.timestamp.year, Message.query.get(self.msg_id).timestamp.year)
+        self.assertEqual(msg.user.username, "cached")
+
+        self.assertEqual(metrics.get("cache.messages.miss"), 1)
+        self.assertEqual(metrics.get("cache.messages.local_hit"), 1)
+        self.assertEqual(message_cache.hit_ratio(), 0.5)
+        self.assertIsNone(message_cache.get(999999))
+
+    def test_unprojected_columns_still_load(self):
+        db.session.expunge_all()
+        user = user_cache.get(self.user_id)
+
+        self.assertTrue(user.password.startswith("$2"))
+
+    def test_shared_tier(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            user_cache.shared = SQLiteCache(os.path.join(tmp, "cache.db"))
+            try:
+                user_cache.get(self.user_id)
+
+                # Another process would start with an empty local tier
+                user_cache.local.clear()
+                db.session.expunge_all()
+                self.assertEqual(user_cache.get(self.user_id).username, "cached")
+                self.assertEqual(metrics.get("cache.users.shared_hit"), 1)
+
+                user_cache.invalidate(self.user_id)
+                self.assertIsNone(user_cache.shared.get(user_cache.key(self.user_id)))
+            finally:
+                user_cache.shared = None
+
+    def test_profile_edit_invalidates(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get(f"/users/{self.user_id}")
+            c.post("/users/profile/", data={
+                "username": "renamed",
+                "email": "cached@test.com",
+                "password": "password",
+            })
+
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertIn("@renamed", str(resp.data))
+
+    def test_metrics_page_reports_ratio(self):
+        message_cache.get(self.msg_id)
+
+        resp = self.client.get("/metrics")
+        self.assertIn("cache.messages.hit_ratio 0.0", resp.get_data(as_text=True))
@@ -0,0 +1,118 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_compression.py
+
+import gzip
+import os
+from unittest import TestCase
+
+import brotli
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import compression
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class CompressionTestCase(TestCase):
+    """Test which responses get compressed, and how."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        metrics.reset()
+
+        self.client = app.test_client()
+
+        # Nobody logs in with a password, so skip hashing them
+        db.session.add_all(User(username=f"user{i}", email=f"user{i}@test.com",
+                                password="unused")
+                           for i in range(20))
+        db.session.commit()
+
+        self.plain = self.client.get("/users").get_data()
+
+    def tearDown(self):
+        db.session.rollback()
+        compression.compressor.min_size = app.config['COMPRESS_MIN_SIZE']
+
+    def get(self, url, encoding):
+        return self.client.get(url, headers={'Accept-Encoding': encoding})
+
+    def test_gzip(self):
+        resp = self.get("/users", "gzip, deflate")
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.get_data()), self.plain)
+        self.assertLess(len(resp.get_data()), len(self.plain) / 3)
+
+    def test_brotli_preferred(self):
+        resp = self.get("/users", "gzip, deflate, br")
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.get_data()), self.plain)
+
+        resp = self.get("/users", "gzip;q=1.0, br;q=0.5")
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_not_accepted(self):
+        for encoding in ("identity", "gzip;q=0", ""):
+            resp = self.get("/users", encoding)
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.get_data(), self.plain)
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+    def test_skips_small_bodies(self):
+        compression.compressor.min_size = len(self.plain) + 1
+        resp = self.get("/users/1", "gzip")
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_skips_other_types_and_statuses(self):
+        for url in ("/static/images/default-pic.png", "/metrics", "/nowhere",
+                    "/users/1/following"):
+            resp = self.get(url, "gzip")
+            self.assertNotIn('Content-Encoding', resp.headers, url)
+
+    def test_streamed_responses(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            resp = c.get("/users/1/followers", headers={'Accept-Encoding': 'gzip'})
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertNotIn('Content-Length', resp.headers)
+            self.assertIn(b"@user0", gzip.decompress(resp.get_data()))
+
+        self.assertEqual(metrics.get("compression.users_followers.responses"), 1)
+
+    def test_metrics(self):
+        # Streamed, so the totals are recorded once the body is read
+        body = self.get("/users", "gzip").get_data()
+
+        self.assertEqual(metrics.get("compression.list_users.responses"), 1)
+        self.assertEqual(metrics.get("compression.list_users.bytes_in"),
+                         len(self.plain))
+        self.assertEqual(metrics.get("compression.list_users.bytes_out"),
+                         len(body))
+        self.assertGreaterEqual(metrics.get("compression.list_users.cpu_us"), 0)
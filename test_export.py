@@ -0,0 +1,241 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import export
+import partitions
+import snowflake
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+def read_jsonl(archive, section):
+    """Rows of `section` from every one of its files in `archive`, in order."""
+
+    names = sorted(n for n in archive.namelist() if n.startswith(f"{section}/"))
+    return [json.loads(line) for name in names
+            for line in archive.read(name).splitlines()]
+
+
+class ExportTestCase(TestCase):
+    """Test the streamed and resumable data exports."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        self.directory = tempfile.mkdtemp()
+        partitions.archive.directory = os.path.join(self.directory, "archive")
+
+        # Small batches and files, so a few rows span several of each
+        export.BATCH_SIZE = 3
+        export.CHUNK_ROWS = 4
+
+        # Nobody logs in with a password, so skip hashing them
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="unused")
+                 for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+        self.user_id = self.user_ids[0]
+
+        messages = [Message(text=f"message {i}", user_id=uid)
+                    for uid in self.user_ids for i in range(10)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [m.id for m in messages if m.user_id == self.user_id]
+        others = [m.id for m in messages if m.user_id != self.user_id]
+
+        db.session.add_all(Likes(user_id=self.user_id, message_id=id)
+                           for id in others[:7])
+        db.session.add_all(Follows(user_following_id=self.user_id,
+                                   user_being_followed_id=uid)
+                           for uid in self.user_ids[1:])
+        db.session.add(Follows(user_following_id=self.user_ids[2],
+                               user_being_followed_id=self.user_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        export.BATCH_SIZE = 5000
+        export.CHUNK_ROWS = 100000
+        partitions.archive.directory = app.config['MESSAGE_ARCHIVE_DIR']
+        shutil.rmtree(self.directory)
+
+    def download(self, query=""):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get(f"/users/export{query}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(resp.get_data()))
+
+    def assert_complete(self, archive):
+        profile = json.loads(archive.read('profile.json'))
+        self.assertEqual(profile['username'], "user0")
+        self.assertEqual(profile['email'], "user0@test.com")
+
+        self.assertEqual([row['id'] for row in read_jsonl(archive, 'messages')],
+                         self.message_ids)
+        self.assertEqual(len(read_jsonl(archive, 'likes')), 7)
+        self.assertEqual([row['username'] for row in
+                          read_jsonl(archive, 'following')],
+                         ["user1", "user2", "user3"])
+        self.assertEqual(read_jsonl(archive, 'followers'),
+                         [{'user_id': self.user_ids[2], 'username': "user2"}])
+
+        manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual(manifest['rows'], {'messages': 10, 'likes': 7,
+                                            'following': 3, 'followers': 1})
+        self.assertEqual(manifest['excluded'], ["likes of archived messages"])
+
+    def test_download(self):
+        archive = self.download()
+        self.assert_complete(archive)
+
+        # Files of at most CHUNK_ROWS rows, named after their first key
+        names = [n for n in archive.namelist() if n.startswith("messages/")]
+        self.assertEqual(len(names), 3)
+        self.assertEqual(names[1], f"messages/{self.message_ids[4]:020d}.jsonl")
+
+    def test_resume_download(self):
+        archive = self.download(f"?after=messages:{self.message_ids[5]}")
+
+        self.assertNotIn('profile.json', archive.namelist())
+        self.assertEqual([row['id'] for row in read_jsonl(archive, 'messages')],
+                         self.message_ids[6:])
+        self.assertEqual(len(read_jsonl(archive, 'likes')), 7)
+
+        archive = self.download("?after=following")
+        self.assertEqual([n.split('/')[0] for n in archive.namelist()],
+                         ['followers', 'manifest.json'])
+
+    def test_archived_messages(self):
+        # Two old months of messages by this user and another
+        ids = []
+        for month in (datetime(2020, 1, 1), datetime(2020, 2, 1)):
+            first = snowflake.min_id(month)
+            rows = [{'id': first + n, 'text': f"old {n}",
+                     'timestamp': month.isoformat(),
+                     'user_id': self.user_ids[n % 2], 'likes': n}
+                    for n in range(6)]
+            partitions.archive.write(month, rows)
+            ids += [row['id'] for row in rows if row['user_id'] == self.user_id]
+
+        # A month of someone else's messages isn't read at all
+        other = datetime(2020, 3, 1)
+        partitions.archive.write(other, [
+            {'id': snowflake.min_id(other) + n, 'text': "other",
+             'timestamp': other.isoformat(), 'user_id': self.user_ids[1],
+             'likes': 0}
+            for n in range(6)])
+        read = []
+        read_block = partitions.archive._read_block
+
+        def spy(month, *args):
+            read.append(month)
+            return read_block(month, *args)
+
+        partitions.archive._read_block = spy
+        try:
+            archive = self.download()
+        finally:
+            del partitions.archive._read_block
+        self.assertNotIn(other, read)
+
+        archived = read_jsonl(archive, 'archived')
+        self.assertEqual([row['id'] for row in archived], ids)
+        self.assertEqual(archived[1], {'id': ids[1], 'text': "old 2",
+                                       'timestamp': "2020-01-01T00:00:00",
+                                       'likes': 2})
+        self.assertEqual([row['id'] for row in read_jsonl(archive, 'messages')],
+                         self.message_ids)
+        manifest = json.loads(archive.read('manifest.json'))
+        self.assertEqual(manifest['rows']['archived'], 6)
+
+        archive = self.download(f"?after=archived:{ids[3]}")
+        self.assertEqual([row['id'] for row in read_jsonl(archive, 'archived')],
+                         ids[4:])
+
+    def test_cli_missing_user(self):
+        result = app.test_cli_runner().invoke(
+            args=['export-user', "999999", os.path.join(self.directory, "x.zip")])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("There's no user 999999", result.output)
+
+    def test_bad_requests(self):
+        resp = self.client.get("/users/export")
+        self.assertEqual(resp.status_code, 302)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        for after in ("nothing", "messages:x", "profile:1"):
+            resp = self.client.get(f"/users/export?after={after}")
+            self.assertEqual(resp.status_code, 400, after)
+
+    def test_cli_resumes(self):
+        path = os.path.join(self.directory, "export.zip")
+        runner = app.test_cli_runner()
+
+        # Die partway through the likes
+        fetch, key = export.SECTIONS['likes']
+        calls = []
+
+        def failing(*args):
+            calls.append(args)
+            if len(calls) > 2:
+                raise RuntimeError("interrupted")
+            return fetch(*args)
+
+        export.SECTIONS['likes'] = (failing, key)
+        try:
+            result = runner.invoke(args=['export-user', str(self.user_id), path])
+        finally:
+            export.SECTIONS['likes'] = (fetch, key)
+
+        self.assertIsInstance(result.exception, RuntimeError)
+        self.assertFalse(os.path.exists(path))
+        # The first file of likes was finished
+        fourth = Likes.query.order_by(Likes.id)[3]
+        self.assertEqual(export._resume_point(f"{path}.parts"),
+                         f"likes:{fourth.id}")
+
+        result = runner.invoke(args=['export-user', str(self.user_id), path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("10 messages, 7 likes", result.output)
+        self.assertFalse(os.path.exists(f"{path}.parts"))
+
+        with zipfile.ZipFile(path) as archive:
+            self.assert_complete(archive)
@@ -0,0 +1,220 @@
+"""Home feed engine tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_feeds.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, FeedEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import feeds
+import jobs
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class FeedTestCase(TestCase):
+    """Test that both feed engines build the same home feed."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                 for i in range(5)]
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+
+        for i in range(40):
+            db.session.add(Message(text=f"msg {i}", user_id=self.user_ids[i % 5]))
+
+        # user0 follows users 1-3, but not user4
+        for followed in self.user_ids[1:4]:
+            db.session.add(Follows(user_being_followed_id=followed,
+                                   user_following_id=self.user_ids[0]))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        feeds.MERGE_CHUNK_SIZE = 200
+        feeds.MERGE_MIN_DEPTH = 5
+
+    def test_engines_agree(self):
+        user = User.query.get(self.user_ids[0])
+
+        for limit in (1, 5, 100):
+            expected = feeds.home_feed(user, 'query', limit)
+            self.assertEqual(feeds.home_feed(user, 'merge', limit), expected)
+
+        feed = feeds.home_feed(user, 'merge', 100)
+        self.assertEqual(len(feed), 32)
+        self.assertNotIn(self.user_ids[4], {msg.user_id for msg in feed})
+        self.assertEqual([m.id for m in feed],
+                         sorted((m.id for m in feed), reverse=True))
+
+    def test_merge_in_chunks(self):
+        feeds.MERGE_CHUNK_SIZE = 2
+
+        self.assertEqual(feeds.merge_feed(self.user_ids, 10),
+                         feeds.query_feed(self.user_ids, 10))
+
+    def test_merge_reads_deeper_when_needed(self):
+        feeds.MERGE_MIN_DEPTH = 1
+
+        # user1 posts everything newer than the rest
+        for i in range(20):
+            db.session.add(Message(text=f"burst {i}", user_id=self.user_ids[1]))
+        db.session.commit()
+
+        feed = feeds.merge_feed(self.user_ids, 10)
+        self.assertEqual(feed, feeds.query_feed(self.user_ids, 10))
+        self.assertEqual(feed[-1].text, "burst 10")
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            feeds.engine_for("push")
+
+    def test_homepage_with_merge_engine(self):
+        app.config['FEED_ENGINE'] = 'merge'
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user_ids[0]
+
+                resp = c.get("/")
+        finally:
+            app.config['FEED_ENGINE'] = 'query'
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("msg 1", str(resp.data))
+        self.assertNotIn("<p>msg 4</p>", str(resp.data))
+
+
+class HybridFeedTestCase(TestCase):
+    """Test pushed feeds with celebrity messages pulled at read time."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        feeds._follower_counts.clear()
+
+        app.config['FEED_ENGINE'] = 'hybrid'
+        app.config['FEED_CELEBRITY_THRESHOLD'] = 3
+
+        self.client = app.test_client()
+
+        names = ["reader", "friend", "star", "fan", "groupie"]
+        users = [User.signup(name, f"{name}@test.com", "password", None)
+                 for name in names]
+        db.session.commit()
+        self.ids = dict(zip(names, [u.id for u in users]))
+
+        self.follow("reader", "friend")
+        self.follow("reader", "star")
+        self.follow("fan", "star")
+        self.follow("groupie", "star")
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['FEED_ENGINE'] = 'query'
+        app.config['FEED_CELEBRITY_THRESHOLD'] = 1000
+
+    def login(self, c, name):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[name]
+
+    def follow(self, name, other):
+        with self.client as c:
+            self.login(c, name)
+            c.post(f"/users/follow/{self.ids[other]}")
+
+    def post(self, name, text):
+        with self.client as c:
+            self.login(c, name)
+            c.post("/messages/new", data={"text": text})
+        return Message.query.filter_by(text=text).one().id
+
+    def pushed_to(self, name):
+        return {e.message_id for e in
+                FeedEntry.query.filter_by(user_id=self.ids[name])}
+
+    def test_push_and_pull(self):
+        friend_msg = self.post("friend", "from a friend")
+        star_msg = self.post("star", "from a star")
+
+        self.assertEqual(self.pushed_to("reader"), {friend_msg})
+        self.assertEqual(self.pushed_to("star"), {star_msg})
+
+        reader = User.query.get(self.ids["reader"])
+        with app.app_context():
+            self.assertEqual(feeds.home_feed(reader, 'hybrid'),
+                             feeds.home_feed(reader, 'query'))
+
+        with self.client as c:
+            self.login(c, "reader")
+            resp = c.get("/")
+        self.assertIn("from a friend", str(resp.data))
+        self.assertIn("from a star", str(resp.data))
+
+    def test_follow_and_unfollow(self):
+        friend_msg = self.post("friend", "hello")
+
+        self.follow("fan", "friend")
+        self.assertEqual(self.pushed_to("fan"), {friend_msg})
+
+        with self.client as c:
+            self.login(c, "fan")
+            c.post(f"/users/stop-following/{self.ids['friend']}")
+        self.assertEqual(self.pushed_to("fan"), set())
+
+    def test_star_dropping_below_threshold(self):
+        star_msg = self.post("star", "old news")
+        self.assertEqual(self.pushed_to("fan"), set())
+
+        with self.client as c:
+            self.login(c, "reader")
+            c.post(f"/users/stop-following/{self.ids['star']}")
+
+        self.assertEqual(self.pushed_to("fan"), {star_msg})
+        self.assertEqual(self.pushed_to("reader"), set())
+
+    def test_delete_message(self):
+        msg_id = self.post("friend", "oops")
+
+        with self.client as c:
+            self.login(c, "friend")
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(FeedEntry.query.count(), 0)
+
+    def test_backfill(self):
+        app.config['FEED_ENGINE'] = 'query'
+        friend_msg = self.post("friend", "before hybrid")
+        self.post("star", "pulled anyway")
+        app.config['FEED_ENGINE'] = 'hybrid'
+
+        with app.app_context():
+            jobs.enqueue('backfill_feeds')
+            db.session.commit()
+
+        self.assertEqual(self.pushed_to("reader"), {friend_msg})
+        self.assertEqual(self.pushed_to("friend"), {friend_msg})
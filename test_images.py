@@ -0,0 +1,232 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_images.py
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest import TestCase
+
+from PIL import Image
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import images
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+def png(width, height, color='red'):
+    out = io.BytesIO()
+    Image.new('RGBA', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves `files` ({path: (content type, body)}) and counts requests."""
+
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+
+        content_type, body = self.files[self.path]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DiskCacheTestCase(TestCase):
+    """Test LRU eviction of cached files."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_evicts_least_recently_used(self):
+        cache = images.DiskCache(self.dir, max_bytes=30)
+        cache.set("a", b"x" * 10)
+        cache.set("b", b"x" * 10)
+        cache.set("c", b"x" * 10)
+
+        # Make "a" the most recently used, then go over the limit
+        os.utime(os.path.join(self.dir, "b"), (1, 1))
+        os.utime(os.path.join(self.dir, "c"), (2, 2))
+        cache.get("a")
+        cache.set("d", b"x" * 10)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"x" * 10)
+        self.assertEqual(sorted(os.listdir(self.dir)), ["a", "c", "d"])
+
+    def test_picks_up_existing_files(self):
+        images.DiskCache(self.dir, max_bytes=100).set("a", b"x" * 60)
+
+        cache = images.DiskCache(self.dir, max_bytes=100)
+        cache.set("b", b"x" * 60)
+
+        self.assertIsNone(cache.get("a"))
+
+
+class ImageProxyTestCase(TestCase):
+    """Test the proxy endpoint against a local stand-in image host."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.base = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        metrics.reset()
+        StandInHandler.requests.clear()
+        StandInHandler.files = {
+            '/avatar.png': ('image/png', png(600, 300)),
+            '/page.html': ('text/html', b"<html>not an image</html>"),
+        }
+
+        self.dir = tempfile.mkdtemp()
+        app.config['IMAGE_CACHE_DIR'] = self.dir
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+        images.proxy.init_app(app)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        images.proxy.init_app(app)
+        shutil.rmtree(self.dir)
+
+    def proxied(self, path, size):
+        with app.test_request_context():
+            return images.thumbnail(self.base + path, size)
+
+    def test_thumbnails_fetched_once(self):
+        for size, dimensions in images.SIZES.items():
+            resp = self.client.get(self.proxied('/avatar.png', size))
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertIn('max-age=86400', resp.headers['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, dimensions)
+
+        self.assertEqual(StandInHandler.requests, ['/avatar.png'])
+        self.assertEqual(metrics.get('images.miss'), 1)
+        self.assertEqual(metrics.get('images.hit'), 2)
+
+    def test_bad_signature(self):
+        url = self.proxied('/avatar.png', 'card-image')
+
+        resp = self.client.get(url.replace('/card-image/', '/card-image/0'))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self.client.get(url.replace('card-image', 'huge'))
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(StandInHandler.requests, [])
+
+    def test_unusable_images_fall_back(self):
+        for path in ['/page.html', '/missing.png']:
+            resp = self.client.get(self.proxied(path, 'card-image'))
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn('/static/images/default-pic.png', resp.location)
+
+        self.assertEqual(metrics.get('images.fetch_error'), 2)
+        # Failed fetches don't leave their per-URL locks behind
+        self.assertEqual(images.proxy._locks, {})
+
+        # and aren't tried again for a while
+        resp = self.client.get(self.proxied('/page.html', 'timeline-image'))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(StandInHandler.requests, ['/page.html', '/missing.png'])
+        self.assertEqual(metrics.get('images.failure_hit'), 1)
+
+    def test_too_many_pixels(self):
+        images.proxy.max_pixels = 100 * 100
+
+        resp = self.client.get(self.proxied('/avatar.png', 'card-image'))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(metrics.get('images.fetch_error'), 1)
+
+    def test_lock_kept_while_waiters_hold_it(self):
+        url = self.base + '/avatar.png'
+        waiting = threading.Event()
+        holding = threading.Event()
+        release = threading.Event()
+
+        def waiter():
+            waiting.set()
+            with images.proxy._url_lock(url):
+                holding.set()
+                release.wait(5)
+
+        with images.proxy._url_lock(url):
+            lock = images.proxy._locks[url][0]
+            thread = threading.Thread(target=waiter)
+            thread.start()
+            waiting.wait(5)
+            while images.proxy._locks[url][1] < 2:
+                time.sleep(0.01)
+
+        holding.wait(5)
+        # A third request would wait on the same lock the waiter now holds
+        self.assertIs(images.proxy._locks[url][0], lock)
+        self.assertTrue(lock.locked())
+
+        release.set()
+        thread.join(5)
+        self.assertEqual(images.proxy._locks, {})
+
+    def test_private_hosts_refused(self):
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        images.proxy.init_app(app)
+
+        resp = self.client.get(self.proxied('/avatar.png', 'card-image'))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(StandInHandler.requests, [])
+
+    def test_filter_leaves_local_paths(self):
+        with app.test_request_context():
+            self.assertEqual(images.thumbnail('/static/images/default-pic.png',
+                                              'card-image'),
+                             '/static/images/default-pic.png')
+            self.assertIsNone(images.thumbnail(None, 'card-image'))
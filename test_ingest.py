@@ -0,0 +1,128 @@
+"""Batch ingestion API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ingest.py
+
+import base64
+import os
+from unittest import TestCase
+
+from models import db, User, Message, MessageTerm
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import search
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+def basic_auth(username, password):
+    token = base64.b64encode(f"{username}:{password}".encode()).decode()
+    return {'Authorization': f"Basic {token}"}
+
+
+class IngestTestCase(TestCase):
+    """Test posting messages in batches."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        user = User.signup("bot", "bot@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # An existing message, so new ids don't start at 1
+        db.session.add(Message(text="before", user_id=user.id))
+        db.session.commit()
+
+        self.auth = basic_auth("bot", "password")
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, body, headers=None):
+        return self.client.post("/api/messages/batch", json=body,
+                                headers=self.auth if headers is None else headers)
+
+    def test_batch(self):
+        resp = self.post({"messages": [
+            {"text": "first #import"},
+            {"text": ""},
+            {"text": "x" * 141},
+            "not an object",
+            {"text": "second @bot"},
+        ]})
+
+        self.assertEqual(resp.status_code, 200)
+        data = resp.get_json()
+        self.assertEqual(data['created'], 2)
+
+        statuses = [r['status'] for r in data['results']]
+        self.assertEqual(statuses, ["created", "invalid", "invalid",
+                                    "invalid", "created"])
+        self.assertIn("required", data['results'][1]['error'])
+        self.assertIn("140", data['results'][2]['error'])
+
+        first = Message.query.get(data['results'][0]['id'])
+        second = Message.query.get(data['results'][4]['id'])
+        self.assertEqual(first.text, "first #import")
+        self.assertEqual(second.text, "second @bot")
+        self.assertEqual(first.user_id, self.user_id)
+        # Exact for clients that parse numbers as doubles
+        self.assertEqual(data['results'][0]['id_str'], str(first.id))
+
+        terms = {(t.term, t.message_id) for t in MessageTerm.query}
+        self.assertEqual(terms, {("#import", first.id), ("@bot", second.id)})
+        self.assertEqual(search.search_messages("second"), [second])
+
+    def test_session_auth(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.post("/api/messages/batch",
+                          json={"messages": [{"text": "hi"}]})
+
+        self.assertEqual(resp.get_json()['created'], 1)
+
+    def test_unauthenticated(self):
+        resp = self.post({"messages": []}, headers={})
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn("Basic", resp.headers['WWW-Authenticate'])
+
+        resp = self.post({"messages": [{"text": "hi"}]},
+                         headers=basic_auth("bot", "wrong"))
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post([{"text": "hi"}]).status_code, 400)
+
+        resp = self.client.post("/api/messages/batch", data={"text": "hi"},
+                                headers=self.auth)
+        self.assertEqual(resp.status_code, 400)
+
+        app.config['INGEST_MAX_BATCH'] = 2
+        try:
+            resp = self.post({"messages": [{"text": "hi"}] * 3})
+        finally:
+            app.config['INGEST_MAX_BATCH'] = 1000
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual(Message.query.count(), 1)
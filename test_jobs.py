@@ -0,0 +1,158 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, Job
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import jobs
+
+db.create_all()
+
+CALLS = []
+
+
+@jobs.task
+def record_call(value):
+    CALLS.append(value)
+
+
+@jobs.task
+def always_fail():
+    raise RuntimeError("nope")
+
+
+class JobsTestCase(TestCase):
+    """Test the job queue and worker."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        CALLS.clear()
+
+    def tearDown(self):
+        app.config['JOBS_MODE'] = 'local'
+        db.session.rollback()
+
+    def test_local_mode_runs_inline(self):
+        app.config['JOBS_MODE'] = 'local'
+
+        with app.app_context():
+            self.assertIsNone(jobs.enqueue('record_call', value=1))
+
+        self.assertEqual(CALLS, [1])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_queue_mode_stores_and_runs(self):
+        app.config['JOBS_MODE'] = 'queue'
+
+        with app.app_context():
+            jobs.enqueue('record_call', value=2)
+            db.session.commit()
+            self.assertEqual(CALLS, [])
+            self.assertEqual(Job.query.count(), 1)
+
+            self.assertTrue(jobs.work_once())
+            self.assertFalse(jobs.work_once())
+
+        self.assertEqual(CALLS, [2])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_unknown_task(self):
+        with app.app_context():
+            with self.assertRaises(KeyError):
+                jobs.enqueue('no_such_task')
+
+    def test_retry_then_fail(self):
+        app.config['JOBS_MODE'] = 'queue'
+
+        with app.app_context():
+            job = jobs.enqueue('always_fail')
+            db.session.commit()
+
+            self.assertTrue(jobs.work_once())
+            self.assertEqual(job.status, 'queued')
+            self.assertEqual(job.attempts, 1)
+            self.assertGreater(job.run_at, datetime.utcnow())
+            self.assertIn("nope", job.last_error)
+
+            # Backoff keeps it from being claimed again right away
+            self.assertFalse(jobs.work_once())
+
+            job.attempts = app.config['JOBS_MAX_ATTEMPTS'] - 1
+            job.run_at = datetime.utcnow()
+            db.session.commit()
+
+            self.assertTrue(jobs.work_once())
+            self.assertEqual(job.status, 'failed')
+
+    def test_visibility_timeout(self):
+        app.config['JOBS_MODE'] = 'queue'
+
+        with app.app_context():
+            job = jobs.enqueue('record_call', value=3)
+            db.session.commit()
+
+            self.assertIs(jobs.claim_next(), job)
+            self.assertIsNone(jobs.claim_next())
+
+            # A worker died holding the job; once the lock lapses it's
+            # handed out again
+            job.locked_until = datetime.utcnow() - timedelta(seconds=1)
+            db.session.commit()
+
+            self.assertIs(jobs.claim_next(), job)
+            self.assertEqual(job.attempts, 2)
+
+    def test_purge_account(self):
+        u1 = User.signup("gone", "gone@test.com", "password", None)
+        u2 = User.signup("stays", "stays@test.com", "password", None)
+        db.session.commit()
+
+        m1 = Message(text="bye", user_id=u1.id)
+        m2 = Message(text="hi", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add_all([
+            Likes(user_id=u2.id, message_id=m1.id),
+            Likes(user_id=u1.id, message_id=m2.id),
+            Follows(user_being_followed_id=u1.id, user_following_id=u2.id),
+        ])
+        db.session.commit()
+
+        u1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with app.app_context():
+            jobs.enqueue('purge_account', user_id=u1.id, batch_size=1)
+
+        self.assertEqual(User.query.count(), 1)
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_purge_skips_active_account(self):
+        u1 = User.signup("active", "active@test.com", "password", None)
+        db.session.commit()
+
+        with app.app_context():
+            jobs.enqueue('purge_account', user_id=u1.id)
+
+        self.assertEqual(User.query.count(), 1)
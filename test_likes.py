@@ -0,0 +1,230 @@
+"""Like tests, with and without the write-behind buffer."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_likes.py
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import sqlalchemy
+
+from models import db, User, Message, Likes, Follows, Notification
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import likes
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering, flushing, overlaying and replaying like clicks."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.directory = tempfile.mkdtemp()
+        app.config.update(LIKES_WRITE_BEHIND=True, LIKES_DURABILITY='journal',
+                          LIKES_JOURNAL_DIR=self.directory,
+                          # Flushed by hand in these tests
+                          LIKES_FLUSH_INTERVAL=3600)
+        likes.buffer.init_app(app)
+
+        self.client = app.test_client()
+
+        author = User(username="author", email="author@test.com", password="x")
+        fan = User(username="fan", email="fan@test.com", password="x")
+        db.session.add_all([author, fan])
+        db.session.commit()
+        self.author_id, self.fan_id = author.id, fan.id
+
+        messages = [Message(text=f"message {i}", user_id=self.author_id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.fan_id))
+        db.session.commit()
+        self.message_ids = [msg.id for msg in messages]
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+    def tearDown(self):
+        db.session.rollback()
+        likes.buffer.flush()
+        likes.buffer.journal.close()
+        likes.buffer.journal = None
+        app.config['LIKES_WRITE_BEHIND'] = False
+        likes.buffer.init_app(app)
+        shutil.rmtree(self.directory)
+
+    def click(self, message_id, action):
+        resp = self.client.post(f"/messages/{message_id}/{action}")
+        self.assertEqual(resp.status_code, 302)
+
+    def like_count_shown(self, message_id):
+        html = self.client.get(f"/messages/{message_id}").get_data(as_text=True)
+        return html.split('<i class="fa fa-thumbs-up"></i> ')[1].split()[0]
+
+    def likes_in_db(self):
+        return sorted((like.user_id, like.message_id) for like in Likes.query)
+
+    def test_clicks_collapse_until_flushed(self):
+        msg_id = self.message_ids[0]
+        self.click(msg_id, "add_like")
+        self.click(msg_id, "remove_like")
+        self.click(msg_id, "add_like")
+
+        self.assertEqual(self.likes_in_db(), [])
+        self.assertEqual(likes.buffer.pending(), {(self.fan_id, msg_id): True})
+
+        # The fan sees their own like before it's written
+        self.assertEqual(self.like_count_shown(msg_id), "1")
+        home = self.client.get("/").get_data(as_text=True)
+        self.assertIn(f'action="/messages/{msg_id}/remove_like"', home)
+        self.assertIn(f'action="/messages/{self.message_ids[1]}/add_like"', home)
+
+        self.assertEqual(likes.buffer.flush(), 1)
+        self.assertEqual(self.likes_in_db(), [(self.fan_id, msg_id)])
+        self.assertEqual(likes.buffer.pending(), {})
+        self.assertEqual(self.like_count_shown(msg_id), "1")
+
+    def test_unlike(self):
+        msg_id = self.message_ids[0]
+        db.session.add(Likes(user_id=self.fan_id, message_id=msg_id))
+        db.session.commit()
+
+        self.click(msg_id, "remove_like")
+        self.assertEqual(len(self.likes_in_db()), 1)
+        self.assertEqual(self.like_count_shown(msg_id), "0")
+
+        likes.buffer.flush()
+        self.assertEqual(self.likes_in_db(), [])
+
+    def test_flush_skips_existing_likes_and_deleted_messages(self):
+        liked, deleted = self.message_ids[:2]
+        db.session.add(Likes(user_id=self.fan_id, message_id=liked))
+        db.session.commit()
+
+        self.click(liked, "add_like")
+        self.click(deleted, "add_like")
+        self.assertEqual(self.like_count_shown(liked), "1")
+
+        Message.query.filter_by(id=deleted).delete()
+        db.session.commit()
+
+        likes.buffer.flush()
+        self.assertEqual(self.likes_in_db(), [(self.fan_id, liked)])
+
+    def test_full_buffer_flushes_first(self):
+        likes.buffer.max_pending = 2
+        for msg_id in self.message_ids:
+            self.click(msg_id, "add_like")
+
+        self.assertEqual(len(self.likes_in_db()), 2)
+        self.assertEqual(list(likes.buffer.pending().values()), [True])
+
+    def test_failed_flush_keeps_intents(self):
+        self.click(self.message_ids[0], "add_like")
+
+        engine = likes.buffer._engine
+        likes.buffer._engine = sqlalchemy.create_engine(
+            f"sqlite:///{self.directory}/missing/nothing.db")
+        try:
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                likes.buffer.flush()
+        finally:
+            likes.buffer._engine = engine
+
+        self.click(self.message_ids[1], "add_like")
+        self.assertEqual(len(likes.buffer.pending()), 2)
+
+        likes.buffer.flush()
+        self.assertEqual(len(self.likes_in_db()), 2)
+
+    def test_journal_replayed_after_crash(self):
+        self.click(self.message_ids[0], "add_like")
+        self.click(self.message_ids[1], "add_like")
+        self.click(self.message_ids[1], "remove_like")
+
+        # Lose the buffer, as if the process had died, then start again
+        likes.buffer.journal.close()
+        likes.buffer._pending = {}
+        likes.buffer.init_app(app)
+
+        self.assertEqual(likes.buffer.pending(),
+                         {(self.fan_id, self.message_ids[0]): True,
+                          (self.fan_id, self.message_ids[1]): False})
+
+        likes.buffer.flush()
+        self.assertEqual(self.likes_in_db(), [(self.fan_id, self.message_ids[0])])
+
+        # Only the lock and the current, empty segment are left
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith('.log'))
+        self.assertEqual(os.path.getsize(os.path.join(self.directory, files[0])), 0)
+
+
+class DirectLikeTestCase(TestCase):
+    """Test likes written straight away (LIKES_WRITE_BEHIND off)."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        author = User(username="author", email="author@test.com", password="x")
+        fan = User(username="fan", email="fan@test.com", password="x")
+        db.session.add_all([author, fan])
+        db.session.commit()
+        self.fan_id = fan.id
+
+        msg = Message(text="message", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.fan_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_repeated_clicks_count_once(self):
+        for _ in range(3):
+            self.client.post(f"/messages/{self.message_id}/add_like")
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Notification.query.count(), 1)
+        self.assertEqual(Message.like_counts([Message.query.get(self.message_id)]),
+                         {self.message_id: 1})
+
+        self.assertFalse(likes.set_like(self.fan_id, self.message_id))
+        self.assertTrue(likes.set_like(self.fan_id, self.message_id, liked=False))
+        self.assertFalse(likes.set_like(self.fan_id, self.message_id, liked=False))
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_unique_constraint(self):
+        db.session.add_all([Likes(user_id=self.fan_id, message_id=self.message_id)
+                            for _ in range(2)])
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            db.session.commit()
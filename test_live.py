@@ -0,0 +1,141 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_live.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from live import MemoryHub, hub
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class HubTestCase(TestCase):
+    """Test the in-process pub/sub hub."""
+
+    def test_publish_reaches_topic_subscribers(self):
+        hub = MemoryHub()
+        sub = hub.subscribe([1, 2])
+
+        hub.publish(1, "a")
+        hub.publish(3, "b")
+        hub.publish(2, "c")
+
+        self.assertEqual(sub.get(timeout=0), "a")
+        self.assertEqual(sub.get(timeout=0), "c")
+        self.assertIsNone(sub.get(timeout=0))
+
+    def test_close_unsubscribes(self):
+        hub = MemoryHub()
+        sub = hub.subscribe([1])
+        sub.close()
+
+        hub.publish(1, "a")
+        self.assertIsNone(sub.get(timeout=0))
+        self.assertEqual(hub._subscribers, {})
+
+    def test_slow_subscriber_drops_oldest(self):
+        hub = MemoryHub()
+        sub = hub.subscribe([1])
+
+        for i in range(101):
+            hub.publish(1, i)
+
+        self.assertEqual(sub.get(timeout=0), 1)
+
+
+class StreamViewTestCase(TestCase):
+    """Test the SSE endpoint and the feed item fragment."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        viewer = User.signup("viewer", "viewer@test.com", "password", None)
+        author = User.signup("author", "author@test.com", "password", None)
+        stranger = User.signup("stranger", "stranger@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=viewer.id))
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+        self.author_id = author.id
+        self.stranger_id = stranger.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_stream_requires_login(self):
+        resp = self.client.get("/messages/stream")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_stream_relays_followed_messages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            resp = c.get("/messages/stream")
+            self.assertEqual(resp.mimetype, "text/event-stream")
+
+            hub.publish(self.stranger_id, 111)
+            hub.publish(self.author_id, 222)
+
+            frames = iter(resp.response)
+            self.assertEqual(next(frames), b"retry: 5000\n\n")
+            self.assertEqual(next(frames), b"data: 222\n\n")
+            resp.close()
+
+    def test_add_message_publishes(self):
+        sub = hub.subscribe([self.author_id])
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.author_id
+
+                c.post("/messages/new", data={"text": "live!"})
+
+            msg = Message.query.one()
+            self.assertEqual(sub.get(timeout=0), msg.id)
+        finally:
+            sub.close()
+
+    def test_item_fragment(self):
+        msg = Message(text="just one", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            resp = c.get(f"/messages/{msg_id}/item")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("just one", html)
+            self.assertNotIn("<nav", html)
@@ -79,4 +79,23 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(liking[0].message_id, msg.id)
         self.assertNotEqual(liking[0].message_id, msg2.id)
 
-       
\ No newline at end of file
+       
+    def test_like_counts(self):
+        """Are like counts aggregated per message?"""
+
+        msg = Message(text="popular", user_id=self.uid)
+        msg2 = Message(text="ignored", user_id=self.uid)
+
+        user = User.signup("liker", "liker@email.com", "password", None)
+        user2 = User.signup("liker2", "liker2@email.com", "password", None)
+        db.session.add_all([msg, msg2])
+        db.session.commit()
+
+        user.likes.append(msg)
+        user2.likes.append(msg)
+        db.session.commit()
+
+        counts = Message.like_counts([msg, msg2])
+        self.assertEqual(counts[msg.id], 2)
+        self.assertEqual(counts.get(msg2.id, 0), 0)
+        self.assertEqual(Message.like_counts([]), {})
@@ -0,0 +1,223 @@
+"""Notification inbox tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_notifications.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import likes
+import notifications
+import snowflake
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+def notification_at(day, n, **kw):
+    """Notification number `n` of `day` (days since snowflake.EPOCH)."""
+
+    id = snowflake.min_id(snowflake.EPOCH + timedelta(days=day)) + n
+    return Notification(id=id, day=day, **kw)
+
+
+class NotificationTestCase(TestCase):
+    """Test writing, grouping, paging and rolling up notifications."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Nobody logs in with a password, so skip hashing them
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="unused")
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+        self.author_id = self.user_ids[0]
+
+        msg = Message(text="hello", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def inbox_html(self):
+        self.login(self.author_id)
+        return self.client.get("/notifications").get_data(as_text=True)
+
+    def test_follow_like_and_mention(self):
+        fan = self.user_ids[1]
+        self.login(fan)
+        self.client.post(f"/users/follow/{self.author_id}")
+        self.client.post(f"/messages/{self.message_id}/add_like")
+        self.client.post("/messages/new", data={"text": "hi @USER0 and @user1"})
+
+        self.assertEqual(notifications.unread_count(self.author_id), 3)
+        # Not for mentioning yourself
+        self.assertEqual(notifications.unread_count(fan), 0)
+
+        self.login(self.author_id)
+        home = self.client.get("/").get_data(as_text=True)
+        self.assertIn('<span class="badge badge-primary" id="unread">3</span>', home)
+
+        html = self.inbox_html()
+        self.assertIn("followed you", html)
+        self.assertIn(f'liked <a href="/messages/{self.message_id}">your warble</a>',
+                      html)
+        self.assertIn("mentioned you in", html)
+        self.assertIn("hi @USER0 and @user1", html)
+        self.assertEqual(html.count("list-group-item-info"), 3)
+
+        # Seen now
+        self.assertEqual(notifications.unread_count(self.author_id), 0)
+        home = self.client.get("/").get_data(as_text=True)
+        self.assertNotIn('id="unread"', home)
+        self.assertNotIn("list-group-item-info", self.inbox_html())
+
+    def test_likes_are_grouped(self):
+        for user_id in self.user_ids[1:]:
+            self.login(user_id)
+            self.client.post(f"/messages/{self.message_id}/add_like")
+
+        # Liking again doesn't count twice
+        self.client.post(f"/messages/{self.message_id}/remove_like")
+        self.client.post(f"/messages/{self.message_id}/add_like")
+
+        groups = notifications.inbox(self.author_id)
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0].actors, 4)
+        self.assertEqual(groups[0].actor.id, self.user_ids[-1])
+        html = self.inbox_html()
+        self.assertIn('<a href="/users/5">@user4</a>', html)
+        self.assertIn("and 3 others", html)
+
+    def test_buffered_likes_notify_when_written(self):
+        directory = tempfile.mkdtemp()
+        app.config.update(LIKES_WRITE_BEHIND=True, LIKES_JOURNAL_DIR=directory,
+                          LIKES_FLUSH_INTERVAL=3600)
+        likes.buffer.init_app(app)
+        try:
+            fan = self.user_ids[1]
+            self.login(fan)
+            self.client.post(f"/messages/{self.message_id}/add_like")
+            self.assertEqual(Notification.query.count(), 0)
+
+            likes.buffer.flush()
+            self.assertEqual(
+                [(n.user_id, n.actor_id, n.kind, n.message_id)
+                 for n in Notification.query],
+                [(self.author_id, fan, 'like', self.message_id)])
+
+            # Only new likes
+            self.client.post(f"/messages/{self.message_id}/add_like")
+            likes.buffer.flush()
+            self.assertEqual(Notification.query.count(), 1)
+        finally:
+            likes.buffer.journal.close()
+            likes.buffer.journal = None
+            app.config['LIKES_WRITE_BEHIND'] = False
+            likes.buffer.init_app(app)
+            shutil.rmtree(directory)
+
+    def test_pages(self):
+        today = (datetime.utcnow() - snowflake.EPOCH).days
+        db.session.add_all(
+            notification_at(today - day, n, user_id=self.author_id, kind='follow',
+                            actor_id=self.user_ids[1 + n])
+            for day in range(5) for n in range(2))
+        db.session.commit()
+
+        groups = notifications.inbox(self.author_id, limit=2)
+        self.assertEqual([g.actors for g in groups], [2, 2])
+        self.assertEqual([g.timestamp.date() for g in groups],
+                         [(datetime.utcnow() - timedelta(days=day)).date()
+                          for day in (0, 1)])
+
+        seen = [g.latest for g in groups]
+        while groups:
+            groups = notifications.inbox(self.author_id, before=groups[-1].latest,
+                                         limit=2)
+            seen += [g.latest for g in groups]
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+    def test_unread_count_is_capped(self):
+        notifications.notify_many(
+            {'user_id': self.author_id, 'kind': 'follow',
+             'actor_id': self.user_ids[1]}
+            for i in range(notifications.UNREAD_CAP + 10))
+        db.session.commit()
+
+        self.assertEqual(notifications.unread_count(self.author_id),
+                         notifications.UNREAD_CAP + 1)
+        self.login(self.author_id)
+        self.assertIn(">99+</span>", self.client.get("/").get_data(as_text=True))
+
+    def test_rollup(self):
+        today = (datetime.utcnow() - snowflake.EPOCH).days
+        keep_days = app.config['NOTIFICATIONS_KEEP_DAYS']
+
+        rows = [notification_at(today - 2, n, user_id=self.author_id, kind='like',
+                                actor_id=self.user_ids[1 + n % 3],
+                                message_id=self.message_id)
+                for n in range(6)]
+        rows += [notification_at(today - 2, 10 + n, user_id=self.author_id,
+                                 kind='follow', actor_id=self.user_ids[1 + n])
+                 for n in range(2)]
+        rows += [notification_at(today, n, user_id=self.author_id, kind='like',
+                                 actor_id=self.user_ids[1 + n],
+                                 message_id=self.message_id)
+                 for n in range(2)]
+        rows.append(notification_at(today - keep_days - 1, 0, kind='follow',
+                                    user_id=self.author_id,
+                                    actor_id=self.user_ids[1]))
+        db.session.add_all(rows)
+        db.session.commit()
+
+        def summary():
+            return [(g.kind, g.latest, g.actors, g.actor.id)
+                    for g in notifications.inbox(self.author_id)]
+
+        before = summary()
+        self.assertEqual(len(before), 4)
+
+        with app.test_request_context():
+            jobs.enqueue('rollup_notifications', batch_size=1)
+
+        # One row per finished day's group; today's are left as they are
+        self.assertEqual(Notification.query.count(), 4)
+        after = summary()
+        self.assertEqual(after, before[:3])
+        self.assertEqual([actors for kind, latest, actors, actor in after],
+                         [2, 2, 3])
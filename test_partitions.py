@@ -0,0 +1,236 @@
+"""Message partition and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, MessageTerm
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import partitions
+import snowflake
+import tags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+def message_at(month, n, **kw):
+    """Message number `n` of `month`."""
+
+    id = snowflake.min_id(month) + n
+    return Message(id=id, timestamp=snowflake.timestamp(id), **kw)
+
+
+class MonthTestCase(TestCase):
+    """Test the month arithmetic behind partitions."""
+
+    def test_add_months(self):
+        self.assertEqual(partitions.add_months(datetime(2024, 11, 1), 3),
+                         datetime(2025, 2, 1))
+        self.assertEqual(partitions.add_months(datetime(2024, 1, 1), -1),
+                         datetime(2023, 12, 1))
+
+    def test_month_ids(self):
+        first, last = partitions.month_ids(datetime(2024, 2, 1))
+        self.assertEqual(snowflake.timestamp(first), datetime(2024, 2, 1))
+        self.assertEqual(snowflake.timestamp(last), datetime(2024, 3, 1))
+        self.assertEqual(partitions.partition_name(datetime(2024, 2, 1)),
+                         "messages_2024_02")
+
+
+class PartitionTestCase(TestCase):
+    """Test pruning reads to recent months and archiving old ones."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.directory = tempfile.mkdtemp()
+        partitions.archive.directory = self.directory
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                 for i in range(2)]
+        db.session.commit()
+        self.author_id, self.fan_id = [u.id for u in users]
+
+        self.this_month = partitions.month_start(datetime.utcnow())
+        self.old_month = partitions.add_months(self.this_month, -14)
+
+        self.old = [message_at(self.old_month, n, text=f"old #news {n}",
+                               user_id=self.author_id)
+                    for n in range(5)]
+        self.new = [message_at(self.this_month, n, text=f"new {n}",
+                               user_id=self.author_id)
+                    for n in range(3)]
+        db.session.add_all(self.old + self.new)
+        db.session.flush()
+        tags.index_messages(self.old)
+        db.session.add(Likes(user_id=self.fan_id, message_id=self.old[1].id))
+        db.session.add(Likes(user_id=self.fan_id, message_id=self.new[0].id))
+        db.session.commit()
+
+        self.old_ids = [msg.id for msg in self.old]
+        self.new_ids = [msg.id for msg in self.new]
+
+    def tearDown(self):
+        db.session.rollback()
+        partitions.BLOCK_SIZE = 1000
+        partitions.archive.directory = app.config['MESSAGE_ARCHIVE_DIR']
+        shutil.rmtree(self.directory)
+
+    def count_queries(self, fn):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            result = fn()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', count)
+        return result, len(statements)
+
+    def newest(self, limit):
+        query = (Message
+                 .query
+                 .filter(Message.user_id == self.author_id)
+                 .order_by(Message.id.desc()))
+        return self.count_queries(lambda: partitions.newest(query, limit))
+
+    def test_newest_stops_at_recent_months(self):
+        rows, queries = self.newest(3)
+        self.assertEqual([msg.id for msg in rows], self.new_ids[::-1])
+        self.assertEqual(queries, 1)
+
+    def test_newest_reads_back_when_needed(self):
+        rows, queries = self.newest(6)
+        self.assertEqual([msg.id for msg in rows],
+                         self.new_ids[::-1] + self.old_ids[::-1][:3])
+        self.assertEqual(queries, len(partitions.RECENT_WINDOWS) + 1)
+
+        rows, queries = self.newest(100)
+        self.assertEqual([msg.id for msg in rows],
+                         (self.old_ids + self.new_ids)[::-1])
+
+    def test_archive_old_months(self):
+        partitions.BLOCK_SIZE = 2
+        with app.test_request_context():
+            jobs.enqueue('maintain_partitions')
+
+        self.assertEqual(sorted(id for id, in db.session.query(Message.id)),
+                         self.new_ids)
+        self.assertEqual([like.message_id for like in Likes.query],
+                         [self.new_ids[0]])
+        self.assertEqual(MessageTerm.query.count(), 0)
+        self.assertTrue(os.path.exists(partitions.archive.path(self.old_month)))
+
+        self.assertEqual([row['id'] for row in
+                          partitions.archive.rows(self.old_month)],
+                         self.old_ids)
+        for id in self.old_ids:
+            self.assertEqual(partitions.archive.get(id)['id'], id)
+        self.assertIsNone(partitions.archive.get(self.old_ids[-1] + 1))
+        self.assertIsNone(partitions.archive.get(self.new_ids[0]))
+
+        resp = self.client.get(f"/messages/{self.old_ids[1]}")
+        html = resp.get_data(as_text=True)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("old <a href=\"/tags/news\">#news</a> 1", html)
+        self.assertIn("@user0", html)
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 1', html)
+
+        resp = self.client.get(f"/messages/{self.old_ids[-1] + 1}")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_archive_keeps_archived_rows(self):
+        archived_id = self.old_ids[-1] + 10
+        partitions.archive.write(self.old_month, [
+            {'id': archived_id, 'text': "archived", 'user_id': self.author_id,
+             'timestamp': snowflake.timestamp(archived_id).isoformat(),
+             'likes': 0}])
+
+        with app.test_request_context():
+            jobs.enqueue('maintain_partitions')
+
+        self.assertEqual([row['id'] for row in
+                          partitions.archive.rows(self.old_month)],
+                         self.old_ids + [archived_id])
+
+    def test_archive_write_streams_and_merges(self):
+        partitions.BLOCK_SIZE = 2
+        first = snowflake.min_id(self.old_month)
+
+        def rows(ids, text):
+            for id in ids:
+                yield {'id': first + id, 'text': text, 'user_id': self.author_id,
+                       'timestamp': self.old_month.isoformat(), 'likes': 0}
+
+        partitions.archive.write(self.old_month, rows([1, 3, 5], "old"))
+        partitions.archive.write(self.old_month, rows([2, 3, 6], "new"))
+
+        self.assertEqual([(row['id'] - first, row['text']) for row in
+                          partitions.archive.rows(self.old_month)],
+                         [(1, "old"), (2, "new"), (3, "new"), (5, "old"),
+                          (6, "new")])
+
+    def test_purge_removes_archived_messages(self):
+        partitions.BLOCK_SIZE = 2
+        fan_message = message_at(self.old_month, 10, text="fan",
+                                 user_id=self.fan_id)
+        db.session.add(fan_message)
+        db.session.commit()
+        fan_message_id = fan_message.id
+        with app.test_request_context():
+            jobs.enqueue('maintain_partitions')
+
+        self.assertEqual(partitions.archive.user_months(self.author_id),
+                         [self.old_month])
+
+        author = User.query.get(self.author_id)
+        author.deleted_at = datetime.utcnow()
+        db.session.commit()
+        with app.test_request_context():
+            jobs.enqueue('purge_account', user_id=self.author_id)
+
+        self.assertIsNone(User.query.get(self.author_id))
+        self.assertEqual([row['id'] for row in
+                          partitions.archive.rows(self.old_month)],
+                         [fan_message_id])
+        self.assertEqual(partitions.archive.user_months(self.author_id), [])
+        self.assertEqual(partitions.archive.user_months(self.fan_id),
+                         [self.old_month])
+
+    def test_nothing_to_archive(self):
+        app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'] = 24
+        try:
+            with app.test_request_context():
+                jobs.enqueue('maintain_partitions')
+        finally:
+            app.config['MESSAGE_ARCHIVE_AFTER_MONTHS'] = 12
+
+        self.assertEqual(Message.query.count(), 8)
+        self.assertEqual(os.listdir(self.directory), [])
@@ -0,0 +1,99 @@
+"""Profile summary tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_profiles.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import profiles
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class ProfileSummaryTestCase(TestCase):
+    """Test the single-query profile stats."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        profiles._cache.clear()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("one", "one@test.com", "password", None)
+        u2 = User.signup("two", "two@test.com", "password", None)
+        u3 = User.signup("three", "three@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id, self.u3_id = u1.id, u2.id, u3.id
+
+        m1 = Message(text="m1", user_id=u1.id)
+        m2 = Message(text="m2", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follows(user_being_followed_id=u3.id, user_following_id=u1.id),
+            Follows(user_being_followed_id=u1.id, user_following_id=u2.id),
+            Likes(user_id=u1.id, message_id=m2.id),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_counts(self):
+        summary = profiles.profile_summary(self.u1_id, self.u2_id)
+
+        self.assertEqual(summary, profiles.ProfileSummary(
+            messages=1, following=2, followers=1, likes=1, viewer_follows=True))
+
+        self.assertFalse(
+            profiles.profile_summary(self.u1_id, self.u3_id).viewer_follows)
+        self.assertFalse(profiles.profile_summary(self.u1_id).viewer_follows)
+
+    def test_cached_until_invalidated(self):
+        profiles.profile_summary(self.u1_id)
+
+        db.session.add(Message(text="m3", user_id=self.u1_id))
+        db.session.commit()
+        self.assertEqual(profiles.profile_summary(self.u1_id).messages, 1)
+
+        profiles.invalidate(self.u1_id)
+        self.assertEqual(profiles.profile_summary(self.u1_id).messages, 2)
+
+    def test_follow_route_invalidates(self):
+        self.assertFalse(
+            profiles.profile_summary(self.u3_id, self.u2_id).viewer_follows)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f"/users/follow/{self.u3_id}")
+
+            summary = profiles.profile_summary(self.u3_id, self.u2_id)
+            self.assertTrue(summary.viewer_follows)
+            self.assertEqual(summary.followers, 2)
+
+            resp = c.get(f"/users/{self.u3_id}")
+            self.assertIn("Unfollow", str(resp.data))
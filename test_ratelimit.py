@@ -0,0 +1,126 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ratelimit.py
+
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from ratelimit import limiter, MemoryBackend, SQLiteBackend
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class BackendTestCase(TestCase):
+    """Test token buckets in each backend."""
+
+    def check_bucket(self, backend):
+        self.assertTrue(backend.take("k", 2, 60))
+        self.assertTrue(backend.take("k", 2, 60))
+        self.assertFalse(backend.take("k", 2, 60))
+
+        # Other keys have their own bucket
+        self.assertTrue(backend.take("other", 2, 60))
+
+    def test_memory(self):
+        self.check_bucket(MemoryBackend())
+
+    def test_memory_is_bounded(self):
+        backend = MemoryBackend(max_keys=2)
+        for key in "abc":
+            backend.take(key, 1, 60)
+
+        # "a" was evicted, so it starts over with a full bucket
+        self.assertFalse(backend.take("c", 1, 60))
+        self.assertTrue(backend.take("a", 1, 60))
+
+    def test_sqlite_prunes_expired_buckets(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SQLiteBackend(os.path.join(tmp, "buckets.db"))
+            backend.PRUNE_INTERVAL = 0
+            backend.take("old", 1, 0.01)
+            time.sleep(0.02)
+            backend.take("new", 1, 60)
+
+            keys = backend._connect().execute("SELECT key FROM buckets")
+            self.assertEqual([key for key, in keys], ["new"])
+
+    def test_sqlite_shared_between_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "buckets.db")
+            self.check_bucket(SQLiteBackend(path))
+
+            # A second process opening the same file sees the empty bucket
+            self.assertFalse(SQLiteBackend(path).take("k", 2, 60))
+
+
+class LimitedRoutesTestCase(TestCase):
+    """Test that the routes reject over-limit requests."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+        self.old_backend, self.old_limits = limiter.backend, limiter.limits
+        limiter.backend = MemoryBackend()
+        limiter.limits = dict(limiter.limits, login_ip=(100, 60),
+                              login_username=(2, 60))
+        metrics.reset()
+
+    def tearDown(self):
+        limiter.backend, limiter.limits = self.old_backend, self.old_limits
+        db.session.rollback()
+
+    def test_login_throttled_before_bcrypt(self):
+        data = {"username": "victim", "password": "guess123"}
+
+        with mock.patch.object(User, 'authenticate',
+                               return_value=False) as authenticate:
+            for _ in range(2):
+                resp = self.client.post("/login", data=data)
+                self.assertEqual(resp.status_code, 200)
+
+            resp = self.client.post("/login", data=data)
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(authenticate.call_count, 2)
+
+            # A different username from the same IP is still let through
+            resp = self.client.post("/login", data={"username": "other",
+                                                    "password": "guess123"})
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(metrics.get("ratelimit.login_username.hit"), 4)
+        self.assertEqual(metrics.get("ratelimit.login_username.rejected"), 1)
+
+    def test_get_is_not_limited(self):
+        for _ in range(5):
+            resp = self.client.get("/login")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_page(self):
+        metrics.incr("ratelimit.login_ip.hit", 3)
+
+        resp = self.client.get("/metrics")
+        self.assertIn("ratelimit.login_ip.hit 3", resp.get_data(as_text=True))
@@ -0,0 +1,157 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_readmodels.py
+
+import os
+from unittest import TestCase
+
+from flask import before_render_template, template_rendered
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from readmodels import FeedItem, UserCard, ProfileSummary
+import readmodels
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class ReadModelTestCase(TestCase):
+    """Test the records themselves."""
+
+    def test_immutable(self):
+        summary = ProfileSummary(1, 2, 3, 4, viewer_follows=False)
+
+        with self.assertRaises(AttributeError):
+            summary.messages = 5
+        with self.assertRaises(AttributeError):
+            summary.extra = 5
+        self.assertFalse(hasattr(summary, '__dict__'))
+
+    def test_fields(self):
+        self.assertEqual(ProfileSummary(1, 2, 3, 4, False),
+                         ProfileSummary(messages=1, following=2, followers=3,
+                                        likes=4, viewer_follows=False))
+        self.assertNotEqual(ProfileSummary(1, 2, 3, 4, False),
+                            ProfileSummary(1, 2, 3, 4, True))
+
+        with self.assertRaises(TypeError):
+            ProfileSummary(1, 2, 3, 4)
+        with self.assertRaises(TypeError):
+            ProfileSummary(1, 2, 3, 4, False, messages=1)
+
+
+class PageTestCase(TestCase):
+    """Test that pages render from read models alone."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Nobody logs in with a password, so skip hashing them
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="unused")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+        self.viewer_id, self.author_id, self.other_id = self.user_ids
+
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "hello @user0 #birds"})
+        self.message_id = Message.query.one().id
+
+        self.login(self.viewer_id)
+        self.client.post(f"/users/follow/{self.author_id}")
+        self.client.post(f"/messages/{self.message_id}/add_like")
+
+        # Queries run while a template renders
+        self.queries = []
+        self.rendering = False
+        db.event.listen(db.engine, 'before_cursor_execute', self.count)
+        before_render_template.connect(self.start, app)
+        template_rendered.connect(self.stop, app)
+
+    def tearDown(self):
+        db.event.remove(db.engine, 'before_cursor_execute', self.count)
+        before_render_template.disconnect(self.start, app)
+        template_rendered.disconnect(self.stop, app)
+        db.session.rollback()
+
+    def count(self, conn, cursor, statement, *args):
+        if self.rendering:
+            self.queries.append(statement)
+
+    def start(self, sender, template, context):
+        self.rendering = True
+
+    def stop(self, sender, template, context):
+        self.rendering = False
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_no_queries_while_rendering(self):
+        self.login(self.author_id)
+        html = self.client.get("/notifications").get_data(as_text=True)
+        self.assertIn("@user0</a>", html)
+
+        self.login(self.viewer_id)
+        for url in ("/", f"/users/{self.author_id}",
+                    f"/messages/{self.message_id}",
+                    f"/messages/{self.message_id}/item", "/tags/birds",
+                    "/search?q=hello"):
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200, url)
+            self.assertIn("hello", resp.get_data(as_text=True), url)
+
+        self.assertEqual(self.queries, [])
+
+    def test_feed_items(self):
+        self.login(self.viewer_id)
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn(f"/messages/{self.message_id}/remove_like", html)
+
+        row = db.session.query(*readmodels.MESSAGE_COLUMNS).one()
+        [item] = readmodels.feed_items([row], {row.id: 1})
+
+        self.assertIsInstance(item, FeedItem)
+        self.assertEqual(item.author.username, "user1")
+        self.assertEqual(item.likes, 1)
+        self.assertFalse(item.liked)
+
+    def test_user_cards(self):
+        self.login(self.viewer_id)
+        html = self.client.get("/users").get_data(as_text=True)
+
+        # Following user1 only
+        self.assertIn(f'action="/users/stop-following/{self.author_id}"', html)
+        self.assertIn(f'action="/users/follow/{self.other_id}"', html)
+
+        cards = list(readmodels.user_cards(
+            readmodels.card_query().order_by(User.id), self.viewer_id,
+            batch_size=2))
+        self.assertEqual([c.username for c in cards],
+                         ["user0", "user1", "user2"])
+        self.assertEqual([c.viewer_follows for c in cards],
+                         [False, True, False])
+        self.assertIsInstance(cards[0], UserCard)
@@ -0,0 +1,109 @@
+"""Full-text search tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_search.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import search
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class SearchTestCase(TestCase):
+    """Test indexing and searching messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": text})
+
+        return Message.query.filter_by(text=text).one().id
+
+    def test_post_is_searchable(self):
+        self.post("the quick brown fox")
+        self.post("a lazy dog")
+
+        found = search.search_messages("QUICK fox")
+        self.assertEqual([m.text for m in found], ["the quick brown fox"])
+
+        resp = self.client.get("/search?q=lazy")
+        self.assertIn("a lazy dog", str(resp.data))
+        self.assertNotIn("brown fox", str(resp.data))
+
+    def test_query_syntax_is_inert(self):
+        self.post("fox AND hound")
+
+        self.assertEqual(search.search_messages('"'), [])
+        self.assertEqual(len(search.search_messages('fox" (hound*')), 1)
+
+    def test_ranked_and_paged(self):
+        self.post("bird")
+        self.post("bird bird bird")
+
+        first = search.search_messages("bird", per_page=1)
+        second = search.search_messages("bird", page=2, per_page=1)
+
+        self.assertEqual(first[0].text, "bird bird bird")
+        self.assertEqual(second[0].text, "bird")
+
+    def test_delete_unindexes(self):
+        msg_id = self.post("short lived")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f"/messages/{msg_id}/delete")
+
+        # Reuse the id for an unrelated message; the old text must not match
+        db.session.add(Message(id=msg_id, text="replacement", user_id=self.user_id))
+        db.session.commit()
+
+        self.assertEqual(search.search_messages("short"), [])
+
+    def test_reindex(self):
+        db.session.add_all([Message(text=f"backlog {i}", user_id=self.user_id)
+                            for i in range(3)])
+        db.session.commit()
+        self.assertEqual(search.search_messages("backlog"), [])
+
+        with app.app_context():
+            jobs.enqueue('reindex_messages', batch_size=2)
+
+        self.assertEqual(len(search.search_messages("backlog")), 3)
@@ -0,0 +1,178 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_session_store.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from session_store import MemoryStore, SQLiteStore, ServerSessionInterface
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class StoreTestCase(TestCase):
+    """Test each session store."""
+
+    def check_store(self, store):
+        store.set("a", {"curr_user": 1}, 1, 60)
+        store.set("b", {"curr_user": 1}, 1, 60)
+        store.set("c", {"curr_user": 2}, 2, 60)
+        store.set("old", {"curr_user": 3}, 3, -1)
+
+        self.assertEqual(store.get("a"), {"curr_user": 1})
+        self.assertIsNone(store.get("old"))
+        self.assertIsNone(store.get("missing"))
+
+        store.delete_user(1, keep="b")
+        self.assertIsNone(store.get("a"))
+        self.assertIsNotNone(store.get("b"))
+        self.assertIsNotNone(store.get("c"))
+
+        store.delete("c")
+        self.assertIsNone(store.get("c"))
+
+    def test_memory(self):
+        self.check_store(MemoryStore())
+
+    def test_memory_is_bounded(self):
+        store = MemoryStore(max_sessions=2)
+        for sid in "abc":
+            store.set(sid, {}, None, 60)
+
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("c"), {})
+
+    def test_memory_forgets_evicted_sessions(self):
+        store = MemoryStore(max_sessions=1)
+        for user_id in range(5):
+            store.set(f"s{user_id}", {}, user_id, 60)
+
+        self.assertLessEqual(len(store._by_user), 2)
+        self.assertEqual(store._by_user[4], {"s4"})
+
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.check_store(SQLiteStore(os.path.join(tmp, "sessions.db")))
+
+    def test_sqlite_prunes_expired_sessions(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteStore(os.path.join(tmp, "sessions.db"))
+            store.PRUNE_INTERVAL = 0
+            store.set("old", {}, 1, -1)
+            store.set("new", {}, 1, 60)
+
+            sids = store._connect().execute("SELECT sid FROM sessions")
+            self.assertEqual([sid for sid, in sids], ["new"])
+
+
+class ServerSessionViewTestCase(TestCase):
+    """Test the app running on server-side sessions."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.store = MemoryStore()
+        self.old_interface = app.session_interface
+        app.session_interface = ServerSessionInterface(self.store, CURR_USER_KEY)
+
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        app.session_interface = self.old_interface
+        db.session.rollback()
+
+    def login(self, client):
+        return client.post("/login", data={"username": "testuser",
+                                           "password": "testuser"})
+
+    def session_cookie(self, client):
+        name = app.config['SESSION_COOKIE_NAME']
+        return next(c.value for c in client.cookie_jar if c.name == name)
+
+    def test_cookie_is_opaque_id(self):
+        client = app.test_client()
+        self.login(client)
+
+        sid = self.session_cookie(client)
+        self.assertEqual(self.store.get(sid)[CURR_USER_KEY], self.user_id)
+
+        resp = client.get("/users/profile/")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_untouched_session_not_loaded(self):
+        client = app.test_client()
+        resp = client.get("/static/stylesheets/style.css")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn("Set-Cookie", resp.headers)
+
+    def test_password_change_revokes_other_sessions(self):
+        laptop = app.test_client()
+        phone = app.test_client()
+        self.login(laptop)
+        self.login(phone)
+
+        resp = laptop.post("/users/profile/", data={
+            "username": "testuser",
+            "email": "test@test.com",
+            "new_password": "brandnew",
+            "password": "testuser",
+        })
+        self.assertEqual(resp.status_code, 302)
+
+        resp = laptop.get("/users/profile/")
+        self.assertEqual(resp.status_code, 200)
+
+        resp = phone.get("/users/profile/", follow_redirects=True)
+        self.assertIn("Access unauthorized", str(resp.data))
+
+        self.assertTrue(User.authenticate("testuser", "brandnew"))
+
+    def test_login_rotates_id(self):
+        # An id someone got before logging in (here from a flash message)
+        attacker = app.test_client()
+        attacker.get("/logout")
+        planted = self.session_cookie(attacker)
+        self.assertIsNotNone(self.store.get(planted))
+
+        victim = app.test_client()
+        victim.set_cookie('localhost', app.config['SESSION_COOKIE_NAME'],
+                          planted)
+        self.login(victim)
+
+        self.assertNotEqual(self.session_cookie(victim), planted)
+        self.assertIsNone(self.store.get(planted))
+
+        resp = attacker.get("/users/profile/")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_logout_clears_session(self):
+        client = app.test_client()
+        self.login(client)
+        sid = self.session_cookie(client)
+
+        client.get("/logout")
+        self.assertNotIn(CURR_USER_KEY, self.store.get(sid) or {})
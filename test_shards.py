@@ -0,0 +1,302 @@
+"""Message and like sharding tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_shards.py
+
+import base64
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Likes, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import profiles
+import shards
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+SHARD_COUNT = 3
+
+
+class JumpHashTestCase(TestCase):
+    """Test the consistent hash that places users on shards."""
+
+    def test_in_range_and_stable(self):
+        for key in range(1000):
+            bucket = shards.jump_hash(key, 7)
+            self.assertTrue(0 <= bucket < 7)
+            self.assertEqual(shards.jump_hash(key, 7), bucket)
+
+    def test_adding_a_bucket_only_moves_keys_into_it(self):
+        moved = 0
+        for key in range(1000):
+            before, after = shards.jump_hash(key, 4), shards.jump_hash(key, 5)
+            if before != after:
+                self.assertEqual(after, 4)
+                moved += 1
+
+        # About a fifth of the keys should move
+        self.assertTrue(100 < moved < 300)
+
+
+class ShardViewTestCase(TestCase):
+    """Test the routes that read and write messages on shards."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        app.config['MESSAGE_SHARDS'] = ','.join(
+            f"sqlite:///{self.directory}/shard{n}.db" for n in range(SHARD_COUNT))
+        shards.router.init_app(app)
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        # Enough users that every shard gets some
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                 for i in range(8)]
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+        self.assertEqual(len({shards.router.shard_for(id) for id in self.user_ids}),
+                         SHARD_COUNT)
+
+        for followed in self.user_ids[1:]:
+            db.session.add(Follows(user_being_followed_id=followed,
+                                   user_following_id=self.user_ids[0]))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.router.remove()
+        app.config['MESSAGE_SHARDS'] = None
+        shards.router.init_app(app)
+        shutil.rmtree(self.directory)
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        resp = self.client.post("/messages/new", data={"text": text})
+        self.assertEqual(resp.status_code, 302)
+
+    def shard_rows(self, n, model):
+        return shards.router.sessions()[n].query(model).all()
+
+    def all_rows(self, model):
+        return [row for n in range(SHARD_COUNT) for row in self.shard_rows(n, model)]
+
+    def like(self, user_id, msg_id):
+        self.login(user_id)
+        resp = self.client.post(f"/messages/{msg_id}/add_like")
+        self.assertEqual(resp.status_code, 302)
+
+    def test_messages_go_to_the_authors_shard(self):
+        for user_id in self.user_ids:
+            self.post(user_id, f"hello from {user_id}")
+
+        self.assertEqual(Message.query.count(), 0)
+        for n in range(SHARD_COUNT):
+            authors = {msg.user_id for msg in self.shard_rows(n, Message)}
+            self.assertEqual(authors, {id for id in self.user_ids
+                                       if shards.router.shard_for(id) == n})
+
+        user_id = self.user_ids[3]
+        resp = self.client.get(f"/users/{user_id}")
+        self.assertIn(f"hello from {user_id}", str(resp.data))
+
+    def test_home_feed_merges_shards(self):
+        for i in range(3):
+            for user_id in self.user_ids:
+                self.post(user_id, f"message {i} from {user_id}")
+
+        with app.test_request_context():
+            user = User.query.get(self.user_ids[0])
+            feed = shards.router.newest_messages(
+                [u.id for u in user.following] + [user.id], 10)
+            self.assertEqual(len(feed), 10)
+            self.assertEqual([msg.id for msg in feed],
+                             sorted((msg.id for msg in feed), reverse=True))
+            # The last round of posts, newest first, then the round before
+            self.assertEqual([msg.text for msg in feed[:8]],
+                             [f"message 2 from {id}" for id in reversed(self.user_ids)])
+
+        self.login(self.user_ids[0])
+        resp = self.client.get("/")
+        for user_id in self.user_ids[1:]:
+            self.assertIn(f"message 2 from {user_id}", str(resp.data))
+
+    def test_likes_go_to_the_likers_shard(self):
+        author = self.user_ids[1]
+        self.post(author, "like me")
+        msg_id = shards.router.session_for(author).query(Message).one().id
+
+        likers = self.user_ids[2:6]
+        for user_id in likers:
+            self.login(user_id)
+            resp = self.client.post(f"/messages/{msg_id}/add_like")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Likes.query.count(), 0)
+        for n in range(SHARD_COUNT):
+            self.assertEqual({like.user_id for like in self.shard_rows(n, Likes)},
+                             {id for id in likers if shards.router.shard_for(id) == n})
+
+        with app.test_request_context():
+            msg = shards.router.get_message(msg_id)
+            self.assertEqual(msg.user.id, author)
+            self.assertEqual(shards.router.like_counts([msg]), {msg_id: 4})
+
+        self.login(likers[0])
+        self.client.post(f"/messages/{msg_id}/remove_like")
+        with app.test_request_context():
+            msg = shards.router.get_message(msg_id)
+            self.assertEqual(shards.router.like_counts([msg]), {msg_id: 3})
+
+        resp = self.client.get(f"/messages/{msg_id}")
+        self.assertIn("like me", str(resp.data))
+
+    def test_one_like_per_message_on_shards(self):
+        user_id = self.user_ids[1]
+        session = shards.router.session_for(user_id)
+        session.add_all([Likes(user_id=user_id, message_id=1),
+                         Likes(user_id=user_id, message_id=1)])
+        with self.assertRaises(IntegrityError):
+            session.commit()
+        session.rollback()
+
+    def test_unknown_message_is_404(self):
+        self.login(self.user_ids[0])
+        resp = self.client.get("/messages/12345")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_needs_query_feed_engine(self):
+        app.config['FEED_ENGINE'] = 'hybrid'
+        try:
+            with self.assertRaises(ValueError):
+                shards.router.init_app(app)
+        finally:
+            app.config['FEED_ENGINE'] = 'query'
+
+    def test_delete_message_and_its_likes(self):
+        author = self.user_ids[1]
+        self.post(author, "short lived")
+        msg_id = shards.router.session_for(author).query(Message).one().id
+        for user_id in self.user_ids[2:6]:
+            self.like(user_id, msg_id)
+
+        self.login(author)
+        resp = self.client.post(f"/messages/{msg_id}/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        shards.router.remove()
+        self.assertEqual(self.all_rows(Message), [])
+        self.assertEqual(self.all_rows(Likes), [])
+
+    def test_batch_goes_to_the_authors_shard(self):
+        author = self.user_ids[2]
+        token = base64.b64encode(b"user2:password").decode()
+        resp = self.client.post(
+            "/api/messages/batch", json={"messages": [{"text": "one"},
+                                                      {"text": "two"}]},
+            headers={'Authorization': f"Basic {token}"})
+        self.assertEqual(resp.status_code, 200)
+
+        ids = [result['id'] for result in resp.get_json()['results']]
+        self.assertEqual(Message.query.count(), 0)
+        shard = shards.router.session_for(author)
+        self.assertEqual(sorted(msg.id for msg in shard.query(Message)), sorted(ids))
+
+    def test_likes_page_and_profile_counts(self):
+        liker = self.user_ids[0]
+        for author in self.user_ids[1:4]:
+            self.post(author, f"liked from {author}")
+        for msg in self.all_rows(Message):
+            self.like(liker, msg.id)
+
+        # A deleted author's messages drop out of the likes page
+        gone = User.query.get(self.user_ids[3])
+        gone.deleted_at = db.func.now()
+        db.session.commit()
+
+        resp = self.client.get(f"/users/{liker}/likes")
+        html = resp.get_data(as_text=True)
+        self.assertIn(f"liked from {self.user_ids[1]}", html)
+        self.assertIn(f"liked from {self.user_ids[2]}", html)
+        self.assertNotIn(f"liked from {self.user_ids[3]}", html)
+
+        with app.test_request_context():
+            profiles.invalidate(liker)
+            summary = profiles.profile_summary(liker)
+            # Likes of the deleted account's message count until the purge
+            self.assertEqual((summary.messages, summary.following,
+                              summary.likes), (0, 6, 3))
+            summary = profiles.profile_summary(self.user_ids[1])
+            self.assertEqual((summary.messages, summary.followers), (1, 1))
+
+    def test_purge_account(self):
+        gone, other = self.user_ids[1], self.user_ids[2]
+        self.post(gone, "bye")
+        self.post(other, "hi")
+        [bye] = shards.router.session_for(gone).query(Message).all()
+        [hi] = shards.router.session_for(other).query(Message).all()
+        self.like(other, bye.id)
+        self.like(gone, hi.id)
+
+        self.login(gone)
+        resp = self.client.post("/users/delete")
+        self.assertEqual(resp.status_code, 302)
+
+        shards.router.remove()
+        self.assertIsNone(User.query.get(gone))
+        self.assertEqual([msg.text for msg in self.all_rows(Message)], ["hi"])
+        self.assertEqual(self.all_rows(Likes), [])
+
+    def test_inbox_shows_sharded_messages(self):
+        self.post(self.user_ids[1], "hello @user0")
+
+        self.login(self.user_ids[0])
+        resp = self.client.get("/notifications")
+        self.assertIn("hello @user0", resp.get_data(as_text=True))
+
+    def test_tags_mentions_and_search(self):
+        author = self.user_ids[1]
+        self.post(author, "hello #birds @user0")
+        self.post(self.user_ids[2], "hello #birds from a deleted account")
+        gone = User.query.get(self.user_ids[2])
+        gone.deleted_at = db.func.now()
+        db.session.commit()
+
+        self.login(self.user_ids[0])
+        for url in ("/tags/birds", f"/users/{self.user_ids[0]}/mentions",
+                    "/search?q=hello"):
+            html = self.client.get(url).get_data(as_text=True)
+            self.assertIn("hello <a", html, url)
+            self.assertNotIn("deleted account", html, url)
+
+        msg_id = shards.router.session_for(author).query(Message).one().id
+        self.login(author)
+        self.client.post(f"/messages/{msg_id}/delete")
+        html = self.client.get("/tags/birds").get_data(as_text=True)
+        self.assertNotIn("hello", html)
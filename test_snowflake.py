@@ -0,0 +1,167 @@
+"""Message id generator tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_snowflake.py
+
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import snowflake
+from snowflake import IdGenerator
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1700000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test id layout, ordering and worker claims."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def generator(self, **kw):
+        gen = IdGenerator(lock_dir=self.dir, clock=self.clock, **kw)
+        self.addCleanup(gen.release)
+        return gen
+
+    def test_ids_increase_and_carry_time(self):
+        gen = self.generator()
+        first = gen.next_id()
+        second = gen.next_id()
+        self.clock.now += 0.001
+        third = gen.next_id()
+
+        self.assertEqual(second, first + 1)
+        self.assertGreater(third, second)
+        self.assertEqual(snowflake.timestamp(first),
+                         datetime(1970, 1, 1) + timedelta(seconds=1700000000))
+
+    def test_sequence_overflow_and_clock_going_back(self):
+        gen = self.generator()
+        ids = [gen.next_id() for _ in range(snowflake.MAX_SEQUENCE + 2)]
+
+        self.clock.now -= 10
+        ids.append(gen.next_id())
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(snowflake.timestamp(ids[-2]) - snowflake.timestamp(ids[0]),
+                         timedelta(milliseconds=1))
+
+    def test_threads_get_unique_ids(self):
+        gen = self.generator()
+        ids = []
+
+        def make():
+            ids.extend(gen.next_id() for _ in range(1000))
+
+        threads = [threading.Thread(target=make) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(set(ids)), 4000)
+
+    def test_processes_claim_different_workers(self):
+        first = self.generator(workers=range(3, 5))
+        second = self.generator(workers=range(3, 5))
+        third = self.generator(workers=range(3, 5))
+
+        first.next_id()
+        second.next_id()
+        self.assertEqual((first.worker_id, second.worker_id), (3, 4))
+
+        with self.assertRaises(RuntimeError):
+            third.next_id()
+
+        first.release()
+        third.next_id()
+        self.assertEqual(third.worker_id, 3)
+
+    @skipUnless(hasattr(os, 'fork'), "needs fork")
+    def test_forked_child_claims_its_own_worker(self):
+        gen = self.generator()
+        gen.next_id()
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            gen._after_fork()
+            gen.next_id()
+            os.write(write, str(gen.worker_id).encode())
+            os._exit(0)
+
+        os.waitpid(pid, 0)
+        child_worker = int(os.read(read, 10))
+        os.close(read)
+        os.close(write)
+
+        self.assertNotEqual(child_worker, gen.worker_id)
+
+    def test_parse_workers(self):
+        self.assertEqual(snowflake.parse_workers("8-15"), range(8, 16))
+        self.assertEqual(snowflake.parse_workers("7"), range(7, 8))
+        with self.assertRaises(ValueError):
+            snowflake.parse_workers("0-1024")
+
+
+class MessageIdTestCase(TestCase):
+    """Test that messages get time-ordered ids and matching timestamps."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("u", "u@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_new_messages(self):
+        before = datetime.utcnow() - timedelta(seconds=1)
+        messages = [Message(text=f"m{i}", user_id=self.user_id) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        ids = [msg.id for msg in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertGreater(ids[0], 2 ** 32)
+
+        for msg in messages:
+            self.assertEqual(msg.timestamp, snowflake.timestamp(msg.id))
+            self.assertGreater(msg.timestamp, before)
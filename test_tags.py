@@ -0,0 +1,130 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_tags.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, MessageTerm
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import jobs
+import tags
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class ExtractTestCase(TestCase):
+    """Test term parsing and rendering."""
+
+    def test_extract_terms(self):
+        self.assertEqual(
+            tags.extract_terms("#Flask and #flask with @Bob, not me@mail"),
+            {"#flask", "@bob"})
+
+    def test_linkify_tags(self):
+        html = tags.linkify_tags("<b>it's</b> #Python @bob")
+
+        self.assertIn('<a href="/tags/python">#Python</a>', html)
+        self.assertIn("&lt;b&gt;it&#39;s&lt;/b&gt;", html)
+        self.assertIn("@bob", html)
+        self.assertNotIn("/tags/39", html)
+
+
+class TagViewTestCase(TestCase):
+    """Test indexing on post and the tag/mention timelines."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        other = User.signup("other", "other@test.com", "testuser", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def post(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": text})
+
+    def test_post_indexes_terms(self):
+        self.post("hi @other, #warbler time")
+
+        terms = {t.term for t in MessageTerm.query.all()}
+        self.assertEqual(terms, {"@other", "#warbler"})
+
+        resp = self.client.get("/tags/Warbler")
+        self.assertIn('<a href="/tags/warbler">#warbler</a> time', str(resp.data))
+
+        resp = self.client.get(f"/users/{self.other_id}/mentions")
+        self.assertIn("hi @other", str(resp.data))
+
+    def test_tag_pagination(self):
+        msgs = [Message(text=f"#paged {i}", user_id=self.user_id)
+                for i in range(tags.PAGE_SIZE + 5)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        for msg in msgs:
+            tags.index_message(msg)
+        db.session.commit()
+
+        first = tags.messages_for_term("#paged")
+        self.assertEqual(len(first), tags.PAGE_SIZE)
+        self.assertEqual(first[0].id, msgs[-1].id)
+
+        rest = tags.messages_for_term("#paged", before=first[-1].id)
+        self.assertEqual([m.id for m in rest], [m.id for m in msgs[4::-1]])
+
+        resp = self.client.get("/tags/paged")
+        self.assertIn(f"?before={first[-1].id}", str(resp.data))
+
+    def test_backfill(self):
+        db.session.add_all([
+            Message(text="old #one", user_id=self.user_id),
+            Message(text="older #two @other", user_id=self.user_id),
+            Message(text="plain", user_id=self.user_id),
+        ])
+        db.session.commit()
+
+        with app.app_context():
+            jobs.enqueue('backfill_terms', batch_size=1)
+
+        terms = sorted(t.term for t in MessageTerm.query.all())
+        self.assertEqual(terms, ["#one", "#two", "@other"])
+
+    def test_delete_message_drops_terms(self):
+        self.post("bye #gone")
+        msg_id = Message.query.one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f"/messages/{msg_id}/delete")
+
+        self.assertEqual(MessageTerm.query.count(), 0)
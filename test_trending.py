@@ -0,0 +1,155 @@
+"""Trending counter tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_trending.py
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from trending import CountMinSketch, SlidingCounter
+import trending
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CounterTestCase(TestCase):
+    """Test the sketch and sliding window."""
+
+    def test_sketch_never_undercounts(self):
+        sketch = CountMinSketch(width=64, depth=3)
+        for i in range(500):
+            sketch.add(i % 50)
+
+        for key in range(50):
+            self.assertGreaterEqual(sketch.estimate(key), 10)
+
+    def test_window_slides(self):
+        clock = FakeClock()
+        counter = SlidingCounter(buckets=3, bucket_seconds=10, clock=clock)
+
+        counter.add("#old", 5)
+        clock.now += 10
+        counter.add("#new", 2)
+        self.assertEqual(counter.estimate("#old"), 5)
+
+        clock.now += 20
+        self.assertEqual(counter.estimate("#old"), 0)
+        self.assertEqual(counter.estimate("#new"), 2)
+
+        clock.now += 1000
+        self.assertEqual(counter.top(5), [])
+
+    def test_top_is_bounded(self):
+        counter = SlidingCounter(candidates=3)
+        for i in range(10):
+            counter.add(f"#t{i}", i + 1)
+
+        self.assertEqual(len(counter.candidates), 3)
+        self.assertEqual(counter.top(2), [("#t9", 10), ("#t8", 9)])
+
+    def test_snapshot_round_trip(self):
+        counter = SlidingCounter()
+        counter.add(42, 3)
+
+        restored = SlidingCounter()
+        restored.load_dict(counter.to_dict())
+
+        self.assertEqual(restored.top(1), [(42, 3)])
+
+
+class TrendingViewTestCase(TestCase):
+    """Test recording from the routes and the home page panel."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        trending.trending_tags = SlidingCounter()
+        trending.trending_likes = SlidingCounter()
+
+        self.client = app.test_client()
+
+        user = User.signup("testuser", "test@test.com", "testuser", None)
+        other = User.signup("other", "other@test.com", "testuser", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.other_id = other.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_home_shows_trending(self):
+        msg = Message(text="liked", user_id=self.other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post("/messages/new", data={"text": "#Hot take"})
+            c.post(f"/messages/{msg_id}/add_like")
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+        self.assertIn('<a href="/tags/hot">#hot</a>', html)
+        self.assertIn("1 likes", html)
+
+    def test_only_changes_count(self):
+        msg = Message(text="liked", user_id=self.other_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.post(f"/messages/{msg_id}/remove_like")
+        for _ in range(3):
+            self.client.post(f"/messages/{msg_id}/add_like")
+        self.assertEqual(trending.trending_likes.top(1), [(msg_id, 1)])
+
+        for _ in range(2):
+            self.client.post(f"/messages/{msg_id}/remove_like")
+        self.assertEqual(trending.trending_likes.top(1), [])
+
+    def test_snapshot_file(self):
+        trending.trending_tags.add("#saved", 4)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trending.json")
+            trending.save_snapshot(path)
+
+            trending.trending_tags = SlidingCounter()
+            trending.load_snapshot(path)
+
+        self.assertEqual(trending.top_tags(), [("#saved", 4)])
@@ -5,6 +5,7 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User, Likes, Follows
@@ -20,6 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import jobs
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -30,6 +32,8 @@ db.create_all()
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
+# Run background jobs inline
+app.config['JOBS_MODE'] = 'local'
 
 class UserViewTestCase(TestCase):
     """Test views for users"""
@@ -151,6 +155,22 @@ class UserViewTestCase(TestCase):
         db.session.add_all([f1,f2,f3])
         db.session.commit()
     
+    def test_stop_following_deleted_user(self):
+        self.setup_followers()
+        u1 = User.query.get(self.u1_id)
+        u1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.post(f"/users/stop-following/{self.u1_id}")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertIsNone(Follows.query.get((self.u1_id, self.testuser_id)))
+        self.assertEqual(Follows.query.count(), 2)
+
     def test_show_who_user_is_following(self):
         self.setup_followers()
         with self.client as c:
@@ -196,4 +216,79 @@ class UserViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
 
-    
\ No newline at end of file
+    
+    def test_list_pages_are_streamed(self):
+        self.setup_followers()
+        self.setup_likes()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            for url in ["/users", f"/users/{self.testuser_id}/following",
+                        f"/users/{self.testuser_id}/followers",
+                        f"/users/{self.testuser_id}/likes"]:
+                resp = c.get(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertTrue(resp.is_streamed)
+
+            html = resp.get_data(as_text=True)
+            self.assertIn("something here again", html)
+            self.assertIn('<i class="fa fa-thumbs-up"></i> 1', html)
+
+    def test_streamed_page_shows_flash_once(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [("danger", "Something went wrong")]
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("Something went wrong", html)
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertNotIn("Something went wrong", html)
+
+    def test_user_search_no_results(self):
+        resp = self.client.get('/users?q=nobody')
+        self.assertIn("Sorry, no users found", str(resp.data))
+        self.assertNotIn("@testuser", str(resp.data))
+
+    def test_delete_user_hides_then_purges(self):
+        self.setup_followers()
+        app.config['JOBS_MODE'] = 'queue'
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                resp = c.post("/users/delete")
+                self.assertEqual(resp.status_code, 302)
+
+                # Still in the table, but gone from every page
+                self.assertIsNotNone(User.query.get(self.u1_id).deleted_at)
+
+                resp = c.get("/users")
+                self.assertNotIn("@hello", str(resp.data))
+
+                resp = c.get(f"/users/{self.u1_id}")
+                self.assertEqual(resp.status_code, 404)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get(f"/users/{self.testuser_id}/following")
+                self.assertNotIn("@hello", str(resp.data))
+                self.assertIn("@bonjour", str(resp.data))
+
+                self.assertFalse(User.authenticate("hello", "pass12"))
+
+            with app.app_context():
+                jobs.work(burst=True)
+
+            self.assertIsNone(User.query.get(self.u1_id))
+            self.assertEqual(
+                Follows.query.filter(
+                    (Follows.user_following_id == self.u1_id) |
+                    (Follows.user_being_followed_id == self.u1_id)).count(),
+                0)
+        finally:
+            app.config['JOBS_MODE'] = 'local'
@@ -0,0 +1,236 @@
+"""Trending hashtags and most-liked messages for Warbler.
+
+Counts are kept incrementally as messages are posted and liked, so the
+home page never re-aggregates `messages` or `likes`. Each trend is a
+`SlidingCounter`: a ring of count-min sketches, one per time bucket,
+which together cover the last hour in fixed memory however many distinct
+tags or messages come through. Alongside the sketches, a small candidate
+set tracks the current heavy hitters so the top entries can be listed
+without scanning anything.
+
+Counters live in each app process. With TRENDING_SNAPSHOT_PATH set they
+are written to disk every TRENDING_SNAPSHOT_INTERVAL seconds and reloaded
+on startup, so a restart doesn't wipe the window.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from models import db, User, Message
+from shards import router
+import tags
+
+# A top message's row when it's gathered from the shards
+TopMessage = namedtuple('TopMessage', 'id text username')
+
+
+class CountMinSketch:
+    """Approximate counts for arbitrary keys in `width` x `depth` cells.
+
+    Estimates never undercount (for non-negative totals); they overcount by
+    at most a small fraction of the total with high probability.
+    """
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.clear()
+
+    def cells(self, key):
+        """Column index of `key` in each row."""
+
+        digest = hashlib.blake2b(str(key).encode(), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self.width
+                for i in range(self.depth)]
+
+    def add(self, key, amount=1):
+        for row, col in zip(self.rows, self.cells(key)):
+            row[col] += amount
+
+    def estimate(self, key):
+        return min(row[col] for row, col in zip(self.rows, self.cells(key)))
+
+    def clear(self):
+        self.rows = [array('l', [0]) * self.width for _ in range(self.depth)]
+
+
+class SlidingCounter:
+    """Approximate per-key counts over the last `buckets` x `bucket_seconds`.
+
+    Keeps up to `candidates` keys as possible heavy hitters; `top()` ranks
+    those by their current windowed estimate.
+    """
+
+    def __init__(self, buckets=12, bucket_seconds=300, width=2048, depth=4,
+                 candidates=50, clock=time.time):
+        self.bucket_seconds = bucket_seconds
+        self.sketches = [CountMinSketch(width, depth) for _ in range(buckets)]
+        self.max_candidates = candidates
+        self.candidates = {}
+        self.clock = clock
+        self.epoch = self._epoch()
+        self._lock = threading.Lock()
+
+    def _epoch(self):
+        return int(self.clock() // self.bucket_seconds)
+
+    def _advance(self):
+        """Clear buckets that have slid out of the window since last use."""
+
+        epoch = self._epoch()
+        stale = min(epoch - self.epoch, len(self.sketches))
+        for i in range(1, stale + 1):
+            self.sketches[(self.epoch + i) % len(self.sketches)].clear()
+        self.epoch = epoch
+
+    def _estimate(self, key):
+        cells = self.sketches[0].cells(key)
+        return min(sum(sketch.rows[row][col] for sketch in self.sketches)
+                   for row, col in enumerate(cells))
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self._advance()
+            self.sketches[self.epoch % len(self.sketches)].add(key, amount)
+
+            self.candidates[key] = self._estimate(key)
+            if len(self.candidates) > self.max_candidates:
+                del self.candidates[min(self.candidates, key=self.candidates.get)]
+
+    def estimate(self, key):
+        with self._lock:
+            self._advance()
+            return self._estimate(key)
+
+    def top(self, n):
+        """Up to `n` (key, count) pairs with the highest current counts."""
+
+        with self._lock:
+            self._advance()
+            for key in self.candidates:
+                self.candidates[key] = self._estimate(key)
+
+            ranked = sorted(self.candidates.items(), key=lambda kv: -kv[1])
+            return [(key, count) for key, count in ranked[:n] if count > 0]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'epoch': self.epoch,
+                'sketches': [[row.tolist() for row in sketch.rows]
+                             for sketch in self.sketches],
+                'candidates': list(self.candidates.items()),
+            }
+
+    def load_dict(self, data):
+        """Restore state saved by `to_dict` (with the same dimensions)."""
+
+        with self._lock:
+            self.epoch = data['epoch']
+            for sketch, rows in zip(self.sketches, data['sketches']):
+                sketch.rows = [array('l', row) for row in rows]
+            self.candidates = dict(data['candidates'])
+            self._advance()
+
+
+trending_tags = SlidingCounter()
+trending_likes = SlidingCounter()
+
+_snapshot = {'path': None, 'interval': 60, 'last': 0.0}
+
+
+def record_message(msg):
+    """Count the hashtags in a newly posted message."""
+
+    for term in tags.extract_terms(msg.text):
+        if term.startswith('#'):
+            trending_tags.add(term)
+    maybe_snapshot()
+
+
+def record_like(message_id, amount=1):
+    """Count a like (or, with amount=-1, an unlike) of a message."""
+
+    trending_likes.add(message_id, amount)
+    maybe_snapshot()
+
+
+def top_tags(n=5):
+    """[(tag, count)] for the most used hashtags in the window."""
+
+    return trending_tags.top(n)
+
+
+def top_messages(n=5):
+    """[(row, count)] for the most liked messages in the window.
+
+    Each row has the message's `id` and `text` and its author's `username`.
+    """
+
+    top = trending_likes.top(n)
+    if not top:
+        return []
+
+    if not router.enabled:
+        found = {row.id: row for row in (db.session
+                                         .query(Message.id, Message.text,
+                                                User.username)
+                                         .join(User, User.id == Message.user_id)
+                                         .filter(Message.id.in_([id for id, _ in top]),
+                                                 User.deleted_at.is_(None)))}
+        return [(found[id], count) for id, count in top if id in found]
+
+    # The messages are spread over the shards and `users` is in the main
+    # database, so the join happens here
+    rows = router.messages_by_ids([id for id, _ in top])
+    usernames = dict(db.session
+                     .query(User.id, User.username)
+                     .filter(User.id.in_({row.user_id for row in rows}),
+                             User.deleted_at.is_(None)))
+    found = {row.id: TopMessage(row.id, row.text, usernames[row.user_id])
+             for row in rows if row.user_id in usernames}
+    return [(found[id], count) for id, count in top if id in found]
+
+
+def save_snapshot(path):
+    """Write both counters to `path`, replacing it atomically."""
+
+    data = {'tags': trending_tags.to_dict(), 'likes': trending_likes.to_dict()}
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def load_snapshot(path):
+    """Restore both counters from a file written by `save_snapshot`."""
+
+    with open(path) as f:
+        data = json.load(f)
+    trending_tags.load_dict(data['tags'])
+    trending_likes.load_dict(data['likes'])
+
+
+def maybe_snapshot():
+    """Save a snapshot if one is configured and the interval has passed."""
+
+    path = _snapshot['path']
+    now = time.time()
+    if path and now - _snapshot['last'] >= _snapshot['interval']:
+        _snapshot['last'] = now
+        save_snapshot(path)
+
+
+def init_app(app):
+    """Set up snapshotting from config and reload the last snapshot."""
+
+    _snapshot['path'] = app.config.get('TRENDING_SNAPSHOT_PATH')
+    _snapshot['interval'] = app.config.get('TRENDING_SNAPSHOT_INTERVAL', 60)
+
+    if _snapshot['path'] and os.path.exists(_snapshot['path']):
+        load_snapshot(_snapshot['path'])